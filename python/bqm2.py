@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 
+import hashlib
 import json
 import logging
 import optparse
-from genericpath import isfile
-from os import listdir
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
 from time import sleep
 
 from collections import defaultdict
@@ -15,11 +19,27 @@ from google.cloud import storage
 from google.cloud.bigquery.client import Client
 from google.cloud.bigquery.job import QueryJobConfig
 
+from filehash import fileHashes
 from loader import DelegatingFileSuffixLoader, \
     BqQueryTemplatingFileLoader, BqDataFileLoader, \
     TableType
-from resource import BqJobs
+from resource import BqJobs, ResourceFailed, UriIndex, bashPool, \
+    gcsLedger, uploadPool
 from google.cloud import bigquery
+import resource
+import tmplhelper
+
+
+# glob patterns, one per line, of files and folders to skip during
+# discovery.  Relative to the folder the ignore file is in
+IGNORE_FILE = ".bqm2ignore"
+
+
+class SelectionError(ValueError):
+    """ the resources asked for can't be run as they are, e.g. a
+    selection matches nothing or depends on missing inputs.  Reported as
+    a usage error """
+    pass
 
 
 class DependencyBuilder:
@@ -27,32 +47,156 @@ class DependencyBuilder:
     Dependency builder loads resources from the folders specified.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, recursive=False, include=None,
+                 exclude=None):
+        """
+        :param recursive: also discover files in the sub folders of
+        each folder
+        :param include: glob patterns.  If any, only files whose path
+        relative to the folder or name matches one are loaded
+        :param exclude: glob patterns of files and folders to skip
+        """
         self.loader = loader
-
-    def buildDepend(self, folders) -> tuple:
+        self.recursive = recursive
+        self.include = include or []
+        self.exclude = exclude or []
+
+    def matches(self, patterns: list, relPath: str) -> bool:
+        name = relPath.split("/")[-1]
+        return any([fnmatch(relPath, p) or fnmatch(name, p)
+                    for p in patterns])
+
+    def readIgnoreFile(self, folder: str) -> list:
+        try:
+            with open(os.path.join(folder, IGNORE_FILE)) as f:
+                return [line.strip().rstrip("/") for line in f
+                        if line.strip() and not line.startswith("#")]
+        except FileNotFoundError:
+            return []
+
+    def discover(self, folder: str, relFolder="", ignored=()):
+        """ yields the files under folder we can load, in name order.
+        Folders are scanned as they are reached so loading starts
+        before discovery finishes
+
+        :param ignored: (folder path relative to the root, patterns)
+        of the ignore files of the folders above this one
+        """
+        patterns = self.readIgnoreFile(folder)
+        if len(patterns):
+            ignored = ignored + ((relFolder, patterns),)
+
+        def isIgnored(relPath):
+            if self.matches(self.exclude, relPath):
+                return True
+            for (base, basePatterns) in ignored:
+                if self.matches(basePatterns, relPath[len(base):]
+                                .lstrip("/")):
+                    return True
+            return False
+
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            relPath = "/".join([relFolder, entry.name]).lstrip("/")
+            if isIgnored(relPath):
+                continue
+            if entry.is_dir():
+                # i.e. .git
+                if self.recursive and not entry.name.startswith("."):
+                    yield from self.discover(entry.path, relPath, ignored)
+            elif entry.is_file() and self.loader.handles(entry.path) and \
+                    (not len(self.include) or
+                     self.matches(self.include, relPath)):
+                yield entry.path
+
+    def buildDepend(self, folders, asOf: datetime = None) -> tuple:
         """ folders arg is an array of strings which should point
         at folders containing resource descriptions loadable by
-        self.loader """
+        self.loader
+
+        :param asOf: the time relative date vars are evaluated against
+        rather than tmplhelper.asOf
+        """
         resources = {}
         resourceDependencies = {}
-        for folder in folders:
-            folder = re.sub("/$", "", folder)
-            for name in listdir(folder):
-                file = "/".join([folder, name])
-                if isfile(file) and self.loader.handles(file):
-                    for rsrc in self.loader.load(file):
+        previous = tmplhelper.asOf
+        if asOf is not None:
+            tmplhelper.asOf = asOf
+        try:
+            for folder in folders:
+                folder = re.sub("/$", "", folder)
+                for file in self.discover(folder):
+                    for rsrc in self.loader.load(file, root=folder):
                         resources[rsrc.key()] = rsrc
+        finally:
+            tmplhelper.asOf = previous
+            fileHashes.flush()
+
+        for rsrc in resources.values():
+            resourceDependencies[rsrc.key()] = set([])
+
+        for rsrc in resources.values():
+            for osrc in resources.values():
+                if rsrc.dependsOn(osrc):
+                    resourceDependencies[rsrc.key()].add(osrc.key())
+
+        # resources reading gcs depend on those writing what they read
+        writers = UriIndex()
+        for rsrc in resources.values():
+            for uri in rsrc.gcsWrites():
+                writers.add(uri, rsrc.key())
+        for rsrc in resources.values():
+            for uri in rsrc.gcsReads():
+                resourceDependencies[rsrc.key()].update(
+                    [k for k in writers.lookup(uri) if k != rsrc.key()])
 
-            for rsrc in resources.values():
-                resourceDependencies[rsrc.key()] = set([])
+        return (resources, resourceDependencies)
 
-            for rsrc in resources.values():
-                for osrc in resources.values():
-                    if rsrc.dependsOn(osrc):
-                        resourceDependencies[rsrc.key()].add(osrc.key())
 
-        return (resources, resourceDependencies)
+def selectSubgraph(dependencies: dict, selectors: list) -> set:
+    """
+    :param dependencies: the keys each resource key depends on
+    :param selectors: resource keys or globs of them.  A leading + also
+    selects everything they depend on, directly or not, and a trailing +
+    everything which depends on them.  i.e. +dataset.table+
+    :return: the keys selected
+    """
+    dependants = defaultdict(set)
+    for (k, deps) in dependencies.items():
+        for d in deps:
+            dependants[d].add(k)
+
+    def closure(keys, edges):
+        ret = set([])
+        toVisit = list(keys)
+        while len(toVisit):
+            k = toVisit.pop()
+            if k not in ret:
+                ret.add(k)
+                toVisit.extend(edges.get(k, []))
+        return ret
+
+    selected = set([])
+    for selector in selectors:
+        pattern = selector.strip("+")
+        keys = [k for k in dependencies.keys() if fnmatch(k, pattern)]
+        if not len(keys):
+            raise SelectionError("--select " + selector +
+                                 " matches no resources")
+        selected.update(keys)
+        if selector.startswith("+"):
+            selected.update(closure(keys, dependencies))
+        if selector.endswith("+"):
+            selected.update(closure(keys, dependants))
+    return selected
+
+
+def restrictTo(dependencies: dict, selected: set) -> dict:
+    """ :return: the dependencies of the selected keys only.  Their
+    dependencies outside of the selection are kept, not being in the
+    result they are treated as already finished - frozen inputs """
+    return {k: v for (k, v) in dependencies.items() if k in selected}
 
 
 class DependencyExecutor:
@@ -62,6 +206,8 @@ class DependencyExecutor:
         self.resources = resources
         self.dependencies = dependencies
         self.maxRetry = maxRetry
+        # why each resource which could not be built failed
+        self.failed = {}
 
     def dump(self, folder):
         """ dump expanded templates to a folder """
@@ -119,6 +265,47 @@ class DependencyExecutor:
 
                     self.dependencies[n] = self.dependencies[n] - torm
 
+    def plan(self) -> int:
+        """ prints what would be executed in order along with how each
+        resource would be built.  Checks what can be checked locally,
+        i.e. the format of files to load, so problems show before
+        anything is uploaded
+
+        :return: the number of resources which could not be planned
+        """
+        errors = 0
+        for level in self.levels():
+            for n in level:
+                print("would execute", n)
+                try:
+                    plan = self.resources[n].plan()
+                except Exception as e:
+                    errors += 1
+                    print("    error:", e)
+                    continue
+                if plan:
+                    print("    " + plan)
+        return errors
+
+    def levels(self) -> list:
+        """ :return: lists of keys, each depending only on keys of the
+        lists before it """
+        remaining = {k: set(v) & self.dependencies.keys()
+                     for (k, v) in self.dependencies.items()}
+        ret = []
+        while len(remaining):
+            level = sorted([k for (k, v) in remaining.items()
+                            if not len(v)])
+            if not len(level):
+                raise Exception("circular dependencies between " +
+                                " ".join(sorted(remaining.keys())))
+            for k in level:
+                del remaining[k]
+            for v in remaining.values():
+                v.difference_update(level)
+            ret.append(level)
+        return ret
+
     def dotml(self):
         print("digraph g {\n")
         for (k, s) in sorted(self.dependencies.items()):
@@ -136,37 +323,144 @@ class DependencyExecutor:
             raise Exception("Maximum retries hit for resource",
                             rsrcKey)
 
-    def execute(self, checkFrequency=10, maxConcurrent=10):
+    def launch(self, n, awaitingStamp: set, builtFrom: dict,
+               depFingerprints: dict):
+        """ (re)create resource n.  Its metadata, including the
+        fingerprint of the inputs it was built from, is stamped once it
+        is seen to no longer be running """
+        builtFrom[n] = self.inputsFingerprint(depFingerprints)
+        try:
+            self.resources[n].create()
+        except ResourceFailed as e:
+            self.fail(n, str(e))
+            return False
+        self.resources[n].invalidate()
+        awaitingStamp.add(n)
+        return True
+
+    def checkRunning(self, n) -> bool:
+        """ :return: whether n is running.  n is failed rather than
+        retried if its run can't succeed """
+        try:
+            return self.resources[n].isRunning()
+        except ResourceFailed as e:
+            self.fail(n, str(e))
+            return False
+
+    def fail(self, n, reason: str):
+        """ drops n, and everything depending on it, from the run """
+        logging.error("%s failed: %s", n, reason)
+        self.failed[n] = reason
+        toVisit = [n]
+        while len(toVisit):
+            k = toVisit.pop()
+            self.dependencies.pop(k, None)
+            for (d, deps) in self.dependencies.items():
+                if k in deps and d not in self.failed:
+                    self.failed[d] = "depends on " + k + " which failed"
+                    toVisit.append(d)
+
+    def stampCompleted(self, completed: list, builtFrom: dict,
+                       maxConcurrent=10):
+        """ The post run phase.  Records hashes etc on the resources
+        whose jobs have completed.  These are independent so we write
+        them concurrently """
+        if not len(completed):
+            return
+
+        def stamp(n):
+            print("stamping metadata for", n)
+            self.resources[n].invalidate()
+            self.resources[n].stampMetadata(builtFrom.pop(n, None))
+            self.resources[n].invalidate()
+
+        with ThreadPoolExecutor(max_workers=maxConcurrent) as pool:
+            # list to surface exceptions
+            list(pool.map(stamp, completed))
+
+    def inputsFingerprint(self, fingerprints: dict):
+        """ :param fingerprints: fingerprint of each dependency keyed
+        by resource key """
+        joined = "\n".join(["=".join([k, fingerprints[k]])
+                            for k in sorted(fingerprints.keys())])
+        return hashlib.md5(joined.encode("utf-8")).hexdigest()
+
+    def dependenciesChanged(self, n, depUpdateTime, depFingerprints):
+        recorded = self.resources[n].recordedInputs()
+        if recorded is None:
+            # built before we recorded input fingerprints
+            return self.resources[n].updateTime() < depUpdateTime
+        return recorded != self.inputsFingerprint(depFingerprints)
+
+    def frozenInputs(self) -> set:
+        """ :return: the keys depended on which are not part of the
+        run, i.e. outside of --select.  They are used as they are """
+        return set([d for deps in self.dependencies.values()
+                    for d in deps if d not in self.dependencies])
+
+    def checkFrozenInputs(self):
+        """ raises SelectionError if a frozen input does not exist """
+        missing = sorted([k for k in self.frozenInputs()
+                          if not self.resources[k].exists()])
+        if len(missing):
+            raise SelectionError("selected resources depend on missing " +
+                                 ", ".join(missing) +
+                                 ", include them in --select")
+
+    def execute(self, checkFrequency=10, maxConcurrent=10) -> dict:
+        """ :return: why each resource which could not be built, or
+        depends on one which could not, failed """
+        self.checkFrozenInputs()
         running = set([])
         retries = defaultdict(lambda: self.maxRetry)
+        # resources we have launched or seen running which need
+        # their metadata stamped once they complete
+        awaitingStamp = set([])
+        # the inputs fingerprint of each resource we launched
+        builtFrom = {}
 
         # def update times is a dict of maximum of the update
         # times of the dependencies of a resource
 
         depUpdateTimes = defaultdict(lambda: 0)
+        # the fingerprints of the dependencies of a resource.  Finished
+        # resources don't change so we only fingerprint them once
+        depFingerprints = defaultdict(dict)
+        finished = {}
         while len(self.dependencies):
             todel = set([])
             for n in sorted(self.dependencies.keys()):
                 if not len(self.dependencies[n]):
                     todel.add(n)
 
-            """ flag to capture if anything was running.  If so,
-            we will pause before looping again """
+            ready = []
             for n in sorted(todel):
-                if (self.resources[n].isRunning()):
+                if self.checkRunning(n):
                     print(self.resources[n], "already running")
                     running.add(n)
-                    continue
+                    awaitingStamp.add(n)
+                elif n in self.failed:
+                    running.discard(n)
+                    awaitingStamp.discard(n)
                 else:
                     running.discard(n)
+                    ready.append(n)
+
+            completed = [n for n in ready if n in awaitingStamp]
+            self.stampCompleted(completed, builtFrom, maxConcurrent)
+            awaitingStamp.difference_update(completed)
+
+            for n in ready:
                 if not self.resources[n].exists():
                     if len(running) >= maxConcurrent:
                         print("max concurrent running already")
                         continue
                     self.handleRetries(retries, n)
                     print("executing: because it doesn't exist ", n)
-                    self.resources[n].create()
-                    if (self.resources[n].isRunning()):
+                    if not self.launch(n, awaitingStamp, builtFrom,
+                                       depFingerprints[n]):
+                        continue
+                    if self.checkRunning(n):
                         running.add(n)
                 elif self.resources[n].shouldUpdate():
                     if len(running) >= maxConcurrent:
@@ -175,9 +469,12 @@ class DependencyExecutor:
                     self.handleRetries(retries, n)
                     print("executing: because our definition has changed",
                           n, self.resources[n])
-                    self.resources[n].create()
+                    if not self.launch(n, awaitingStamp, builtFrom,
+                                       depFingerprints[n]):
+                        continue
                     running.add(n)
-                elif self.resources[n].updateTime() < depUpdateTimes[n]:
+                elif self.dependenciesChanged(n, depUpdateTimes[n],
+                                              depFingerprints[n]):
                     if len(running) >= maxConcurrent:
                         print("max concurrent running already")
                         continue
@@ -185,7 +482,9 @@ class DependencyExecutor:
                     print("executing: because our dependencies have "
                           "changed since we last ran",
                           n, self.resources[n])
-                    self.resources[n].create()
+                    if not self.launch(n, awaitingStamp, builtFrom,
+                                       depFingerprints[n]):
+                        continue
                     running.add(n)
                 else:
                     print(self.resources[n],
@@ -205,8 +504,12 @@ class DependencyExecutor:
                     if k in torm:
                         continue
                     if k not in self.dependencies:
-                        kDateTime = self.resources[k].updateTime()
+                        if k not in finished:
+                            finished[k] = (self.resources[k].updateTime(),
+                                           self.resources[k].fingerprint())
+                        (kDateTime, kFingerprint) = finished[k]
                         depUpdateTimes[n] = max(depUpdateTimes[n], kDateTime)
+                        depFingerprints[n][k] = kFingerprint
                         torm.add(k)
 
                 self.dependencies[n] = self.dependencies[n] - torm
@@ -214,6 +517,169 @@ class DependencyExecutor:
             if len(self.dependencies):
                 sleep(checkFrequency)
 
+        for (n, reason) in sorted(self.failed.items()):
+            print("failed:", n, reason)
+        return self.failed
+
+
+class Backfill:
+    """
+    Materializes the resources of folders once per as-of date of a
+    range.  The relative date vars are evaluated against each date in
+    turn and the graph of each date is executed on its own so dates
+    progress in parallel.  Resources which don't vary by date are
+    executed once up front.  The outcome of each date is recorded in a
+    ledger so a rerun only retries the dates which didn't finish.
+    """
+
+    def __init__(self, builder: DependencyBuilder, folders: list,
+                 ledger: str, maxRetry=2, selectors=None):
+        """ :param selectors: see selectSubgraph.  Restricts the
+        resources backfilled for each date """
+        self.builder = builder
+        self.folders = folders
+        self.ledger = ledger
+        self.maxRetry = maxRetry
+        self.selectors = selectors
+        self.lock = threading.Lock()
+
+    def dates(self, start: str, end: str) -> list:
+        """ :return: every date from start to end inclusive.  Hourly if
+        they are given as yyyymmddhh, daily otherwise """
+        if len(start) != len(end):
+            raise SelectionError("backfill range must be both yyyymmdd or "
+                                 "both yyyymmddhh: " + start + " " + end)
+        (format, step) = ("%Y%m%d", timedelta(days=1))
+        if len(start) == 10:
+            (format, step) = ("%Y%m%d%H", timedelta(hours=1))
+        (dt, last) = (tmplhelper.parseAsOf(start),
+                      tmplhelper.parseAsOf(end))
+        ret = []
+        while dt <= last:
+            ret.append(dt.strftime(format))
+            dt += step
+        return ret
+
+    def loadLedger(self) -> dict:
+        try:
+            with open(self.ledger) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, progress: dict, date: str, state: str):
+        with self.lock:
+            progress[date] = state
+            with open(self.ledger + ".tmp", "w") as f:
+                json.dump(progress, f, indent=2, sort_keys=True)
+            os.replace(self.ledger + ".tmp", self.ledger)
+
+    def loadGraphs(self, dates: list) -> dict:
+        """ :return: the (resources, dependencies) of each date.  The
+        templates are compiled once and rendered for each date """
+        graphs = {}
+        for date in dates:
+            (resources, dependencies) = self.builder.buildDepend(
+                self.folders, asOf=tmplhelper.parseAsOf(date))
+            if self.selectors:
+                dependencies = restrictTo(
+                    dependencies,
+                    selectSubgraph(dependencies, self.selectors))
+            graphs[date] = (resources, dependencies)
+        return graphs
+
+    def partition(self, graphs: dict) -> tuple:
+        """
+        splits out the resources executed for more than one date along
+        with what they depend on.  Each date keeps its dependencies on
+        them, as it does on resources outside of any selection, as
+        frozen inputs.  Raises SelectionError if a resource executed for
+        several dates is defined differently for some of them, i.e. its
+        name does not vary by date but its query does
+
+        :return: the common (resources, dependencies) and the remaining
+        (resources, dependencies) of each date
+        """
+        owner = {}
+        seen = defaultdict(int)
+        resources = {}
+        for date in sorted(graphs.keys()):
+            resources.update(graphs[date][0])
+            for k in graphs[date][1].keys():
+                owner[k] = date
+                seen[k] += 1
+
+        common = set([])
+        toVisit = [k for (k, count) in seen.items() if count > 1]
+        while len(toVisit):
+            k = toVisit.pop()
+            if k in common or k not in owner:
+                continue
+            common.add(k)
+            toVisit.extend(graphs[owner[k]][1][k])
+
+        for k in sorted(common):
+            dates = [d for d in sorted(graphs.keys())
+                     if k in graphs[d][1]]
+            first = graphs[dates[0]][0][k]
+            for date in dates[1:]:
+                if not first == graphs[date][0][k]:
+                    raise SelectionError(
+                        "{} is defined differently for {} and {} so "
+                        "can't be backfilled once for both.  Make its "
+                        "name vary by date too".format(k, dates[0], date))
+
+        commonGraph = (resources,
+                       {k: set(graphs[owner[k]][1][k]) for k in common})
+        perDate = {}
+        for (date, (resources, dependencies)) in graphs.items():
+            perDate[date] = (resources,
+                             {k: set(v) for (k, v) in dependencies.items()
+                              if k not in common})
+        return (commonGraph, perDate)
+
+    def execute(self, start: str, end: str, parallelDates=4,
+                checkFrequency=10, maxConcurrent=10) -> list:
+        """ :return: the dates which failed """
+        progress = self.loadLedger()
+        pending = [d for d in self.dates(start, end)
+                   if progress.get(d) != "done"]
+        if not len(pending):
+            print("backfill of", start, "to", end, "already done")
+            return []
+
+        (common, perDate) = self.partition(self.loadGraphs(pending))
+        failed = DependencyExecutor(*common, maxRetry=self.maxRetry).execute(
+            checkFrequency=checkFrequency, maxConcurrent=maxConcurrent)
+        if len(failed):
+            # every date builds on the common resources
+            for date in pending:
+                self.record(progress, date, "failed: " +
+                            ", ".join(sorted(failed.keys())))
+            return pending
+
+        def run(date):
+            print("backfilling", date)
+            try:
+                failed = DependencyExecutor(
+                    *perDate[date], maxRetry=self.maxRetry).execute(
+                    checkFrequency=checkFrequency,
+                    maxConcurrent=maxConcurrent)
+            except Exception as e:
+                logging.exception("backfill of %s failed", date)
+                self.record(progress, date, "failed: " + str(e))
+                return date
+            if len(failed):
+                self.record(progress, date, "failed: " +
+                            ", ".join(sorted(failed.keys())))
+                return date
+            self.record(progress, date, "done")
+            return None
+
+        with ThreadPoolExecutor(max_workers=parallelDates) as pool:
+            failed = [d for d in pool.map(run, pending) if d is not None]
+        return failed
+
 
 if __name__ == "__main__":
     parser = optparse.OptionParser("[options] folder[ folder2[...]]")
@@ -230,6 +696,12 @@ if __name__ == "__main__":
     parser.add_option("--show", dest="show",
                       action="store_true", default=False,
                       help="Show the dependency tree")
+    parser.add_option("--plan", dest="plan",
+                      action="store_true", default=False,
+                      help="Show the order resources would be executed "
+                           "in and how, i.e. the format local files "
+                           "would be loaded as.  Exits non-zero if any "
+                           "can't be")
     parser.add_option("--dumpToFolder", dest="dumpToFolder",
                       default=None,
                       help="Dump expanded templates to disk to the "
@@ -272,11 +744,101 @@ if __name__ == "__main__":
                            "created. i.e. us-east1, us-central1, etc",
                       default="US")
 
+    parser.add_option("--maxCombinations", type=int,
+                      default=tmplhelper.maxCombinations,
+                      help="The maximum number of combinations a single "
+                           "entry of a .vars file may explode into. "
+                           "Loading fails fast beyond this")
+    parser.add_option("--asOf", type=str, default=None,
+                      help="The time relative date vars are evaluated "
+                           "against as yyyymmdd or yyyymmddhh.  Defaults "
+                           "to the time the run started.  Useful for "
+                           "backfills")
+    parser.add_option("--backfill", dest="backfill",
+                      action="store_true", default=False,
+                      help="'backfill' mode.  Executes the folders once "
+                           "for each as-of date from --from to --to, "
+                           "several dates in parallel")
+    parser.add_option("--from", dest="backfillFrom", type=str,
+                      help="The first as-of date of the backfill as "
+                           "yyyymmdd or yyyymmddhh")
+    parser.add_option("--to", dest="backfillTo", type=str,
+                      help="The last as-of date of the backfill as "
+                           "yyyymmdd or yyyymmddhh")
+    parser.add_option("--backfillDates", type=int, default=4,
+                      help="The number of dates backfilled in parallel. "
+                           "--maxConcurrent applies to each")
+    parser.add_option("--backfillLedger", type=str,
+                      default="bqm2backfill.json",
+                      help="The file the progress of each date of the "
+                           "backfill is recorded in.  Dates recorded as "
+                           "done are skipped when rerun")
+
+    parser.add_option("--recursive", dest="recursive",
+                      action="store_true", default=False,
+                      help="Also load the files in the sub folders of "
+                           "each folder")
+    parser.add_option("--include", dest="include", action="append",
+                      default=[],
+                      help="A glob of the files to load, matched against "
+                           "the path relative to the folder or the file "
+                           "name.  May be repeated.  Defaults to all")
+    parser.add_option("--exclude", dest="exclude", action="append",
+                      default=[],
+                      help="A glob of the files or folders to skip. "
+                           "May be repeated.  Patterns in .bqm2ignore "
+                           "files are skipped as well")
+
+    parser.add_option("--bashWorkers", type=int, default=4,
+                      help="The maximum number of bashtemplate scripts "
+                           "to run locally in parallel")
+    parser.add_option("--uploadWorkers", type=int, default=4,
+                      help="The maximum number of localdata chunks to "
+                           "upload in parallel")
+    parser.add_option("--bashStreamChunkSize", type=int, default=100,
+                      help="Megabytes of a streaming bashtemplate's "
+                           "output read before its upload starts.  Output "
+                           "within this is not reloaded when unchanged")
+    parser.add_option("--localdataChunkSize", type=int, default=0,
+                      help="Split .localdata files larger than this many "
+                           "megabytes into chunks uploaded in parallel. "
+                           "Not split by default")
+    parser.add_option("--localdataGzip", action="store_true",
+                      default=False,
+                      help="Compress .localdata files as they are "
+                           "uploaded")
+    parser.add_option("--localdataSniff", action="store_true",
+                      default=False,
+                      help="Sniff the delimiter and header row of "
+                           "delimited .localdata files from a sample "
+                           "rather than always skipping one header row")
+    parser.add_option("--gcsFullRefresh", action="store_true",
+                      default=False,
+                      help="Reload incremental .gcsdata tables from all "
+                           "of their objects rather than appending the "
+                           "new ones")
+    parser.add_option("--select", dest="select", action="append",
+                      default=[],
+                      help="Only process the resource with this key, i.e. "
+                           "dataset.table, or glob of keys.  Prefix with "
+                           "+ to include everything it depends on, suffix "
+                           "with + to include everything depending on it. "
+                           "May be repeated.  Resources outside the "
+                           "selection are left as they are")
+
     (options, args) = parser.parse_args()
 
     FORMAT = '%(asctime)-15s %(clientip)s %(user)-8s %(message)s'
     logging.basicConfig(format=FORMAT)
 
+    tmplhelper.maxCombinations = options.maxCombinations
+    bashPool.resize(options.bashWorkers)
+    uploadPool.resize(options.uploadWorkers)
+    resource.streamChunkBytes = options.bashStreamChunkSize * 1024 * 1024
+    gcsLedger.fullRefresh = options.gcsFullRefresh
+    if options.asOf:
+        tmplhelper.asOf = tmplhelper.parseAsOf(options.asOf)
+
     additional_args = {'location': options.bqClientLocation}
     kwargs = {"dataset": options.defaultDataset}
     if options.varsFile:
@@ -296,7 +858,7 @@ if __name__ == "__main__":
     gcsClient = storage.Client(project=kwargs["project"])
 
     bqJobs = BqJobs(client)
-    if options.execute:
+    if options.execute or options.backfill:
         bqJobs.loadTableJobs()
 
     builder = DependencyBuilder(
@@ -317,10 +879,11 @@ if __name__ == "__main__":
                                              bqJobs,
                                              TableType.VIEW,
                                              kwargs),
-            localdata=BqDataFileLoader(loadClient,
-                                       kwargs['dataset'],
-                                       kwargs['project'],
-                                       bqJobs),
+            localdata=BqDataFileLoader(
+                loadClient, kwargs['dataset'], kwargs['project'], bqJobs,
+                gzip=options.localdataGzip,
+                chunkBytes=options.localdataChunkSize * 1024 * 1024,
+                sniffFormat=options.localdataSniff),
             gcsdata=BqQueryTemplatingFileLoader(client, gcsClient,
                                                 bqJobs,
                                                 TableType.TABLE_GCS_LOAD,
@@ -332,17 +895,54 @@ if __name__ == "__main__":
             externaltable=BqQueryTemplatingFileLoader(loadClient, gcsClient,
                                                       bqJobs,
                                                       TableType.EXTERNAL_TABLE,
-                                                      kwargs))
+                                                      kwargs)),
+        recursive=options.recursive,
+        include=options.include,
+        exclude=options.exclude
     )
 
+    if options.backfill:
+        if not options.backfillFrom or not options.backfillTo:
+            parser.error("--backfill requires --from and --to")
+        try:
+            failed = Backfill(builder, args, options.backfillLedger,
+                              maxRetry=options.maxRetry,
+                              selectors=options.select).execute(
+                options.backfillFrom, options.backfillTo,
+                parallelDates=options.backfillDates,
+                checkFrequency=options.checkFrequency,
+                maxConcurrent=options.maxConcurrent)
+        except SelectionError as e:
+            parser.error(str(e))
+        if len(failed):
+            print("backfill failed for", " ".join(failed))
+            sys.exit(1)
+        sys.exit(0)
+
     (resources, dependencies) = builder.buildDepend(args)
+    if options.select:
+        try:
+            dependencies = restrictTo(dependencies,
+                                      selectSubgraph(dependencies,
+                                                     options.select))
+        except SelectionError as e:
+            parser.error(str(e))
     executor = DependencyExecutor(resources, dependencies,
                                   maxRetry=options.maxRetry)
     if options.execute:
-        executor.execute(checkFrequency=options.checkFrequency,
-                         maxConcurrent=options.maxConcurrent)
+        try:
+            executor.checkFrozenInputs()
+        except SelectionError as e:
+            parser.error(str(e))
+        failed = executor.execute(checkFrequency=options.checkFrequency,
+                                  maxConcurrent=options.maxConcurrent)
+        if len(failed):
+            sys.exit(1)
     elif options.show:
         executor.show()
+    elif options.plan:
+        if executor.plan():
+            sys.exit(1)
     elif options.dotml:
         executor.dotml()
     elif options.dumpToFolder:
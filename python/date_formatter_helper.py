@@ -1,5 +1,8 @@
 from datetime import datetime
 
+# the most dates whose components each helper remembers
+maxExpansions = 100000
+
 
 class DateFormatHelper:
     def __init__(self, formats: list, formats_suffixes: list):
@@ -9,21 +12,43 @@ class DateFormatHelper:
         """
         self.formats = formats
         self.formats_suffixes = formats_suffixes
+        # date formatted with formats[0] -> the rest of its formats
+        self.expansions = {}
 
         assert len(formats)
         assert len(formats) == len(formats_suffixes)
 
+    def precompute(self, dates: list):
+        """ fills the expansion table for dates so formatting keys with
+        any of them is a lookup """
+        if len(self.expansions) + len(dates) > maxExpansions:
+            self.expansions.clear()
+        for dt in dates:
+            self.expansions[dt.strftime(self.formats[0])] = \
+                tuple([dt.strftime(f) for f in self.formats[1:]])
+
+    def expand(self, v: str) -> tuple:
+        """ :return: v in each of formats[1:] """
+        ret = self.expansions.get(v)
+        if ret is None:
+            dt = datetime.strptime(v, self.formats[0])
+            self.precompute([dt])
+            # v needn't be how formats[0] writes dt e.g. 2024011
+            ret = self.expansions[dt.strftime(self.formats[0])]
+        return ret
+
     def format_date_key(self, k: str, v: str, m: dict):
         if k.endswith(f"_{self.formats_suffixes[0]}") \
                 or k == self.formats_suffixes[0]:
+            expanded = None
             for i in range(1, len(self.formats_suffixes)):
                 newkey = k.replace(self.formats_suffixes[0],
                                    self.formats_suffixes[i])
                 if newkey in m:
                     continue
-                newval = datetime.strptime(v, self.formats[0])\
-                    .strftime(self.formats[i])
-                m[newkey] = newval
+                if expanded is None:
+                    expanded = self.expand(v)
+                m[newkey] = expanded[i - 1]
 
     def show_new_keys(self, keys: list):
         m = set()
@@ -48,13 +73,22 @@ class DateFormatHelpers:
             ret.update(f.show_new_keys(keys))
         return ret
 
+    def precompute(self, format: str, dates: list):
+        """ precomputes the components of dates for the helper whose
+        base format is format """
+        for f in self.formatters:
+            if f.formats[0] == format:
+                f.precompute(dates)
+
     def format_date_keys(self, k: str, v: str, m: dict):
         for f in self.formatters:
             f.format_date_key(k, v, m)
 
     def format_all_date_keys(self, m: dict):
+        # keys generated by one formatter are never base keys of another
+        # so we only need to list the keys once
+        kv = [x for x in m.items()]
         for f in self.formatters:
-            kv = [x for x in m.items()]
             for x in kv:
                 try:
                     f.format_date_key(x[0], x[1], m)
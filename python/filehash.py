@@ -0,0 +1,115 @@
+"""
+Cached file hashing.
+
+Hashes are kept in a sidecar file per folder keyed by file name along
+with the size, modification time and inode of the file when it was
+hashed.  An unchanged file costs a single stat to hash again, including
+across runs.  Other facts derived from a file's content, such as its
+format, are kept alongside.
+
+Sidecars are rewritten by flush rather than as each file is hashed, once
+discovery is done and again at exit.
+"""
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import threading
+
+SIDECAR = ".bqm2hashes"
+
+ALGORITHMS = {
+    "md5": hashlib.md5,
+    "blake2b": lambda: hashlib.blake2b(digest_size=20)
+}
+
+
+def hashFile(path: str, algorithm: str = "blake2b") -> str:
+    """ hashes path by mapping it into memory rather than reading it
+    through a buffer """
+    h = ALGORITHMS[algorithm]()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+    return h.hexdigest()
+
+
+class FileHashCache:
+    def __init__(self, persist=True):
+        """
+        :param persist: save hashes to a sidecar file in the folder of
+        each file hashed
+        """
+        self.persist = persist
+        self.stores = {}
+        # folders whose store has changed since it was last saved
+        self.dirty = set([])
+        self.lock = threading.Lock()
+
+    def statKey(self, path: str) -> list:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def store(self, folder: str) -> dict:
+        if folder not in self.stores:
+            store = {}
+            if self.persist:
+                try:
+                    with open(os.path.join(folder, SIDECAR)) as f:
+                        store = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            self.stores[folder] = store
+        return self.stores[folder]
+
+    def save(self, folder: str):
+        if not self.persist:
+            return
+        sidecar = os.path.join(folder, SIDECAR)
+        try:
+            with open(sidecar + ".tmp", "w") as f:
+                json.dump(self.stores[folder], f, sort_keys=True)
+            os.replace(sidecar + ".tmp", sidecar)
+        except OSError:
+            # read only folders simply don't get hashes persisted
+            pass
+
+    def flush(self):
+        """ saves the store of each folder changed since the last flush """
+        with self.lock:
+            for folder in sorted(self.dirty):
+                self.save(folder)
+            self.dirty.clear()
+
+    def digest(self, path: str, algorithm: str = "blake2b") -> str:
+        """ :return: hex digest of the content of path """
+        return self.derived(path, algorithm,
+                            lambda p: hashFile(p, algorithm))
+
+    def derived(self, path: str, name: str, compute):
+        """ :return: compute(path), remembered under name for as long as
+        the file is unchanged.  It must be json serializable """
+        folder, base = os.path.split(os.path.abspath(path))
+        key = self.statKey(path)
+        with self.lock:
+            store = self.store(folder)
+            entry = store.get(base)
+            if entry is None or entry["stat"] != key:
+                entry = {"stat": key}
+                store[base] = entry
+            if name in entry:
+                return entry[name]
+
+        value = compute(path)
+        with self.lock:
+            # the file may have changed while we computed
+            if self.statKey(path) == key:
+                entry[name] = value
+                self.dirty.add(folder)
+        return value
+
+
+fileHashes = FileHashCache()
+atexit.register(fileHashes.flush)
@@ -1,4 +1,7 @@
 import json
+import os
+import threading
+from collections import ChainMap
 from json.decoder import JSONDecodeError
 
 from google.cloud.bigquery.client import Client
@@ -10,22 +13,24 @@ from google.cloud import storage
 from google.cloud.exceptions import NotFound
 
 import tmplhelper
+from filehash import fileHashes
 from resource import BqExternalTableBasedResource
 from resource import Resource, _buildDataSetKey_, BqDatasetBackedResource, \
     BqJobs, BqQueryBackedTableResource, _buildDataSetTableKey_, \
     BqViewBackedTableResource, BqDataLoadTableResource, \
     BqExtractTableResource, BqGcsTableLoadResource, BqProcessTableResource
-from tmplhelper import evalTmplRecurse, explodeTemplate
-from date_formatter_helper import helpers
+from tmplhelper import TemplateScope
 
 
 class FileLoader:
     def __init__(self):
         pass
 
-    def load(self, file) -> Resource:
+    def load(self, file, root: str = None) -> Resource:
         """ The resource loader will attempt to load the resources
-        which it handles from the file arg """
+        which it handles from the file arg
+
+        :param root: the folder file was discovered under, if any """
         pass
 
     def handles(self, file) -> bool:
@@ -46,7 +51,7 @@ class DelegatingFileSuffixLoader(FileLoader):
                 raise ValueError("args must be subclass of FileLoader")
             self.loaders = kwargs
 
-    def load(self, file):
+    def load(self, file, root: str = None):
         suffixParts = file.split("/")[-1].split(".")
         if len(suffixParts) == 1:
             raise ValueError(file +
@@ -54,7 +59,7 @@ class DelegatingFileSuffixLoader(FileLoader):
                              str(self.loaders.keys()) + " to be processed"
                              )
         try:
-            return self.loaders[suffixParts[-1]].load(file)
+            return self.loaders[suffixParts[-1]].load(file, root=root)
         except KeyError:
             raise ValueError("No loader associated with suffix: " +
                              suffixParts[-1])
@@ -89,6 +94,12 @@ def parseDatasetTable(filePath, defaultDataset: str, bqClient: Client,
                          "dataset.table.suffix or table.suffix")
 
 
+def isTrue(value) -> bool:
+    """ for boolean template vars which may be json booleans or
+    strings """
+    return str(value).lower() == "true"
+
+
 def parseDataset(filePath):
     """ Takes a file path and parses to dataset string"""
     tokens = filePath.split("/")[-1].split(".")
@@ -119,6 +130,10 @@ def cacheDataSet(bqClient: Client, bqTable: Table, datasets: dict):
     return datasets[dsetKey]
 
 
+# vars shared by every template of the folder it is in
+GLOBAL_VARS = "global.vars"
+
+
 class TableType(Enum):
     VIEW = 1
     TABLE = 2
@@ -170,7 +185,10 @@ class BqQueryTemplatingFileLoader(FileLoader):
         self.bqJobs = bqJobs
         self.datasets = {}
         self.tableType = tableType
-        self.cachedFileLoads = {}
+        self.folderScopes = {}
+        # folder -> its TemplateScope, for the asOf they were resolved at
+        self.templateScopes = {}
+        self.templateScopesAsOf = None
         if not self.tableType or self.tableType not in TableType:
             raise Exception("TableType must be set")
 
@@ -178,34 +196,78 @@ class BqQueryTemplatingFileLoader(FileLoader):
                                  folder: str,
                                  filename: str,
                                  defaultVars: dict):
-        ret = []
+        return [dict(v) for v in
+                BqQueryTemplatingFileLoader.iterTemplateVarsArray(
+                    rawTemplates, folder, filename, defaultVars)]
+
+    def iterTemplateVarsArray(rawTemplates,
+                              folder: str,
+                              filename: str,
+                              defaultVars: dict):
+        """ lazily explodes and evaluates each of rawTemplates.  One
+        combination at a time is held in memory.
+
+        Each entry is layered over defaultVars, which may itself be a
+        ChainMap of layers or an already resolved TemplateScope, rather
+        than merged with it.  The layers are resolved once and shared by
+        every entry and combination
+        """
+        scope = defaultVars
+        if not isinstance(scope, TemplateScope):
+            scope = TemplateScope(isinstance(defaultVars, ChainMap) and
+                                  defaultVars.maps or [defaultVars])
         for t in rawTemplates:
-            copy = t.copy()
-            copy['folder'] = folder
-            copy['filename'] = filename
-            if 'dataset' not in copy:
-                copy['dataset'] = defaultVars['dataset']
-            if 'project' not in copy:
-                copy['project'] = defaultVars['project']
-            if 'table' not in copy:
-                copy['table'] = filename
-
-            for (k, v) in defaultVars.items():
-                if k not in copy:
-                    copy[k] = v
-
-            ret += [evalTmplRecurse(t) for t in explodeTemplate(copy)]
-
-        return ret
-
-    def cached_file_read(self, file):
-        if file in self.cachedFileLoads:
-            return self.cachedFileLoads[file]
-        else:
-            with open(file) as filestr:
-                filestr = filestr.read()
-            self.cachedFileLoads[file] = filestr
-            return filestr
+            entry = t.copy()
+            entry['folder'] = folder
+            entry['filename'] = filename
+            if 'table' not in entry:
+                entry['table'] = filename
+
+            yield from scope.iterEntry(entry)
+
+    def folderScope(self, folderPath: str, root: str = None) -> ChainMap:
+        """ :return: the vars of the global.vars file of folderPath, if
+        any, layered over those of each folder above it up to root, then
+        over our default vars.  Read once per folder
+
+        :param root: the folder the hierarchy starts at.  Only the
+        global.vars of folderPath is used if not set """
+        folderPath = os.path.normpath(folderPath)
+        if root is not None:
+            root = os.path.normpath(root)
+        if (root, folderPath) not in self.folderScopes:
+            folderVars = {}
+            globalVarsFile = os.path.join(folderPath, GLOBAL_VARS)
+            if os.path.isfile(globalVarsFile):
+                with open(globalVarsFile) as f:
+                    try:
+                        folderVars = json.load(f)
+                    except JSONDecodeError:
+                        raise Exception("Problem reading json vars from "
+                                        "file: ", globalVarsFile)
+                if not isinstance(folderVars, dict):
+                    raise Exception("Must be a json object in " +
+                                    globalVarsFile)
+            parent = ChainMap(self.defaultVars)
+            if root is not None and folderPath != root and \
+                    not os.path.relpath(folderPath, root).startswith(".."):
+                parent = self.folderScope(os.path.dirname(folderPath), root)
+            self.folderScopes[(root, folderPath)] = \
+                ChainMap(folderVars, *parent.maps)
+        return self.folderScopes[(root, folderPath)]
+
+    def templateScope(self, folderPath: str, root: str = None) \
+            -> TemplateScope:
+        """ :return: the folderScope of folderPath resolved once per folder
+        for the current asOf """
+        if self.templateScopesAsOf != tmplhelper.runTime():
+            self.templateScopes.clear()
+            self.templateScopesAsOf = tmplhelper.runTime()
+        key = (root, folderPath)
+        if key not in self.templateScopes:
+            self.templateScopes[key] = TemplateScope(
+                self.folderScope(folderPath, root).maps)
+        return self.templateScopes[key]
 
     def processTemplateVar(self, templateVars: dict, template: str,
                            filePath: str, mtime: int, out: dict):
@@ -223,20 +285,17 @@ class BqQueryTemplatingFileLoader(FileLoader):
         Datasets are ok.
         :return: void
         """
-        templateVarsCopy = templateVars.copy()
-        helpers.format_all_date_keys(templateVarsCopy)
-
         if 'dataset' not in templateVars:
             raise Exception("Missing dataset in template vars for " +
                             filePath + ".vars")
         dataset = templateVars['dataset']
         needed = tmplhelper.keysOfTemplate(template)
-        if not needed.issubset(templateVars.keys()):
-            missing = str(needed - templateVars.keys())
+        if not all([k in templateVars for k in needed]):
+            missing = str(set([k for k in needed if k not in templateVars]))
             raise Exception("Please define values for " +
                             missing + " in a file: ",
                             filePath + ".vars")
-        query = template.format(**templateVars)
+        query = tmplhelper.compileTemplate(template).render(templateVars)
         # print("formatting query: ", query)
         table = templateVars['table']
         project = None
@@ -258,12 +317,16 @@ class BqQueryTemplatingFileLoader(FileLoader):
             except Exception:
                 expiration = None
 
+        # raw or normalized - see BqQueryBasedResource
+        queryHash = templateVars.get('query_hash', 'raw')
+
         if self.tableType == TableType.TABLE:
             jT = self.bqJobs.getJobForTable(bqTable)
             arsrc = BqQueryBackedTableResource([query], bqTable,
                                                self.bqClient,
                                                queryJob=jT,
-                                               expiration=expiration)
+                                               expiration=expiration,
+                                               queryHash=queryHash)
             out[key] = arsrc
             # check if there is extraction logic
             # todo: we need to populate the extraction job
@@ -280,7 +343,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 out[extractRsrc.key()] = extractRsrc
         elif self.tableType == TableType.VIEW:
             arsrc = BqViewBackedTableResource([query], bqTable,
-                                              self.bqClient)
+                                              self.bqClient,
+                                              queryHash=queryHash)
             out[key] = arsrc
 
         elif self.tableType == TableType.TABLE_GCS_LOAD:
@@ -291,15 +355,15 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 raise Exception("source_format not found in template vars")
 
             if templateVars["source_format"] not in set(["PARQUET", "ORC"]):
-                schemaFileStr = self.cached_file_read(filePath + ".schema")
-                schema = loadSchemaFromString(schemaFileStr.strip())
+                schema = schemas.load(filePath + ".schema")
                 templateVars["schema"] = schema
 
-            rsrc = BqGcsTableLoadResource(bqTable,
-                                          self.bqClient,
-                                          self.gcsClient,
-                                          jT, query, schema,
-                                          templateVars)
+            rsrc = BqGcsTableLoadResource(
+                bqTable, self.bqClient, self.gcsClient, jT, query, schema,
+                templateVars,
+                incremental=isTrue(templateVars.get('incremental', False)),
+                fullRefreshEvery=int(
+                    templateVars.get('full_refresh_every', 0)))
             out[key] = rsrc
         elif self.tableType == TableType.UNION_TABLE:
             if key in out:
@@ -310,7 +374,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 arsrc = BqQueryBackedTableResource([query], bqTable,
                                                    self.bqClient,
                                                    queryJob=jT,
-                                                   expiration=expiration)
+                                                   expiration=expiration,
+                                                   queryHash=queryHash)
                 out[key] = arsrc
 
         elif self.tableType == TableType.UNION_VIEW:
@@ -319,18 +384,18 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 arsrc.addQuery(query)
             else:
                 arsrc = BqViewBackedTableResource([query], bqTable,
-                                                  self.bqClient)
+                                                  self.bqClient,
+                                                  queryHash=queryHash)
                 out[key] = arsrc
 
         elif self.tableType == TableType.BASH_TABLE:
             jT = self.bqJobs.getJobForTable(bqTable)
-            stripped = self.cached_file_read(filePath + ".schema").strip()
-            schema = loadSchemaFromString(stripped)
-            # with open(filePath + ".schema") as schemaFile:
-            #     schema = loadSchemaFromString(schemaFile.read().strip())
-            arsrc = BqProcessTableResource(query, bqTable, schema,
-                                           self.bqClient,
-                                           job=jT)
+            schema = schemas.load(filePath + ".schema")
+            arsrc = BqProcessTableResource(
+                query, bqTable, schema, self.bqClient, job=jT,
+                streaming=isTrue(templateVars.get('streaming', False)),
+                gzip=isTrue(templateVars.get('gzip', False)),
+                sniffFormat=isTrue(templateVars.get('sniff', False)))
             out[key] = arsrc
         elif self.tableType == TableType.EXTERNAL_TABLE:
             from google.cloud.bigquery import ExternalConfig
@@ -342,9 +407,7 @@ class BqQueryTemplatingFileLoader(FileLoader):
             schema = None
             if not autodetect:
                 try:
-                    stripped = \
-                        self.cached_file_read(filePath + ".schema").strip()
-                    schema = loadSchemaFromString(stripped)
+                    schema = schemas.load(filePath + ".schema")
                 except Exception:
                     raise Exception("Please provide a .schema "
                                     "file for your external table. " +
@@ -366,7 +429,7 @@ class BqQueryTemplatingFileLoader(FileLoader):
             raise Exception("Templating generated duplicate "
                             "tables outputs for " + filePath)
 
-    def load(self, filePath):
+    def load(self, filePath, root: str = None):
         mtime = getmtime(filePath)
         ret = {}
         with open(filePath) as f:
@@ -375,10 +438,10 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 filename = filePath.split("/")[-1].split(".")[-2]
                 folder = filePath.split("/")[-2]
                 templateVars = \
-                    BqQueryTemplatingFileLoader.explodeTemplateVarsArray(
-                        self.loadTemplateVars(
+                    BqQueryTemplatingFileLoader.iterTemplateVarsArray(
+                        self.iterTemplateVars(
                             filePath + ".vars"), folder, filename,
-                        self.defaultVars)
+                        self.templateScope(os.path.dirname(filePath), root))
 
             except FileNotFoundError:
                 raise Exception("Please define template vars in a file "
@@ -389,34 +452,75 @@ class BqQueryTemplatingFileLoader(FileLoader):
         return ret.values()
 
     def loadTemplateVars(self, filePath) -> list:
+        return list(self.iterTemplateVars(filePath))
+
+    def iterTemplateVars(self, filePath):
+        """ yields the entries of the .vars file filePath.  It is either
+        a json list of objects or json lines, one object per line.  Json
+        lines are read one entry at a time so they may be arbitrarily
+        large """
         try:
             with open(filePath) as f:
-                templateVarsList = json.loads(f.read())
-                if not isinstance(templateVarsList, list):
-                    raise Exception(
-                        "Must be json list of objects in " + filePath)
-                for definition in templateVarsList:
-                    if not isinstance(definition, dict):
-                        raise Exception(
-                            "Must be json list of objects in " + filePath)
-                return templateVarsList
+                first = f.read(1)
+                while first.isspace():
+                    first = f.read(1)
+                f.seek(0)
+                if first == "{":
+                    yield from self.iterJsonLines(f, filePath)
+                    return
+                try:
+                    templateVarsList = json.loads(f.read())
+                except JSONDecodeError:
+                    raise Exception("Problem reading json var list from "
+                                    "file: ", filePath)
         except FileNotFoundError:
-            return [{}]
-        except JSONDecodeError:
-            raise Exception("Problem reading json var list from file: ",
-                            filePath)
+            yield {}
+            return
+
+        if not isinstance(templateVarsList, list):
+            raise Exception(
+                "Must be json list of objects in " + filePath)
+        for definition in templateVarsList:
+            if not isinstance(definition, dict):
+                raise Exception(
+                    "Must be json list of objects in " + filePath)
+        yield from templateVarsList
+
+    def iterJsonLines(self, f, filePath):
+        for (lineNo, line) in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                definition = json.loads(line)
+            except JSONDecodeError:
+                raise Exception("Problem reading json vars from line " +
+                                str(lineNo) + " of file: ", filePath)
+            if not isinstance(definition, dict):
+                raise Exception("Must be json object on line " +
+                                str(lineNo) + " of " + filePath)
+            yield definition
 
 
 class BqDataFileLoader(FileLoader):
     def __init__(self, bqClient: Client, defaultDataset=None,
-                 defaultProject=None, bqJobs=None):
+                 defaultProject=None, bqJobs=None, gzip=False,
+                 chunkBytes=0, sniffFormat=False):
+        """
+        :param gzip: compress files as they are uploaded
+        :param chunkBytes: split files larger than this into chunks
+        uploaded in parallel.  Not split if 0
+        :param sniffFormat: sniff the delimiter and header of files
+        """
         self.bqClient = bqClient
         self.defaultDataset = defaultDataset
         self.defaultProject = defaultProject
         self.datasets = {}
         self.bqJobs = bqJobs
+        self.gzip = gzip
+        self.chunkBytes = chunkBytes
+        self.sniffFormat = sniffFormat
 
-    def load(self, filePath):
+    def load(self, filePath, root: str = None):
         mtime = getmtime(filePath)
         schemaFilePath = filePath + ".schema"
         mtime_schema = getmtime(schemaFilePath)
@@ -424,14 +528,16 @@ class BqDataFileLoader(FileLoader):
         bqTable = parseDatasetTable(filePath, self.defaultDataset,
                                     self.bqClient, self.defaultProject)
 
-        with open(schemaFilePath) as schemaFile:
-            schema = loadSchemaFromString(schemaFile.read().strip())
+        schema = schemas.load(schemaFilePath)
 
         jT = self.bqJobs.getJobForTable(bqTable)
 
         ret = []
         ret.append(BqDataLoadTableResource(filePath, bqTable, schema,
-                                           self.bqClient, jT))
+                                           self.bqClient, jT,
+                                           gzip=self.gzip,
+                                           chunkBytes=self.chunkBytes,
+                                           sniffFormat=self.sniffFormat))
         ret.append(cacheDataSet(self.bqClient, bqTable,
                                 self.datasets))
         return ret
@@ -484,3 +590,30 @@ def loadSchemaField(jsonField: dict):
                        mode=mode,
                        description=description,
                        fields=fields)
+
+
+class SchemaCache:
+    """
+    Parsed .schema files shared by every loader and resource of the
+    process.  Schemas are keyed by the hash of their file's content, which
+    costs a stat per file once hashed, so a schema shared by many
+    templates or combinations is parsed once.  The parsed schemas are
+    tuples so they may be shared safely
+    """
+
+    def __init__(self):
+        self.parsed = {}
+        self.lock = threading.Lock()
+
+    def load(self, schemaFilePath: str) -> tuple:
+        digest = fileHashes.digest(schemaFilePath)
+        with self.lock:
+            if digest in self.parsed:
+                return self.parsed[digest]
+        with open(schemaFilePath) as schemaFile:
+            schema = tuple(loadSchemaFromString(schemaFile.read().strip()))
+        with self.lock:
+            return self.parsed.setdefault(digest, schema)
+
+
+schemas = SchemaCache()
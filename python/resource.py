@@ -1,9 +1,14 @@
+import bisect
 import hashlib
 import json
 import logging
+import os
 import re
 import subprocess
+import threading
 import uuid
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from json.decoder import JSONDecodeError
 
@@ -18,6 +23,10 @@ from google.cloud.bigquery.job import WriteDisposition, \
 from google.cloud.bigquery.table import Table, TableReference
 from google.cloud.exceptions import NotFound
 
+from filehash import ALGORITHMS, fileHashes, hashFile
+from sniffer import SAMPLE_BYTES, FormatError, firstLineFormat, sniff, \
+    sniffFile
+
 # max length of description allowed by biquery
 # https://cloud.google.com/bigquery/quotas - found this by updating
 # a single table description.
@@ -47,6 +56,46 @@ class Resource:
     def dump(self):
         return ""
 
+    def stampMetadata(self, inputs: str = None):
+        """ Post run hook.  Called once the job behind this resource
+        has completed so state needed by later runs can be recorded.
+        Probing methods i.e. exists, updateTime and shouldUpdate must
+        never write
+
+        :param inputs: fingerprint of the inputs this resource was
+        built from or None if unknown
+        """
+        pass
+
+    def fingerprint(self) -> str:
+        """ Identifies the data currently held by this resource.
+        Dependants rerun when the fingerprints of their inputs change """
+        return str(self.updateTime())
+
+    def recordedInputs(self):
+        """ :return: the inputs fingerprint recorded when this resource
+        was last built.  None if nothing was recorded """
+        return None
+
+    def plan(self):
+        """ :return: how this resource would be built, for --plan.  None
+        if there's nothing to say beyond executing it """
+        return None
+
+    def gcsReads(self) -> tuple:
+        """ :return: the gcs uri patterns this resource reads.  Edges to
+        the resources writing them are found through a UriIndex rather
+        than dependsOn """
+        return ()
+
+    def gcsWrites(self) -> tuple:
+        """ :return: the gcs uri patterns this resource writes """
+        return ()
+
+    def invalidate(self):
+        """ Drop anything cached while probing this resource """
+        pass
+
     def __eq__(self, other):
         raise Exception("Must implement __eq__")
 
@@ -202,14 +251,17 @@ class BqDatasetBackedResource(Resource):
     def shouldUpdate(self):
         return False
 
+    def fingerprint(self):
+        # tables being added to a dataset does not change their data
+        return "dataset:" + self.key()
+
     def __str__(self):
         return ":".join([self.dataset.project, self.dataset.dataset_id])
 
     def __eq__(self, other):
         try:
             return self.key() == other.key() and \
-                   self.dataset.project == other.dataset.project and \
-                   self.dataset.name == other.dataset.name
+                   self.dataset.project == other.dataset.project
         except Exception:
             return False
 
@@ -221,26 +273,85 @@ def makeJobName(parts: list):
 # base resource class for all table back resources
 class BqTableBasedResource(Resource):
     """ Base class of query based big query actions """
+    # the last table fetched from bigquery.  Shared by exists and
+    # updateTime so probing a resource costs a single get_table
+    cachedTable = None
+    # true for resources whose description is only ever written when
+    # they are (re)built and so identifies the data held
+    stampsDescription = False
+
     def __init__(self, table: Table, bqClient: Client):
         self.table = table
         self.bqClient = bqClient
 
+    def fetchTable(self):
+        """ :return: the bigquery table, None if it does not exist """
+        if self.cachedTable is None:
+            try:
+                self.cachedTable = self.bqClient.get_table(self.table)
+            except NotFound:
+                return None
+            self.table = self.cachedTable
+        return self.cachedTable
+
+    def invalidate(self):
+        self.cachedTable = None
+
     def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        return self.fetchTable() is not None
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.modified
+        table = self.fetchTable()
+        if table is None:
+            raise NotFound(self.key())
 
+        createdTime = table.modified
         if createdTime:
             return int(createdTime.strftime("%s")) * 1000
         return None
 
+    def description(self):
+        table = self.fetchTable()
+        if table is None or not table.description:
+            return ""
+        return table.description
+
+    def writeDescription(self, description: str, expiration: int = None):
+        """ writes description onto the table when it has not been
+        written since the table was last (re)built i.e. it is empty
+
+        :param expiration: days from now the table expires in, set
+        along with the description if the table has no expiration """
+        table = self.fetchTable()
+        if table is None or table.description:
+            return
+        table.description = description
+        fields = ["description"]
+        if expiration is not None and table.expires is None:
+            table.expires = datetime.now() + timedelta(days=expiration)
+            fields.append("expires")
+        self.table = self.bqClient.update_table(table, fields)
+        self.invalidate()
+
+    def fingerprint(self):
+        description = self.description()
+        if self.stampsDescription and description:
+            return hashlib.md5(description.encode("utf-8")).hexdigest()
+
+        # only data stats as metadata only updates e.g. expiration or
+        # description writes move the modified time
+        table = self.fetchTable()
+        if table is None:
+            raise NotFound(self.key())
+        stats = [table.num_rows, table.num_bytes,
+                 parseDescriptionTag(description, "jobid")]
+        return hashlib.md5(":".join([str(x) for x in stats])
+                           .encode("utf-8")).hexdigest()
+
+    def recordedInputs(self):
+        return parseDescriptionTag(self.description(), "inputs")
+
     def create(self):
         raise Exception("implement")
 
@@ -259,39 +370,168 @@ class BqTableBasedResource(Resource):
                          self.table.table_id, "${query}"])
 
 
-def generate_file_md5(filename, blocksize=2**20):
-    m = hashlib.md5()
-    with open(filename, "rb") as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
+class WorkerPool:
+    """ A bounded pool of local workers.  Work such as bash templates
+    and uploads runs in the background so it overlaps with other work
+    and with big query jobs """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def resize(self, workers: int):
+        """ only takes effect before the first script is submitted """
+        self.workers = workers
+
+    def submit(self, fn, *args) -> Future:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers)
+        return self.executor.submit(fn, *args)
+
+
+# shared by every bash template.  Sized from the --bashWorkers option
+bashPool = WorkerPool()
+# shared by every localdata upload.  Sized from the --uploadWorkers option
+uploadPool = WorkerPool()
+
+
+class ScriptOutputStream:
+    """
+    The stdout of a running script as a binary stream for uploading.
+    Reads return exactly as many bytes as asked for until the output
+    ends, as chunked uploads expect.  If the script then exits non zero
+    the final read raises so the upload is never completed and no load
+    job is created from partial output
+    """
+
+    def __init__(self, process: subprocess.Popen, head: bytes = b""):
+        """
+        :param head: bytes already read from process.stdout
+        """
+        self.process = process
+        self.head = head
+        self.position = 0
+        self.hash = ALGORITHMS["blake2b"]()
+
+    def read(self, size=-1) -> bytes:
+        if 0 <= size < len(self.head):
+            # the rest of the head is kept for the next read
+            (ret, self.head) = (self.head[:size], self.head[size:])
+            self.hash.update(ret)
+            self.position += len(ret)
+            return ret
+        chunks = [self.head]
+        length = len(self.head)
+        self.head = b""
+        while size < 0 or length < size:
+            chunk = self.process.stdout.read(
+                size < 0 and -1 or size - length)
+            if not chunk:
+                if self.process.wait() != 0:
+                    raise ScriptFailed(self.process.args,
+                                       self.process.returncode)
                 break
-            m.update(buf)
-    return m.hexdigest()
+            chunks.append(chunk)
+            length += len(chunk)
+        ret = b"".join(chunks)
+        self.hash.update(ret)
+        self.position += len(ret)
+        return ret
+
+    def digest(self) -> str:
+        """ of the output read so far """
+        return self.hash.hexdigest()
+
+    def tell(self) -> int:
+        return self.position
+
+
+class GzipStream:
+    """ gzips a binary stream as it is read """
+
+    def __init__(self, source):
+        self.source = source
+        self.compressor = zlib.compressobj(wbits=31)
+        self.buffer = b""
+        self.position = 0
+        self.finished = False
+
+    def read(self, size=-1) -> bytes:
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            data = self.source.read(COMPRESS_BLOCK_SIZE)
+            self.buffer += self.compressor.compress(data)
+            if len(data) < COMPRESS_BLOCK_SIZE:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+        if size < 0:
+            size = len(self.buffer)
+        ret = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.position += len(ret)
+        return ret
+
+    def tell(self) -> int:
+        return self.position
+
+
+class ResourceFailed(Exception):
+    """ raised by create when a resource can't be built, e.g. its data
+    is malformed.  Only it and what depends on it fail, the rest of the
+    run carries on """
+    pass
+
+
+class ScriptFailed(Exception):
+    def __init__(self, script, returncode):
+        super(ScriptFailed, self).__init__(
+            "{} exited with status {}".format(script, returncode))
+
+
+# bytes of script output compressed at a time
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# bytes of streamed script output read before its upload starts.  Set
+# from the --bashStreamChunkSize option
+streamChunkBytes = 100 * 1024 * 1024
 
 
 class BqProcessTableResource(BqTableBasedResource):
-    """ todo: currently we block during the creation of this
-    table but we should probably treat this just like any table
-    create and put it in the background
-    """
+    """ Runs a bash script and loads its output into the table.  The
+    script and the submission of the load run on bashPool so create
+    returns immediately.  The resource is running from then until the
+    load job completes """
+    stampsDescription = True
+
     def __init__(self, query: str, table: Table,
                  schema: tuple, bqClient: Client,
-                 job: _AsyncJob):
-        """ """
+                 job: _AsyncJob, streaming=False, gzip=False,
+                 sniffFormat=False):
+        """
+        :param streaming: upload the output of the script as it is
+        written rather than from a file once it's done
+        :param gzip: compress the output when streaming it
+        :param sniffFormat: sniff the delimiter and header of the
+        output.  Otherwise it is json or tab delimited without a header
+        """
         super(BqProcessTableResource, self).__init__(table, bqClient)
         self.query = query
         self.table = table
         self.bqClient = bqClient
         self.schema = schema
         self.job = job
-
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        self.streaming = streaming
+        self.gzip = gzip
+        self.sniffFormat = sniffFormat
+        self.filtered = None
+        # the script and load submission running on bashPool
+        self.pending = None
+        self.scriptFailed = False
+        # digests of the output loaded last time and of this run's
+        self.previousOutput = None
+        self.outputHash = None
 
     def dependsOn(self, other: Resource):
         return self.legacyBqQueryDependsOn(other)
@@ -300,7 +540,9 @@ class BqProcessTableResource(BqTableBasedResource):
         if self == other:
             return False
 
-        filtered = getFiltered(self.query)
+        if self.filtered is None:
+            self.filtered = getFiltered(self.query)
+        filtered = self.filtered
         if strictSubstring("".join(["", other.key(), " "]), filtered):
             return True
 
@@ -318,38 +560,38 @@ class BqProcessTableResource(BqTableBasedResource):
         m.update(self.query.encode("utf-8"))
         return m.hexdigest()
 
-        return "filehash:" + generate_file_md5(self.file) + ":" + schemahash
-
-    def updateTime(self):
-        """ time in milliseconds.  None if not created """
-        # self.table.reload() # reload was pre-sdk update
-        self.table = self.bqClient.get_table(self.table)
-
-        print("created time is ", str(self.table.modified))
-        createdTime = self.table.modified
-        hashtag = self.makeHashTag()
-
-        if createdTime:
-
-            print("description is ", self.table.description)
-            # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
-                self.table.description = "\n".join(["Do not edit", hashtag])
-                self.bqClient.update_table(self.table, ["description"])
-            return int(createdTime.strftime("%s")) * 1000
-        return None
+    def stampMetadata(self, inputs: str = None):
+        if not self.scriptFailed and jobSucceeded(self.job):
+            tags = makeDescriptionTags(self.job, inputs)
+            if self.outputHash:
+                tags.append("outputhash:" + self.outputHash)
+            self.writeDescription(
+                "\n".join(["Do not edit", self.makeHashTag()] + tags))
+
+    def fingerprint(self):
+        # the data only changes when the output of the script does
+        output = parseDescriptionTag(self.description(), "outputhash")
+        if output:
+            return "outputhash:" + output
+        return super(BqProcessTableResource, self).fingerprint()
+
+    def skipLoad(self):
+        """ the output is what was loaded last time """
+        print(self, "output unchanged, not reloading")
+        self.job = None
 
     def create(self):
         self.table.schema = self.schema
+        self.previousOutput = None
+        self.outputHash = None
 
         if self.exists():
+            self.previousOutput = parseDescriptionTag(self.description(),
+                                                      "outputhash")
             print("Table exists and we're wiping out the description")
             self.table.description = ""
             self.bqClient.update_table(self.table, ["description"])
 
-        # we exec
-        import os
-
         # pump the script into a file
         # script name
         script = "/tmp/" + _buildDataSetTableKey_(table=self.table)
@@ -358,6 +600,82 @@ class BqProcessTableResource(BqTableBasedResource):
 
         os.chmod(script, 0o744)
 
+        self.scriptFailed = False
+        self.pending = bashPool.submit(self.runScript, script)
+
+    def outputFormat(self, head: bytes, complete: bool) -> dict:
+        """ :param head: the first bytes of the output.  Raises
+        FormatError if the output can't be loaded """
+        if self.sniffFormat:
+            return sniff(head, complete, schemaColumns(self.schema))
+        return firstLineFormat(head, "\t")
+
+    def loadJobConfig(self, format: dict) -> bigquery.LoadJobConfig:
+        """ :param format: as decided from the output """
+        return bigquery.LoadJobConfig(
+            source_format=format["source_format"],
+            field_delimiter=format["field_delimiter"],
+            skip_leading_rows=format["skip_leading_rows"],
+            ignore_unknown_values=True,
+            write_disposition=WriteDisposition.WRITE_TRUNCATE,
+            schema=self.schema)
+
+    def streamScript(self, script: str):
+        """ runs on bashPool.  Uploads the output of script as it runs
+        through a resumable upload.  Nothing touches the local disk """
+        with open(script + ".data.error", 'w') as errors:
+            try:
+                fHandle = subprocess.Popen(script, stdout=subprocess.PIPE,
+                                           stderr=errors)
+            except OSError as ose:
+                logging.error(ose)
+                self.scriptFailed = True
+                return None
+
+            with fHandle:
+                head = fHandle.stdout.read(max(streamChunkBytes,
+                                               SAMPLE_BYTES))
+                try:
+                    format = self.outputFormat(head[:SAMPLE_BYTES],
+                                               len(head) < SAMPLE_BYTES)
+                except FormatError as e:
+                    # retrying would only produce the same output
+                    fHandle.kill()
+                    raise ResourceFailed("not loading output: " + str(e))
+                # output within a single chunk is all read so can be
+                # compared with the last load before any is uploaded.
+                # Larger output is always uploaded
+                if len(head) < max(streamChunkBytes, SAMPLE_BYTES) and \
+                        fHandle.wait() == 0:
+                    h = ALGORITHMS["blake2b"]()
+                    h.update(head)
+                    digest = h.hexdigest()
+                    if digest == self.previousOutput:
+                        self.outputHash = digest
+                        self.skipLoad()
+                        return None
+                output = ScriptOutputStream(fHandle, head)
+                stream = output
+                if self.gzip:
+                    stream = GzipStream(output)
+                try:
+                    self.job = self.bqClient.load_table_from_file(
+                        stream, self.table,
+                        job_config=self.loadJobConfig(format))
+                except ScriptFailed as e:
+                    err = open(script + ".data.error").read()
+                    print(str(e) + " error:" + err)
+                    self.scriptFailed = True
+                    return None
+                self.outputHash = output.digest()
+        return self.job
+
+    def runScript(self, script: str):
+        """ runs on bashPool.  Runs script and submits the load of its
+        output """
+        if self.streaming:
+            return self.streamScript(script)
+
         datascript = script + ".data"
         with open(datascript, 'wb') as writable:
             with open(datascript + ".error", 'w') as errors:
@@ -366,6 +684,7 @@ class BqProcessTableResource(BqTableBasedResource):
                                                stderr=errors)
                 except OSError as ose:
                     logging.error(ose)
+                    self.scriptFailed = True
                     return None
 
                 fHandle.wait()
@@ -374,45 +693,59 @@ class BqProcessTableResource(BqTableBasedResource):
             err = open(datascript + ".error").read()
             print("exit status != 0, got " + str(fHandle.returncode)
                   + "error:" + err)
+            self.scriptFailed = True
             return None
 
-        # todo - allow caller to specify file delimiter
-        fieldDelimiter = '\t'
-        with open(datascript, 'r') as readable:
-            srcFormat = BqDataLoadTableResource.detectSourceFormat(
-                                                readable.readline())
-            if srcFormat != SourceFormat.CSV:
-                fieldDelimiter = None
-
-        job_config = bigquery.LoadJobConfig(
-            source_format=srcFormat,
-            field_delimiter=fieldDelimiter, ignore_unknown_values=True,
-            write_disposition=WriteDisposition.WRITE_TRUNCATE,
-            schema=self.schema)
+        self.outputHash = hashFile(datascript)
+        if self.outputHash == self.previousOutput:
+            self.skipLoad()
+            return None
+
+        try:
+            if self.sniffFormat:
+                format = sniffFile(datascript, schemaColumns(self.schema),
+                                   cache=False)
+            else:
+                with open(datascript, "rb") as readable:
+                    format = self.outputFormat(readable.readline(), False)
+            job_config = self.loadJobConfig(format)
+        except FormatError as e:
+            raise ResourceFailed("not loading output: " + str(e))
 
         with open(datascript, "rb") as source_file:
             self.job \
                 = self.bqClient.load_table_from_file(source_file,
                                                      self.table,
                                                      job_config=job_config)
+        return self.job
 
     def key(self):
         return ".".join([self.table.dataset_id, self.table.table_id])
 
     def isRunning(self):
+        """ raises ResourceFailed if the output of the script can't be
+        loaded """
+        if self.pending is not None:
+            if not self.pending.done():
+                print(self, "script running")
+                return True
+            (pending, self.pending) = (self.pending, None)
+            try:
+                pending.result()
+            except ResourceFailed:
+                self.scriptFailed = True
+                raise
+            except Exception as e:
+                logging.error("bash template %s failed: %s", self, e)
+                self.scriptFailed = True
+        if self.scriptFailed:
+            return False
         return isJobRunning(self.job)
 
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
                                         self.table.table_id])
 
-    def detectSourceFormat(firstFileLine: str):
-        try:
-            json.loads(firstFileLine)
-            return SourceFormat.NEWLINE_DELIMITED_JSON
-        except JSONDecodeError:
-            return SourceFormat.CSV
-
     def __eq__(self, other):
         try:
             return self.query == other.query and self.key() == other.key()
@@ -420,86 +753,213 @@ class BqProcessTableResource(BqTableBasedResource):
             return False
 
     def shouldUpdate(self):
-        self.updateTime()
-        if not self.makeHashTag() in self.table.description:
-            return True
-        return False
+        return self.makeHashTag() not in self.description()
 
     def dump(self):
         return self.query
 
 
+class FileSegment:
+    """ the bytes of a file from start up to end as a binary stream """
+
+    def __init__(self, path: str, start: int, end: int):
+        self.f = open(path, "rb")
+        self.f.seek(start)
+        self.remaining = end - start
+        self.position = 0
+
+    def read(self, size=-1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        ret = self.f.read(size)
+        self.remaining -= len(ret)
+        self.position += len(ret)
+        return ret
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        self.f.close()
+
+
+def lineAlignedRanges(path: str, chunkBytes: int) -> list:
+    """ :return: (start, end) byte offsets splitting the file at path
+    into chunks of about chunkBytes each ending at the end of a line.
+    A single chunk if chunkBytes isn't positive """
+    size = os.path.getsize(path)
+    if chunkBytes <= 0 or size <= chunkBytes:
+        return [(0, size)]
+
+    ranges = []
+    start = 0
+    with open(path, "rb") as f:
+        while start < size:
+            end = start + chunkBytes
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+# how long a staging table is kept if a run dies before dropping it
+STAGING_EXPIRATION = timedelta(days=1)
+
+
+def stagingTable(table: Table, schema) -> Table:
+    """ :return: a uniquely named table beside table to load into before
+    copying it over table.  It expires so it doesn't outlive a run which
+    dies before dropping it """
+    staging = Table(".".join(
+        [table.project, table.dataset_id,
+         table.table_id + "_bqm2staging_" + uuid.uuid4().hex[:8]]),
+        schema=schema)
+    staging.expires = datetime.now() + STAGING_EXPIRATION
+    return staging
+
+
 class BqDataLoadTableResource(BqTableBasedResource):
     """
         script for loading local data
+
+        Files larger than chunkBytes are split on line boundaries and
+        the chunks uploaded in parallel on uploadPool into a staging
+        table.  That is then copied over the table in one job so the
+        table is replaced atomically.
     """
+    stampsDescription = True
+
     def __init__(self, file: str, table: Table,
                  schema: tuple, bqClient: Client,
-                 job: _AsyncJob):
-        """ """
+                 job: _AsyncJob, gzip=False, chunkBytes=0,
+                 sniffFormat=False):
+        """
+        :param gzip: compress the file as it is uploaded
+        :param chunkBytes: the size of the chunks to split files into.
+        Not split if 0
+        :param sniffFormat: sniff the delimiter and header of the file.
+        Otherwise delimited files have a header row
+        """
         super(BqDataLoadTableResource, self).__init__(table, bqClient)
         self.file = file
         self.table = table
         self.bqClient = bqClient
         self.schema = schema
         self.job = job
-
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
+        self.gzip = gzip
+        self.chunkBytes = chunkBytes
+        self.sniffFormat = sniffFormat
+        # uploads in progress and then the load jobs of each chunk
+        self.uploads = []
+        self.loadJobs = []
+        self.staging = None
+        self.uploadFailed = False
 
     def makeHashTag(self):
-        schemahash = generate_file_md5(self.file + ".schema")
-        return "filehash:" + generate_file_md5(self.file) + ":" + schemahash
-
-    def updateTime(self):
-        """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.modified
-
-        hashtag = self.makeHashTag()
-
-        if createdTime:
-            # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
-                self.table.description = "\n".join(["Do not edit", hashtag])
-                self.bqClient.update_table(self.table, ["description"])
-            return int(createdTime.strftime("%s")) * 1000
-        return None
+        schemahash = fileHashes.digest(self.file + ".schema")
+        return "filehash-b2:" + fileHashes.digest(self.file) + ":" + \
+            schemahash
+
+    def makeLegacyHashTag(self):
+        """ md5 based tag written before blake2 hashing was used """
+        schemahash = fileHashes.digest(self.file + ".schema", "md5")
+        return "filehash:" + fileHashes.digest(self.file, "md5") + ":" + \
+            schemahash
+
+    def stampMetadata(self, inputs: str = None):
+        if not self.uploadFailed and jobSucceeded(self.job):
+            self.writeDescription(
+                "\n".join(["Do not edit", self.makeHashTag()] +
+                          makeDescriptionTags(self.job, inputs)))
+
+    def loadJobConfig(self, format: dict, first: bool, writeDisposition):
+        """ :param format: as decided from the file
+        :param first: the config is for the chunk starting the file """
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = format["source_format"]
+        job_config.schema = self.table.schema
+        if format["source_format"] == SourceFormat.CSV:
+            if format["field_delimiter"] is not None:
+                job_config.field_delimiter = format["field_delimiter"]
+            if first:
+                job_config.skip_leading_rows = format["skip_leading_rows"]
+        job_config.autodetect = True
+        job_config.write_disposition = writeDisposition
+        return job_config
+
+    def format(self) -> dict:
+        """ :return: the format of the file.  Raises FormatError if it
+        can't be loaded """
+        if self.sniffFormat:
+            return sniffFile(self.file, schemaColumns(self.schema))
+        with open(self.file, "rb") as readable:
+            return firstLineFormat(readable.readline(), None, 1)
+
+    def plan(self):
+        format = self.format()
+        if format["source_format"] != SourceFormat.CSV:
+            return "load " + self.file + " as " + format["source_format"]
+        delimiter = "detected by big query"
+        if format["field_delimiter"] is not None:
+            delimiter = repr(format["field_delimiter"])
+        return "load {} as CSV delimited by {} skipping {} header " \
+               "rows".format(self.file, delimiter,
+                             format["skip_leading_rows"])
 
     def create(self):
+        try:
+            format = self.format()
+        except FormatError as e:
+            raise ResourceFailed(str(e))
+
         self.table.schema = self.schema
 
         if self.exists():
             self.table.description = ""
             self.bqClient.update_table(self.table, ["description"])
 
-        fieldDelimiter = '\t'
-        with open(self.file, 'r') as readable:
-            srcFormat = BqDataLoadTableResource.detectSourceFormat(
-                                                readable.readline())
-
-            if srcFormat != SourceFormat.CSV:
-                fieldDelimiter = None
-
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = srcFormat
-        job_config.schema = self.table.schema
-        if srcFormat == SourceFormat.CSV:
-            job_config.skip_leading_rows = 1
-        job_config.autodetect = True
-        job_config.write_disposition = WriteDisposition.WRITE_TRUNCATE
-
-        with open(self.file, 'rb') as readable:
-            job = self.bqClient.load_table_from_file(
-                readable,
-                self.table,
-                job_config=job_config
-                )
-        self.job = job
+        ranges = lineAlignedRanges(self.file, self.chunkBytes)
+        self.uploadFailed = False
+        self.loadJobs = []
+        destination = self.table
+        writeDisposition = WriteDisposition.WRITE_TRUNCATE
+        if len(ranges) > 1:
+            self.staging = stagingTable(self.table, self.schema)
+            # created up front, rather than by the first load, to expire
+            self.bqClient.create_table(self.staging)
+            destination = self.staging
+            writeDisposition = WriteDisposition.WRITE_APPEND
+
+        self.uploads = [
+            uploadPool.submit(self.upload, destination, start, end,
+                              self.loadJobConfig(format, i == 0,
+                                                 writeDisposition))
+            for (i, (start, end)) in enumerate(ranges)]
+
+    def upload(self, destination: Table, start: int, end: int,
+               job_config: bigquery.LoadJobConfig):
+        """ runs on uploadPool.  Uploads the chunk from start to end and
+        returns its load job """
+        segment = FileSegment(self.file, start, end)
+        try:
+            if self.gzip:
+                return self.bqClient.load_table_from_file(
+                    GzipStream(segment), destination,
+                    job_config=job_config)
+            return self.bqClient.load_table_from_file(
+                segment, destination, size=end - start,
+                job_config=job_config)
+        finally:
+            segment.close()
+
+    def dropStaging(self):
+        if self.staging is not None:
+            self.bqClient.delete_table(self.staging, not_found_ok=True)
+            self.staging = None
 
     def key(self):
         return ".".join([self.table.dataset_id, self.table.table_id])
@@ -508,13 +968,51 @@ class BqDataLoadTableResource(BqTableBasedResource):
         return self.table.dataset_id == resource.key()
 
     def isRunning(self):
-        return isJobRunning(self.job)
+        """ uploading, then loading each chunk, then for chunked files
+        copying the staging table over the table """
+        if len(self.uploads):
+            if not all([f.done() for f in self.uploads]):
+                print(self, "uploading")
+                return True
+            try:
+                jobs = [f.result() for f in self.uploads]
+            except Exception as e:
+                logging.error("upload of %s failed: %s", self, e)
+                jobs = []
+                self.uploadFailed = True
+            self.uploads = []
+            if self.staging is None:
+                self.job = len(jobs) and jobs[0] or None
+            else:
+                self.loadJobs = jobs
+
+        if len(self.loadJobs):
+            if any([isJobRunning(j) for j in self.loadJobs]):
+                return True
+            if all([jobSucceeded(j) for j in self.loadJobs]):
+                self.job = self.bqClient.copy_table(
+                    self.staging, self.table,
+                    job_config=bigquery.CopyJobConfig(
+                        write_disposition=WriteDisposition.WRITE_TRUNCATE))
+            else:
+                logging.error("loading a chunk of %s failed", self)
+                self.uploadFailed = True
+            self.loadJobs = []
+
+        if self.uploadFailed:
+            self.dropStaging()
+            return False
+        running = isJobRunning(self.job)
+        if not running:
+            self.dropStaging()
+        return running
 
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
                                         self.table.table_id])
 
     def detectSourceFormat(firstFileLine: str):
+        """ a guess from the first line alone.  Loads use sniffer """
         try:
             json.loads(firstFileLine)
             return SourceFormat.NEWLINE_DELIMITED_JSON
@@ -528,10 +1026,12 @@ class BqDataLoadTableResource(BqTableBasedResource):
             return False
 
     def shouldUpdate(self):
-        self.updateTime()
-        if not self.makeHashTag() in self.table.description:
-            return True
-        return False
+        description = self.description()
+        if self.makeHashTag() in description:
+            return False
+        if "filehash:" in description:
+            return self.makeLegacyHashTag() not in description
+        return True
 
 
 def processLoadTableOptions(options: dict):
@@ -612,7 +1112,42 @@ def processLoadTableOptions(options: dict):
     return job_config
 
 
+# bigquery's limits on the source uris of a single load job
+MAX_LOAD_URIS = 10000
+MAX_LOAD_BYTES = 15 * 1024 ** 4
+
+
+def batchSources(sources: list, maxUris: int, maxBytes: int) -> list:
+    """ packs (uri, bytes) sources, in order, into batches of at most
+    maxUris uris and maxBytes bytes.  A source larger than maxBytes is
+    given a batch of its own
+
+    :return: list of lists of uris
+    """
+    batches = []
+    batch = []
+    size = 0
+    for (uri, n) in sources:
+        if len(batch) and (len(batch) >= maxUris or size + n > maxBytes):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(uri)
+        size += n
+    if len(batch):
+        batches.append(batch)
+    return batches
+
+
 class BqGcsTableLoadResource(BqTableBasedResource):
+    """
+    Loads gcs objects into a table.  Uris beyond the limits of a single
+    load job are loaded in batches, concurrently, into a staging table
+    which is then copied into the table in one job
+    """
+    # the description is rewritten with the job of each load
+    stampsDescription = True
+
     # LoadTableFromStorageJob
     def __init__(self, table: Table,
                  bqClient: Client,
@@ -620,15 +1155,32 @@ class BqGcsTableLoadResource(BqTableBasedResource):
                  job: LoadJob,
                  query: str,
                  schema: tuple,
-                 options: dict):
+                 options: dict,
+                 incremental: bool = False,
+                 fullRefreshEvery: int = 0):
+        """
+        :param incremental: only append the objects not already loaded
+        according to the ledger at ledgerUri
+        :param fullRefreshEvery: when incremental, reload everything
+        after this many appends.  0 for never
+        """
         super(BqGcsTableLoadResource, self).__init__(table, bqClient)
         self.job = job
+        self.incremental = incremental
+        self.fullRefreshEvery = fullRefreshEvery
+        # (objects, uris, refresh reason) of the load in flight
+        self.loading = None
+        # the load jobs of each batch and the table they load into
+        self.loadJobs = []
+        self.staging = None
+        self.writeDisposition = None
         self.gcsClient = gcsClient
         self.query = query
         self.schema = schema
         self.options = options
         self.uris = tuple([uri for uri in self.query.split("\n") if
                           uri.startswith("gs://")])
+        self.filtered = None
         self.expiration = None
         self.require_exists = None
 
@@ -643,11 +1195,157 @@ class BqGcsTableLoadResource(BqTableBasedResource):
                                 self.table.table_id)
 
     def isRunning(self):
-        return isJobRunning(self.job)
+        """ loading each batch, then for several batches copying the
+        staging table into the table """
+        if len(self.loadJobs):
+            if any([isJobRunning(j) for j in self.loadJobs]):
+                return True
+            failed = [j for j in self.loadJobs if not jobSucceeded(j)]
+            if len(failed):
+                logging.error("loading a batch of %s failed", self)
+                # reported as the job of the resource
+                self.job = failed[0]
+            else:
+                self.job = self.bqClient.copy_table(
+                    self.staging, self.table,
+                    job_config=bigquery.CopyJobConfig(
+                        write_disposition=self.writeDisposition))
+            self.loadJobs = []
+
+        running = isJobRunning(self.job)
+        if not running and self.staging is not None:
+            self.dropStaging()
+        return running
+
+    def dropStaging(self):
+        self.bqClient.delete_table(self.staging, not_found_ok=True)
+        self.staging = None
 
     def dump(self):
         return str(self.uris)
 
+    def matching(self, uri: str) -> list:
+        """ :return: the blobs uri loads, including those in folders
+        under it which its wildcard spans but not the ledgers and markers
+        bqm2 keeps.  From the listing of its folder so uris sharing a
+        folder share a listing """
+        (bucket, head, tail, wildcard) = uriPattern(uri)
+        folder = head[:head.rfind("/") + 1]
+        return [blob for blob in
+                gcsListings.list(self.gcsClient, bucket, folder)
+                if (blob.name == head if not wildcard else
+                    len(blob.name) >= len(head) + len(tail) and
+                    blob.name.startswith(head) and
+                    blob.name.endswith(tail) and
+                    not isBookkeeping(blob.name))]
+
+    def listObjects(self) -> dict:
+        """ :return: generation:md5 of each object matched by the uris,
+        keyed by its uri """
+        objects = {}
+        for uri in self.uris:
+            (bucket, _) = parseBucketAndPrefix(uri)
+            for blob in self.matching(uri):
+                objects["gs://" + bucket + "/" + blob.name] = \
+                    "{}:{}".format(blob.generation, blob.md5_hash)
+        return objects
+
+    def sources(self, uris: list) -> list:
+        """ :return: (uri, bytes) of each of uris.  Wildcards matching
+        more than a load job can take are expanded into their objects.
+        Only wildcards are listed, a single object can't exceed the
+        limits.  Its size is taken from a listing covering it if the run
+        has one, e.g. of the incremental load which found it, else 0 """
+        ret = []
+        for uri in uris:
+            if "*" not in uri:
+                (bucket, path) = parseBucketAndBlobPath(uri)
+                blob = gcsListings.known(bucket, path)
+                ret.append((uri, blob is not None and blob.size or 0))
+                continue
+            blobs = self.matching(uri)
+            size = sum([blob.size or 0 for blob in blobs])
+            # bigquery would load our ledgers and markers too
+            if size > MAX_LOAD_BYTES or spansBookkeeping(uri):
+                (bucket, _) = parseBucketAndPrefix(uri)
+                ret.extend([("gs://" + bucket + "/" + blob.name,
+                             blob.size or 0) for blob in blobs])
+            else:
+                ret.append((uri, size))
+        return ret
+
+    def batches(self, uris: list) -> list:
+        return batchSources(self.sources(uris), MAX_LOAD_URIS,
+                            MAX_LOAD_BYTES)
+
+    def ledgerUri(self) -> str:
+        """ :return: where the ledger of the objects loaded is kept.  The
+        ledger_uri var, by default under LEDGER_PREFIX of the bucket of
+        the first uri """
+        if "ledger_uri" in self.options:
+            return self.options["ledger_uri"]
+        (bucket, _) = parseBucketAndBlobPath(self.uris[0])
+        return "gs://" + bucket + "/" + LEDGER_PREFIX + self.key() + ".json"
+
+    def refreshReason(self, entry: dict, objects: dict):
+        """ :return: why appending the new objects is not enough and
+        the table must be reloaded.  None if it is """
+        if gcsLedger.fullRefresh:
+            return "full refresh requested"
+        if entry is None:
+            return "no ledger"
+        table = self.fetchTable()
+        if table is None:
+            return "table does not exist"
+        if entry["uris"] != list(self.uris):
+            return "source uris changed"
+        if entry["rows"] != table.num_rows:
+            return "table changed outside of incremental loads"
+        changed = [uri for (uri, version) in entry["objects"].items()
+                   if objects.get(uri) != version]
+        if changed:
+            return "{} loaded objects changed or were removed".format(
+                len(changed))
+        if self.fullRefreshEvery and \
+                entry["appends"] >= self.fullRefreshEvery:
+            return "compacting after {} appends".format(entry["appends"])
+        return None
+
+    def pendingLoad(self) -> tuple:
+        """ :return: (objects, uris to load, refresh reason).  The
+        uris are every object when refreshing, otherwise the new ones """
+        objects = self.listObjects()
+        entry = gcsLedger.entry(self.gcsClient, self.ledgerUri())
+        reason = self.refreshReason(entry, objects)
+        if reason:
+            return (objects, sorted(objects), reason)
+        return (objects,
+                sorted([uri for uri in objects
+                        if uri not in entry["objects"]]),
+                None)
+
+    def shouldUpdate(self):
+        if not self.incremental:
+            return False
+        (_, uris, _) = self.pendingLoad()
+        return len(uris) > 0
+
+    def plan(self):
+        if not self.incremental:
+            uris = list(self.uris)
+            ret = "load {} uris".format(len(uris))
+        else:
+            (objects, uris, reason) = self.pendingLoad()
+            if reason:
+                ret = "reload {} objects: {}".format(len(uris), reason)
+            else:
+                ret = "append {} new of {} objects".format(len(uris),
+                                                           len(objects))
+        batches = len(uris) and len(self.batches(uris)) or 0
+        if batches > 1:
+            ret += " in {} batches through a staging table".format(batches)
+        return ret
+
     def create(self):
         if self.require_exists is not None and \
                 not gcsBlobExists(self.gcsClient, self.require_exists):
@@ -666,25 +1364,82 @@ class BqGcsTableLoadResource(BqTableBasedResource):
                 str(uuid.uuid4())
             ]
         )
-        self.job = self.bqClient.load_table_from_uri(
-            self.uris,
-            self.table,
-            jobid,
-            job_config=processLoadTableOptions(self.options)
-            )
+        jobConfig = processLoadTableOptions(self.options)
+        if not self.incremental:
+            uris = list(self.uris)
+        else:
+            self.loading = self.pendingLoad()
+            (objects, uris, reason) = self.loading
+            if not len(uris):
+                print(self, "no new objects to load")
+                self.job = None
+                self.loading = None
+                return
+
+            if reason:
+                print(self, "reloading", len(uris), "objects:", reason)
+                jobConfig.write_disposition = \
+                    WriteDisposition.WRITE_TRUNCATE
+            else:
+                print(self, "appending", len(uris), "new objects")
+                jobConfig.write_disposition = WriteDisposition.WRITE_APPEND
 
-    def exists(self):
-        try:
-            self.table = self.bqClient.get_table(self.table)
-            # update expiration if not set
-            if self.expiration is not None and self.table.expires is None:
-                self.table.expires = datetime.now() + timedelta(
-                    days=self.expiration)
-                self.bqClient.update_table(self.table, ['expires'])
+        batches = self.batches(uris)
+        if len(batches) == 1:
+            self.job = self.bqClient.load_table_from_uri(
+                batches[0], self.table, jobid, job_config=jobConfig)
+            return
 
-            return True
-        except NotFound:
-            return False
+        print(self, "loading", len(uris), "uris in", len(batches),
+              "batches")
+        self.writeDisposition = jobConfig.write_disposition
+        jobConfig.write_disposition = WriteDisposition.WRITE_APPEND
+        jobConfig.destination_table_description = None
+        self.staging = self.bqClient.create_table(
+            stagingTable(self.table, self.schema))
+        self.job = None
+        self.loadJobs = [
+            self.bqClient.load_table_from_uri(
+                batch, self.staging, jobid + "-" + str(i),
+                job_config=jobConfig)
+            for (i, batch) in enumerate(batches)]
+
+    def stampMetadata(self, inputs: str = None):
+        """ tags the table with the load job and its inputs and, for
+        incremental loads, records the objects loaded """
+        if self.job is None or not jobSucceeded(self.job):
+            return
+        table = self.fetchTable()
+        if table is None:
+            return
+        # rewritten on every load as appends keep the old description
+        # and copies of batched loads don't carry it
+        description = []
+        if "destination_table_description" in self.options:
+            description.append(self.options["destination_table_description"])
+        table.description = "\n".join(
+            description + makeDescriptionTags(self.job, inputs))
+        fields = ["description"]
+        if self.expiration is not None and table.expires is None:
+            table.expires = datetime.now() + timedelta(days=self.expiration)
+            fields.append("expires")
+        self.table = self.bqClient.update_table(table, fields)
+        self.invalidate()
+
+        if self.loading is None:
+            return
+        (objects, uris, reason) = self.loading
+        self.loading = None
+        entry = None if reason else \
+            gcsLedger.entry(self.gcsClient, self.ledgerUri())
+        loaded = dict(entry["objects"]) if entry else {}
+        loaded.update([(uri, objects[uri]) for uri in uris])
+        gcsLedger.record(self.gcsClient, self.ledgerUri(), {
+            "uris": list(self.uris),
+            "objects": loaded,
+            "appends": entry["appends"] + 1 if entry else 0,
+            "rows": table.num_rows
+        })
 
     def dependsOn(self, other: Resource):
         if self == other:
@@ -699,16 +1454,11 @@ class BqGcsTableLoadResource(BqTableBasedResource):
             if depends:
                 return True
 
-        if isinstance(other, BqExtractTableResource):
-            # TODO: this is pretty janky but works (mostly) for now
-            me = set([self.uris[i] for i in range(len(self.uris))])
-            them = set(other.uris.split(","))
-            return len(me.intersection(them)) > 0
-
+        # edges to extracts come from gcsReads
         return False
 
-    def shouldUpdate(self):
-        return False
+    def gcsReads(self) -> tuple:
+        return self.uris
 
     def key(self):
         return ".".join([self.table.dataset_id,
@@ -724,8 +1474,10 @@ class BqGcsTableLoadResource(BqTableBasedResource):
         if self == other:
             return False
 
-        gcsremoved = re.sub('^gs:.*$', "\n", self.query)
-        filtered = getFiltered(gcsremoved)
+        if self.filtered is None:
+            gcsremoved = re.sub('^gs:.*$', "\n", self.query)
+            self.filtered = getFiltered(gcsremoved)
+        filtered = self.filtered
 
         if strictSubstring("".join(["", other.key(), " "]), filtered):
             return True
@@ -733,64 +1485,112 @@ class BqGcsTableLoadResource(BqTableBasedResource):
         return False
 
 
+QUERY_HASH_MODES = set(["raw", "normalized"])
+
+
 class BqQueryBasedResource(BqTableBasedResource):
     """ Base class of query based big query actions """
+    stampsDescription = True
+
     def __init__(self, queries: list, table: Table,
-                 bqClient: Client):
+                 bqClient: Client, queryHash: str = "raw"):
+        """
+        :param queryHash: raw - any edit to the query text reruns it.
+        normalized - comment, whitespace and keyword case edits do not
+        """
         self.queries = queries
         self.table = table
         self.bqClient = bqClient
+        self.queryHash = queryHash
+        # the final query and what we derive from it are computed once
+        # and dropped whenever a query is added
+        self.derived = {}
 
         if not isinstance(self.queries, list):
             raise Exception("queries must be of type list")
+        self.querySet = set(self.queries)
+        if self.queryHash not in QUERY_HASH_MODES:
+            raise Exception("query_hash must be one of " +
+                            ",".join(sorted(QUERY_HASH_MODES)))
 
     def __eq__(self, other):
         try:
             return other.key() == self.key() \
-                   and self.makeFinalQuery() == other.makeFinalQuery()
+                   and self.makeRawQueryHashTag() == \
+                   other.makeRawQueryHashTag()
         except Exception:
             return False
 
-    def makeQueryHashTag(self):
-        finalQuery = self.makeFinalQuery()
-        md5hash = "queryhash:" + hashlib.md5(
-            finalQuery.encode("utf-8")).hexdigest()
-        return md5hash
+    def derive(self, name, func):
+        if name not in self.derived:
+            self.derived[name] = func()
+        return self.derived[name]
 
-    def updateTime(self):
-        """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
+    def makeRawQueryHashTag(self):
+        def make():
+            finalQuery = self.makeFinalQuery()
+            return "queryhash:" + hashlib.md5(
+                finalQuery.encode("utf-8")).hexdigest()
+        return self.derive("queryhash", make)
 
-        createdTime = self.table.modified
+    def makeNormalizedQueryHashTag(self):
+        return self.derive("nqueryhash", lambda: "nqueryhash:" +
+                           normalizedQueryHash(self.makeFinalQuery()))
 
-        if createdTime:
-            # getting even more debt ridden
-            final_query = self.makeFinalQuery()
-            # hijack this step to update description
-            if not self.table.description:
-                # we use a create time + a missing description
-                # as a queue to update description with the state
-                # necessary to know if we should update / re-run next
-                # time.
-                padding = 300
-                truncated = len(final_query) > MAX_DESCRIPTION_LEN - padding \
-                    and "(truncated due to size)" or ""
-
-                msg = [f"This table/view was created with "
-                       f"the following {truncated} query", "/**",
-                       f"{final_query[:MAX_DESCRIPTION_LEN-padding]}",
-                       "*/",
-                       "Edits to this description will not be saved",
-                       "Do not edit", "",
-                       self.makeQueryHashTag()]
-
-                self.table.description = "\n".join(msg)
-                self.table = self.bqClient.update_table(
-                        self.table,
-                        ["description"]
-                        )
-            return int(createdTime.strftime("%s")) * 1000
-        return None
+    def makeQueryHashTag(self):
+        if self.queryHash == "normalized":
+            return self.makeNormalizedQueryHashTag()
+        return self.makeRawQueryHashTag()
+
+    def makeQueryHashTags(self):
+        """ we always record the raw hash so switching back to raw
+        hashing doesn't rerun everything """
+        if self.queryHash == "normalized":
+            return [self.makeNormalizedQueryHashTag(),
+                    self.makeRawQueryHashTag()]
+        return [self.makeRawQueryHashTag()]
+
+    def describedByLegacyTags(self, description: str):
+        """ Normalized hashing was turned on after the table was built
+        and so only the raw hash was recorded.  Compare against that and
+        failing that, the query saved in the description """
+        if self.makeRawQueryHashTag() in description:
+            return True
+
+        lines = description.split("\n")
+        if "/**" not in lines or "*/" not in lines or \
+                "(truncated due to size)" in lines[0]:
+            return False
+        start = lines.index("/**") + 1
+        end = len(lines) - lines[::-1].index("*/") - 1
+        savedQuery = "\n".join(lines[start:end])
+        return normalizedQueryHash(savedQuery) == \
+            normalizedQueryHash(self.makeFinalQuery())
+
+    def makeDescription(self):
+        """ the description holds the state necessary to know if we
+        should update / re-run next time """
+        final_query = self.makeFinalQuery()
+        padding = 300
+        truncated = len(final_query) > MAX_DESCRIPTION_LEN - padding \
+            and "(truncated due to size)" or ""
+
+        msg = [f"This table/view was created with "
+               f"the following {truncated} query", "/**",
+               f"{final_query[:MAX_DESCRIPTION_LEN-padding]}",
+               "*/",
+               "Edits to this description will not be saved",
+               "Do not edit", ""] + self.makeQueryHashTags()
+        return "\n".join(msg)
+
+    def stampMetadata(self, inputs: str = None):
+        # views have no job nor expiration
+        job = getattr(self, "queryJob", None)
+        if jobSucceeded(job):
+            self.writeDescription(
+                "\n".join([self.makeDescription()] +
+                          makeDescriptionTags(job, inputs)),
+                getattr(self, "expiration", None))
 
     def create(self):
         raise Exception("implement")
@@ -809,7 +1609,8 @@ class BqQueryBasedResource(BqTableBasedResource):
         if self == other:
             return False
 
-        filtered = getFiltered(self.makeFinalQuery())
+        filtered = self.derive("filtered",
+                               lambda: getFiltered(self.makeFinalQuery()))
         if strictSubstring("".join(["", other.key(), " "]), filtered):
             return True
 
@@ -822,21 +1623,26 @@ class BqQueryBasedResource(BqTableBasedResource):
         return False
 
     def addQuery(self, query):
-        s = set(self.queries)
-        if query not in s:
+        if query not in self.querySet:
+            self.querySet.add(query)
             self.queries.append(query)
+            self.derived = {}
 
     def makeFinalQuery(self):
-        return "\nunion all\n".join(self.queries)
+        return self.derive("finalquery",
+                           lambda: "\nunion all\n".join(self.queries))
 
     def shouldUpdate(self):
-        self.updateTime()
+        description = self.description()
+        if self.makeQueryHashTag() in description:
+            return False
 
-        if not self.makeQueryHashTag() in self.table.description:
-            print("updating because query hash is not in the description")
-            return True
+        if self.queryHash == "normalized" and \
+                self.describedByLegacyTags(description):
+            return False
 
-        return False
+        print("updating because query hash is not in the description")
+        return True
 
 
 class BqViewBackedTableResource(BqQueryBasedResource):
@@ -876,6 +1682,73 @@ def getFiltered(query):
     return re.sub('[^0-9a-zA-Z._]+', ' ', query)
 
 
+# keywords whose case we normalize.  Identifiers are case sensitive
+# so are left alone
+SQL_KEYWORDS = set("""all and any array as asc between by case cast
+collate contains create cross cube current default define desc distinct
+each else end enum escape except exclude exists extract false fetch
+following for from full group grouping groups hash having if ignore in
+inner interval intersect into is join lateral left like limit lookup
+merge natural new no not null nulls of offset on or order outer over
+partition preceding proto qualify range recursive respect right rollup
+rows select set some struct tablesample then to treat true unbounded
+union unnest using when where window with within""".split())
+
+# directives which change how a query is run and so are not comments
+SQL_DIRECTIVES = set(["#standardsql", "#legacysql"])
+
+QUERY_TOKENS = re.compile(
+    r"(?P<comment>--[^\n]*|#[^\n]*|/\*.*?(?:\*/|$))"
+    r"|(?P<literal>'''.*?'''|\"\"\".*?\"\"\""
+    r"|'(?:\\.|''|[^'\\\n])*'|\"(?:\\.|[^\"\\\n])*\"|`[^`]*`)"
+    r"|(?P<space>\s+)"
+    r"|(?P<word>[A-Za-z_][A-Za-z_0-9]*)"
+    r"|(?P<other>.)",
+    re.DOTALL)
+
+
+def isWordLike(kind: str, token: str, index: int):
+    if kind == "literal":
+        return True
+    return token != "" and (token[index].isalnum() or token[index] == "_")
+
+
+def normalizeQuery(query: str) -> str:
+    """ canonical form of a query.  Comments are stripped, whitespace
+    collapsed and keywords upper cased.  String literals and quoted
+    identifiers are left untouched """
+    out = []
+    previous = ("", "")
+    separated = False
+    for m in QUERY_TOKENS.finditer(query):
+        kind = m.lastgroup
+        token = m.group(kind)
+        if kind == "comment" and token.strip().lower() in SQL_DIRECTIVES:
+            out.append(token.strip().lower() + "\n")
+            previous = ("", "")
+            separated = False
+            continue
+        if kind in ("space", "comment"):
+            separated = True
+            continue
+
+        if kind == "word" and previous[1] not in (".", ":") \
+                and token.lower() in SQL_KEYWORDS:
+            token = token.upper()
+        # whitespace only matters between two words, numbers or literals
+        if separated and isWordLike(*previous, -1) and \
+                isWordLike(kind, token, 0):
+            out.append(" ")
+        out.append(token)
+        previous = (kind, token)
+        separated = False
+    return "".join(out)
+
+
+def normalizedQueryHash(query: str) -> str:
+    return hashlib.md5(normalizeQuery(query).encode("utf-8")).hexdigest()
+
+
 def strictSubstring(contained, container):
     """
     :rtype: bool
@@ -885,9 +1758,10 @@ def strictSubstring(contained, container):
 
 class BqQueryBackedTableResource(BqQueryBasedResource):
     def __init__(self, query: str, table: Table,
-                 bqClient: Client, queryJob: QueryJob, expiration: None):
+                 bqClient: Client, queryJob: QueryJob, expiration: None,
+                 queryHash: str = "raw"):
         super(BqQueryBackedTableResource, self)\
-            .__init__(query, table, bqClient)
+            .__init__(query, table, bqClient, queryHash)
         self.queryJob = queryJob
         self.expiration = expiration
 
@@ -919,18 +1793,7 @@ class BqQueryBackedTableResource(BqQueryBasedResource):
             job_config=job_config,
             job_id=jobid
         )
-
-        if self.expiration is not None:
-            def done_callback(future):
-                table_path = ".".join([self.table.project,
-                                      self.table.dataset_id,
-                                      self.table.table_id])
-                table = self.bqClient.get_table(table_path)
-                table.expires = datetime.now() + timedelta(
-                                      days=self.expiration)
-                self.bqClient.update_table(table, ['expires'])
-
-            self.queryJob.add_done_callback(done_callback)
+        # the expiration is set by stampMetadata with the description
 
     def key(self):
         return ".".join([self.table.dataset_id, self.table.table_id])
@@ -983,7 +1846,22 @@ def processExtractTableOptions(options: dict):
     return job_config
 
 
+# completion markers of extracts are written under this prefix of the
+# bucket extracted to, so loads reading the extract never match them
+MARKER_PREFIX = "_bqm2markers/"
+
+
 class BqExtractTableResource(Resource):
+    """
+    Extracts a table to gcs.  Once the extract job has succeeded a marker
+    object recording the job, the modified time of the table extracted
+    and the files written is put under MARKER_PREFIX.  Freshness is read
+    from the marker in a single request and the extract only counts as
+    existing once its marker does
+    """
+    # the marker last read, MISSING if there is none
+    MISSING = {}
+
     def __init__(self,
                  table: Table,
                  bqClient: Client,
@@ -1000,8 +1878,44 @@ class BqExtractTableResource(Resource):
         # check uris
         (self.bucket, self.pathPrefix) = self.parseBucketAndPrefix(uris)
         self.options = options
+        self.marker = None
+        # modified time of the table when the running extract started
+        self.extractedModified = None
+
+    def markerBlob(self):
+        (bucket, path) = parseBucketAndBlobPath(self.uris)
+        return self.gcsClient.bucket(bucket).blob(
+            MARKER_PREFIX + path.replace("*", "_") + "/_SUCCESS")
+
+    def readMarker(self):
+        """ :return: the content of the marker or None if the extract
+        has not completed """
+        if self.marker is None:
+            try:
+                self.marker = json.loads(
+                    self.markerBlob().download_as_bytes())
+            except NotFound:
+                self.marker = self.MISSING
+        if self.marker is self.MISSING:
+            return None
+        return self.marker
+
+    def tableModified(self) -> int:
+        """ :return: time in milliseconds the table was modified.  0 if
+        unknown """
+        self.table = self.bqClient.get_table(self.table)
+        modified = self.table.modified
+        if not modified:
+            return 0
+        return int(modified.strftime("%s")) * 1000
 
     def create(self):
+        # until the new extract completes there's no complete extract
+        try:
+            self.markerBlob().delete()
+        except NotFound:
+            pass
+        self.extractedModified = self.tableModified()
         jobid = "-".join(["extract", self.table.table_id,
                           self.table.table_id, str(uuid.uuid4())])
         self.extractJob = self.bqClient.extract_table(
@@ -1010,6 +1924,37 @@ class BqExtractTableResource(Resource):
                 jobid,
                 job_config=processExtractTableOptions(self.options)
                 )
+        self.invalidate()
+
+    def invalidate(self):
+        # we are (re)writing the blobs under our prefix
+        (bucket, prefix) = parseBucketAndPrefix(self.uris)
+        gcsListings.invalidate(bucket, prefix.split("*")[0])
+        self.marker = None
+
+    def stampMetadata(self, inputs: str = None):
+        """ writes the completion marker once the extract succeeded """
+        if self.extractJob is None or not jobSucceeded(self.extractJob):
+            return
+        objs = gcsUris(self.gcsClient, self.uris)
+        files = sorted([[o.name, o.generation, o.size] for o in objs])
+        updated = [int(o.updated.timestamp() * 1000) for o in objs]
+        marker = {
+            "jobid": self.extractJob.job_id,
+            "tableModified": self.extractedModified,
+            "updated": max(updated) if len(updated) else 0,
+            "fingerprint": filesFingerprint(files),
+            "inputs": inputs,
+            "files": files
+        }
+        self.markerBlob().upload_from_string(
+            json.dumps(marker, indent=2, sort_keys=True),
+            content_type="application/json")
+        self.marker = None
+
+    def recordedInputs(self):
+        marker = self.readMarker()
+        return marker and marker.get("inputs")
 
     def key(self):
         return ".".join(["extract", self.table.dataset_id,
@@ -1023,11 +1968,20 @@ class BqExtractTableResource(Resource):
                                      self.table.table_id])
 
     def exists(self):
-        return gcsExists(self.gcsClient, self.uris)
+        return self.readMarker() is not None
 
     def dependsOn(self, other: Resource):
         return "extract." + other.key() == self.key()
 
+    def gcsWrites(self) -> tuple:
+        return tuple(self.uris.split(","))
+
+    def __eq__(self, other):
+        try:
+            return self.key() == other.key() and self.uris == other.uris
+        except Exception:
+            return False
+
     def dump(self):
         return ",".join(self.uris)
 
@@ -1037,22 +1991,32 @@ class BqExtractTableResource(Resource):
         return (bucket, prefix)
 
     def updateTime(self):
-        objs = [int(o.updated.timestamp() * 1000) for o in
-                gcsUris(self.gcsClient, self.uris)]
-
-        if len(objs) == 0:
+        marker = self.readMarker()
+        if marker is None:
             # basically i've never been extracted
             return 0
+        return marker["updated"]
 
-        return max(objs)
+    def fingerprint(self):
+        marker = self.readMarker()
+        if marker is None:
+            return filesFingerprint(
+                [[o.name, o.generation] for o in
+                 gcsUris(self.gcsClient, self.uris)])
+        return marker["fingerprint"]
 
     def shouldUpdate(self):
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.modified
-        if not createdTime:
+        modified = self.tableModified()
+        if not modified:
             return False
+        marker = self.readMarker()
+        return marker is None or marker["tableModified"] != modified
+
 
-        return self.updateTime() < int(createdTime.strftime("%s")) * 1000
+def filesFingerprint(files: list) -> str:
+    """ :param files: [name, generation, ...] of each file extracted """
+    objs = sorted([":".join([str(f[0]), str(f[1])]) for f in files])
+    return hashlib.md5("\n".join(objs).encode("utf-8")).hexdigest()
 
 
 def export_data_to_gcs(dataset_name, table_name, destination):
@@ -1079,17 +2043,251 @@ def isJobRunning(job):
     return job.running()
 
 
+def jobSucceeded(job):
+    """ a missing job is treated as success - i.e. synchronous creates
+    such as views """
+    return not job or job.error_result is None
+
+
+def schemaColumns(schema) -> list:
+    return [f.name for f in schema or []]
+
+
+def makeDescriptionTags(job, inputs: str):
+    """ the tag lines recording how a table was built """
+    tags = []
+    if job:
+        tags.append("jobid:" + job.job_id)
+    if inputs:
+        tags.append("inputs:" + inputs)
+    return tags
+
+
+def parseDescriptionTag(description: str, tag: str):
+    """ :return: value of the tag:value line in description which we
+    wrote after any query text or None if there is no such line """
+    lines = description.split("\n")
+    if "*/" in lines:
+        lines = lines[len(lines) - lines[::-1].index("*/"):]
+    for line in lines:
+        if line.startswith(tag + ":"):
+            return line[len(tag) + 1:]
+    return None
+
+
 def parseBucketAndPrefix(uris):
     bucket = uris.replace("gs://", "").split("/")[0]
     prefix = "/".join(uris.replace("gs://", "").split("/")[1:])
     return (bucket, prefix)
 
 
+class GcsListingCache:
+    """
+    Gcs listings for the run.  Each (bucket, prefix) is listed once,
+    without a delimiter so nested objects are included, and prefixes
+    under one already listed are answered from that listing.  Blob
+    existence is answered from the listings covering the blob.  Resources
+    writing to a prefix invalidate it
+    """
+
+    def __init__(self):
+        self.listings = {}
+        # the blobs of each listing keyed by name
+        self.names = {}
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def list(self, gcsClient, bucket: str, prefix: str) -> list:
+        """ :return: the blobs whose names start with prefix """
+        key = (bucket, prefix)
+        with self.lock:
+            if key in self.listings:
+                return self.listings[key]
+            for ((b, p), blobs) in self.listings.items():
+                if b == bucket and prefix.startswith(p):
+                    return [x for x in blobs if x.name.startswith(prefix)]
+        blobs = list(gcsClient.bucket(bucket).list_blobs(prefix=prefix))
+        with self.lock:
+            self.listings[key] = blobs
+            self.names[key] = dict([(x.name, x) for x in blobs])
+        return blobs
+
+    def known(self, bucket: str, path: str):
+        """ :return: the blob at path from a listing covering it, None
+        if there is no such listing or it has no such blob.  Never lists """
+        with self.lock:
+            for ((b, prefix), names) in self.names.items():
+                if b == bucket and path.startswith(prefix):
+                    return names.get(path)
+        return None
+
+    def blobExists(self, gcsClient, bucket: str, path: str) -> bool:
+        with self.lock:
+            for ((b, prefix), names) in self.names.items():
+                if b == bucket and path.startswith(prefix):
+                    return path in names
+            if (bucket, path) in self.blobs:
+                return self.blobs[(bucket, path)]
+        exists = gcsClient.bucket(bucket).blob(path).exists()
+        with self.lock:
+            self.blobs[(bucket, path)] = exists
+        return exists
+
+    def invalidate(self, bucket: str, prefix: str):
+        """ forget everything which may have changed by writing blobs
+        starting with prefix """
+        with self.lock:
+            for key in list(self.listings.keys()) + \
+                    list(self.blobs.keys()):
+                (b, p) = key
+                if b == bucket and (p.startswith(prefix) or
+                                    prefix.startswith(p)):
+                    self.listings.pop(key, None)
+                    self.names.pop(key, None)
+                    self.blobs.pop(key, None)
+
+
+# shared by every resource reading gcs during the run
+gcsListings = GcsListingCache()
+
+
+# the ledgers of incremental gcs loads are kept under this prefix of the
+# bucket they load from
+LEDGER_PREFIX = "_bqm2ledgers/"
+
+
+class GcsLoadLedger:
+    """
+    The gcs objects loaded into each incremental .gcsdata table with the
+    generation and md5 of each object when it was loaded.  Objects not in
+    the ledger are new and appended.  The ledger of a table is a json
+    object in gcs, next to the data it describes, so it outlives the
+    machine bqm2 runs on.  Each is read once a run and written whenever a
+    load completes
+    """
+
+    def __init__(self):
+        # reload every incremental table rather than appending
+        self.fullRefresh = False
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def entry(self, gcsClient, uri: str):
+        """ :return: the ledger at uri or None if there is none """
+        with self.lock:
+            if uri in self.entries:
+                return self.entries[uri]
+        (bucket, path) = parseBucketAndBlobPath(uri)
+        try:
+            entry = json.loads(
+                gcsClient.bucket(bucket).blob(path).download_as_bytes())
+        except (NotFound, ValueError):
+            entry = None
+        with self.lock:
+            self.entries[uri] = entry
+        return entry
+
+    def record(self, gcsClient, uri: str, entry: dict):
+        (bucket, path) = parseBucketAndBlobPath(uri)
+        gcsClient.bucket(bucket).blob(path).upload_from_string(
+            json.dumps(entry, indent=2, sort_keys=True),
+            content_type="application/json")
+        with self.lock:
+            self.entries[uri] = entry
+
+
+# shared by every incremental gcs load of the run
+gcsLedger = GcsLoadLedger()
+
+
+def isBookkeeping(name: str) -> bool:
+    """ :return: if the object is a ledger or marker bqm2 writes """
+    return name.startswith(LEDGER_PREFIX) or name.startswith(MARKER_PREFIX)
+
+
+def spansBookkeeping(uri: str) -> bool:
+    """ :return: if the wildcard of uri may match ledgers or markers
+    e.g. a wildcard at the root of a bucket """
+    (_, head, _, wildcard) = uriPattern(uri)
+    return wildcard and (LEDGER_PREFIX.startswith(head) or
+                         MARKER_PREFIX.startswith(head))
+
+
+def uriPattern(uri: str) -> tuple:
+    """ :return: (bucket, head, tail, wildcard) of the gcs uri pattern.
+    head and tail are the object name before and after its wildcard.
+    Patterns with several wildcards are treated as matching anything
+    between the first and the last """
+    (bucket, path) = parseBucketAndBlobPath(uri)
+    if "*" not in path:
+        return (bucket, path, "", False)
+    return (bucket, path[:path.index("*")], path[path.rindex("*") + 1:],
+            True)
+
+
+def urisOverlap(a: str, b: str) -> bool:
+    """ :return: if some object name matches both uri patterns """
+    (aBucket, aHead, aTail, aWild) = uriPattern(a)
+    (bBucket, bHead, bTail, bWild) = uriPattern(b)
+    if aBucket != bBucket:
+        return False
+    if not aWild and not bWild:
+        return aHead == bHead
+    if not aWild:
+        return len(aHead) >= len(bHead) + len(bTail) and \
+            aHead.startswith(bHead) and aHead.endswith(bTail)
+    if not bWild:
+        return urisOverlap(b, a)
+    # the longer head and tail make a name matching both
+    return (aHead.startswith(bHead) or bHead.startswith(aHead)) and \
+        (aTail.endswith(bTail) or bTail.endswith(aTail))
+
+
+class UriIndex:
+    """
+    Gcs uri patterns indexed by bucket and the object name before their
+    wildcard.  Patterns which can overlap one another must have heads
+    where one starts the other, so a lookup checks the heads starting its
+    own head and the prefixes of it rather than every pattern
+    """
+
+    def __init__(self):
+        # bucket -> head -> [(pattern, value)]
+        self.entries = {}
+        # bucket -> sorted heads
+        self.heads = {}
+
+    def add(self, uri: str, value):
+        (bucket, head, _, _) = uriPattern(uri)
+        entries = self.entries.setdefault(bucket, {})
+        if head not in entries:
+            entries[head] = []
+            bisect.insort(self.heads.setdefault(bucket, []), head)
+        entries[head].append((uri, value))
+
+    def lookup(self, uri: str) -> list:
+        """ :return: the values of the patterns overlapping uri """
+        (bucket, head, _, _) = uriPattern(uri)
+        entries = self.entries.get(bucket, {})
+        heads = self.heads.get(bucket, [])
+        candidates = [head[:i] for i in range(len(head))
+                      if head[:i] in entries]
+        i = bisect.bisect_left(heads, head)
+        while i < len(heads) and heads[i].startswith(head):
+            candidates.append(heads[i])
+            i += 1
+
+        ret = []
+        for h in candidates:
+            for (pattern, value) in entries[h]:
+                if value not in ret and urisOverlap(uri, pattern):
+                    ret.append(value)
+        return ret
+
+
 def gcsBlobExists(gcsclient, gcsUri):
     bucket_name, blob_path = parseBucketAndBlobPath(gcsUri)
-    bucket = gcsclient.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    return blob.exists()
+    return gcsListings.blobExists(gcsclient, bucket_name, blob_path)
 
 
 def parseBucketAndBlobPath(uri):
@@ -1110,11 +2308,9 @@ def gcsUris(gcsClient, uris):
                         "a single * char and provide file " +
                         "suffix info: {str(uris)}")
 
-    args = {'prefix': parts[0], 'delimiter': '/'}
-
-    bucket = gcsClient.get_bucket(bucket)
-    objs = [x for x in bucket.list_blobs(**args)
-            if len(parts) == 1 or x.name.endswith(parts[1])]
+    objs = [x for x in gcsListings.list(gcsClient, bucket, parts[0])
+            if (x.name == prefix if len(parts) == 1 else
+                x.name.endswith(parts[1]))]
 
     return objs
 
@@ -1141,6 +2337,8 @@ def legacyBqQueryDependsOn(self, other: Resource):
 # base resource class for all table back resources
 class BqExternalTableBasedResource(BqTableBasedResource):
     """ Base class of query based big query actions """
+    stampsDescription = True
+
     def __init__(self, bqclient: Client, table: Table,
                  external_config: ExternalConfig):
         self.table = table
@@ -1157,20 +2355,16 @@ class BqExternalTableBasedResource(BqTableBasedResource):
         if not autodetect and not table.schema:
             raise Exception("you must not specify a schema in a .schema file")
 
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
-
     def create(self):
         self.bqClient.delete_table(self.table, not_found_ok=True)
         self.table = self.bqClient.create_table(self.table)
-        self.table.description = self.make_description()
-        # update description - for some reason this can't be done
-        # on create???
-        self.bqClient.update_table(self.table, ["description"])
+        # the description is written by stampMetadata
+
+    def stampMetadata(self, inputs: str = None):
+        # there is no job, the table is created synchronously
+        self.writeDescription("\n".join(
+            [self.make_description().rstrip()] +
+            makeDescriptionTags(None, inputs)))
 
     def key(self):
         return ".".join([self.table.dataset_id,
@@ -1186,12 +2380,7 @@ class BqExternalTableBasedResource(BqTableBasedResource):
         return False
 
     def shouldUpdate(self):
-        current_description = self.bqClient.get_table(self.table).description
-        if not current_description:
-            return True
-        if not self.makeHashTag() in current_description:
-            return True
-        return False
+        return self.makeHashTag() not in self.description()
 
     def makeHashTag(self):
         m = hashlib.md5()
@@ -1201,7 +2390,11 @@ class BqExternalTableBasedResource(BqTableBasedResource):
         return m.hexdigest()
 
     def __eq__(self, other):
-        return self.key() == other.key()
+        try:
+            return self.key() == other.key() and \
+                self.makeHashTag() == other.makeHashTag()
+        except Exception:
+            return False
 
     def make_description(self):
         ret = f"""
@@ -0,0 +1,157 @@
+"""
+Source format sniffing for local loads.
+
+The format of a file is decided from a sample of its first bytes rather
+than its first line.  Several records are checked so a blank first line,
+a json header line or a ragged file is caught before anything is
+uploaded.
+"""
+import csv
+import json
+
+from filehash import fileHashes
+
+# bytes sampled from the start of a file
+SAMPLE_BYTES = 64 * 1024
+# records of the sample checked
+SAMPLE_RECORDS = 50
+# delimiters tried in order of preference
+DELIMITERS = ["\t", ",", "|", ";"]
+
+NEWLINE_DELIMITED_JSON = "NEWLINE_DELIMITED_JSON"
+CSV = "CSV"
+
+
+class FormatError(ValueError):
+    pass
+
+
+def sampleLines(sample: bytes, complete: bool) -> list:
+    """ :param complete: the sample is the whole file.  Otherwise its
+    last line may be cut short and is dropped """
+    lines = sample.decode("utf-8", "replace").split("\n")
+    if not complete and len(lines) > 1:
+        lines = lines[:-1]
+    return [line.rstrip("\r") for line in lines
+            if line.strip()][:SAMPLE_RECORDS]
+
+
+def isJsonObject(line: str) -> bool:
+    try:
+        return isinstance(json.loads(line), dict)
+    except ValueError:
+        return False
+
+
+def sniffDelimiter(lines: list, columns: list = None) -> tuple:
+    """ :return: (delimiter, rows) for the first delimiter splitting
+    every line into the same number of fields.  With a single column
+    the first delimiter in none of the lines """
+    if columns and len(columns) == 1:
+        for delimiter in DELIMITERS:
+            if not any([delimiter in line for line in lines]):
+                return (delimiter, [[line] for line in lines])
+        raise FormatError("every delimiter tried appears in the values "
+                          "of the single column")
+
+    for delimiter in DELIMITERS:
+        rows = list(csv.reader(lines, delimiter=delimiter))
+        widths = set([len(row) for row in rows])
+        if len(widths) == 1 and widths.pop() > 1:
+            return (delimiter, rows)
+
+    if not any([d in line for line in lines for d in DELIMITERS]):
+        # a single column
+        return ("\t", [[line] for line in lines])
+    raise FormatError("lines have differing numbers of fields for every "
+                      "delimiter tried: " +
+                      ", ".join([repr(d) for d in DELIMITERS]))
+
+
+def isNumber(value: str) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def hasHeader(rows: list, columns: list = None) -> bool:
+    """ the first row is a header if it names the columns or, failing
+    that, if it has text where the other rows have numbers """
+    if columns and [c.lower() for c in rows[0]] == \
+            [c.lower() for c in columns]:
+        return True
+    if len(rows) < 2:
+        return False
+    for (i, value) in enumerate(rows[0]):
+        if not isNumber(value) and \
+                all([isNumber(row[i]) for row in rows[1:]]):
+            return True
+    return False
+
+
+def sniff(sample: bytes, complete: bool, columns: list = None) -> dict:
+    """
+    :param sample: the first bytes of the data
+    :param complete: sample is all of the data
+    :param columns: the names of the columns of the schema, to
+    recognise a header by
+    :return: dict of source_format, field_delimiter and
+    skip_leading_rows
+    """
+    lines = sampleLines(sample, complete)
+    if not len(lines):
+        return {"source_format": CSV, "field_delimiter": "\t",
+                "skip_leading_rows": 0}
+
+    objects = [isJsonObject(line) for line in lines]
+    if all(objects):
+        return {"source_format": NEWLINE_DELIMITED_JSON,
+                "field_delimiter": None, "skip_leading_rows": 0}
+    if objects[0]:
+        raise FormatError("line {} is not a json object but the first "
+                          "line is".format(objects.index(False) + 1))
+    if len(objects) > 1 and all(objects[1:]):
+        raise FormatError("the first line is not a json object but the "
+                          "following lines are")
+
+    (delimiter, rows) = sniffDelimiter(lines, columns)
+    return {"source_format": CSV, "field_delimiter": delimiter,
+            "skip_leading_rows": hasHeader(rows, columns) and 1 or 0}
+
+
+def firstLineFormat(sample: bytes, delimiter: str = None,
+                    skipLeadingRows: int = 0) -> dict:
+    """ the format decided from the first line alone, as it was before
+    sniffing and still is unless sniffing is asked for.  Json if the line
+    parses, otherwise delimited with skipLeadingRows header rows
+
+    :param delimiter: of delimited data.  None leaves it to big query
+    """
+    line = sample.split(b"\n", 1)[0].decode("utf-8", "replace")
+    try:
+        json.loads(line)
+        return {"source_format": NEWLINE_DELIMITED_JSON,
+                "field_delimiter": None, "skip_leading_rows": 0}
+    except ValueError:
+        return {"source_format": CSV, "field_delimiter": delimiter,
+                "skip_leading_rows": skipLeadingRows}
+
+
+def sniffFile(path: str, columns: list = None, cache=True) -> dict:
+    """ sniffs the start of the file at path.  The decision is cached
+    with the file's hashes so an unchanged file is sniffed once """
+    def sniffPath(path):
+        with open(path, "rb") as f:
+            sample = f.read(SAMPLE_BYTES + 1)
+        try:
+            return sniff(sample[:SAMPLE_BYTES],
+                         len(sample) <= SAMPLE_BYTES, columns)
+        except FormatError as e:
+            raise FormatError(path + ": " + str(e))
+
+    if not cache:
+        return sniffPath(path)
+    return fileHashes.derived(path, "format:" + ",".join(columns or []),
+                              sniffPath)
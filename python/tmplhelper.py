@@ -1,48 +1,74 @@
+import itertools
 import string
+from collections import ChainMap, defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
 from dateutil.relativedelta import relativedelta
 
 from date_formatter_helper import helpers
 
+# the most combinations a single template vars entry may explode into.
+# Set from the --maxCombinations command line option
+maxCombinations = 1000000
+
+# the time relative date vars are evaluated against.  Pinned on first use
+# so every key of a run agrees.  Set from the --asOf command line option
+asOf = None
+
+
+def runTime() -> datetime:
+    """ :return: asOf, pinning it to now if it's not set """
+    global asOf
+    if asOf is None:
+        asOf = datetime.now()
+    return asOf
+
+
+def parseAsOf(value: str) -> datetime:
+    """ :param value: a date as yyyymmdd or yyyymmddhh """
+    for format in ["%Y%m%d%H", "%Y%m%d"]:
+        if len(value) == len(datetime(2000, 1, 1).strftime(format)):
+            try:
+                return datetime.strptime(value, format)
+            except ValueError:
+                break
+    raise ValueError("asOf must be yyyymmdd or yyyymmddhh: " + value)
+
 
 def evalTmplRecurse(templateKeys: dict):
     """
     We need to potentially format each of the value with some of the
-    other values.  So some sort of recursion must happen i.e. we first
-    find the k,v which are not templates and use them to format the
-    unformatted values that we can.
+    other values.  So we format the values in an order where every
+    value is formatted after the values it refers to.
+
+    The order depends only on which keys refer to which, which is the
+    same for every combination exploded from a .vars entry, so it is
+    computed once and shared.
+
+    Copying a ChainMap only copies its first layer so the layers below
+    are shared rather than duplicated.  Values are written to the first
+    layer.
 
     :param templateKeys: The values of the dict may be a template.
-    :return: dict with same keys as templateKeys but fully formatted values
+    :return: dict (or ChainMap) with same keys as templateKeys but fully
+    formatted values
     """
     templateKeysCopy = templateKeys.copy()
-    keysNeeded = {}
-    usableKeys = {}
 
     helpers.format_all_date_keys(templateKeysCopy)
 
-    for (k, v) in templateKeysCopy.items():
-        keys = keysOfTemplate(v)
-        if len(keys):
-            keysNeeded[k] = keys
-        else:
-            usableKeys[k] = templateKeysCopy[k]
-
-    while len(keysNeeded):
-        remaining = len(keysNeeded)
-        for (k, v) in templateKeysCopy.items():
-            if k in usableKeys:
-                continue
+    references = tuple([(k, keysOfTemplate(v))
+                        for (k, v) in templateKeysCopy.items()
+                        if len(keysOfTemplate(v))])
+    for (k, needed) in references:
+        if not needed.issubset(templateKeysCopy.keys()):
+            missing = sorted(needed - templateKeysCopy.keys())
+            raise Exception("template vars: " + k + " refers to " +
+                            ", ".join(missing) + " which are not defined")
 
-            needed = keysNeeded[k]
-            if needed.issubset(usableKeys.keys()):
-                templateKeysCopy[k] = templateKeysCopy[k].format(
-                    **usableKeys)
-                usableKeys[k] = templateKeysCopy[k]
-                del keysNeeded[k]
-        if remaining == len(keysNeeded):
-            raise Exception("template vars: " + str(templateKeys) +
-                            " contains a circular reference")
+    for k in resolutionOrder(references):
+        templateKeysCopy[k] = compileTemplate(
+            templateKeysCopy[k]).render(templateKeysCopy)
 
     for k, v in templateKeysCopy.items():
         if k.endswith("_dash2uscore"):
@@ -51,10 +77,90 @@ def evalTmplRecurse(templateKeys: dict):
     return templateKeysCopy
 
 
+@lru_cache(maxsize=4096)
+def resolutionOrder(references: tuple) -> tuple:
+    """
+    :param references: tuple of (key, frozenset of keys it refers to)
+    for each key whose value is a template
+    :return: the templated keys ordered so each comes after every
+    templated key it refers to
+    """
+    waitingOn = {k: set(needed) for (k, needed) in references}
+    for needed in waitingOn.values():
+        needed.intersection_update(waitingOn.keys())
+    dependants = {k: [] for k in waitingOn}
+    for (k, needed) in waitingOn.items():
+        for n in needed:
+            dependants[n].append(k)
+
+    order = []
+    ready = [k for (k, needed) in waitingOn.items() if not len(needed)]
+    while len(ready):
+        k = ready.pop()
+        order.append(k)
+        for d in dependants[k]:
+            waitingOn[d].discard(k)
+            if not len(waitingOn[d]):
+                ready.append(d)
+
+    if len(order) < len(waitingOn):
+        raise Exception("template vars contain a circular reference: " +
+                        " -> ".join(findCycle(waitingOn)))
+    return tuple(order)
+
+
+def findCycle(waitingOn: dict) -> list:
+    """ :param waitingOn: keys left unresolved mapped to the unresolved
+    keys they refer to.  Every one of them is on or leads to a cycle
+    :return: the keys of one cycle with the first key repeated last """
+    path = [sorted(k for (k, v) in waitingOn.items() if len(v))[0]]
+    while path[-1] not in path[:-1]:
+        path.append(sorted(waitingOn[path[-1]])[0])
+    return path[path.index(path[-1]):]
+
+
 def keysOfTemplate(strr):
     if not isinstance(strr, str):
         return set()
-    return set([x[1] for x in string.Formatter().parse(strr) if x[1]])
+    return compileTemplate(strr).keys
+
+
+class CompiledTemplate:
+    """ A str.format template parsed once.  Templates made of plain
+    {name} fields are rendered by joining strings.  Anything fancier
+    i.e. format specs, conversions or attribute access falls back on
+    str.format """
+    def __init__(self, template: str):
+        self.template = template
+        self.parts = []
+        self.simple = True
+        keys = set()
+        for (literal, field, spec, conversion) in \
+                string.Formatter().parse(template):
+            if field is not None and (not field.isidentifier() or spec or
+                                      conversion):
+                self.simple = False
+            if field:
+                keys.add(field)
+            self.parts.append((literal, field))
+        self.keys = frozenset(keys)
+
+    def render(self, templateVars) -> str:
+        if not self.simple:
+            return self.template.format_map(templateVars)
+        out = []
+        for (literal, field) in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(format(templateVars[field], ""))
+        return "".join(out)
+
+
+@lru_cache(maxsize=65536)
+def compileTemplate(template: str) -> CompiledTemplate:
+    """ shared across combinations and files.  Bounded so memory use
+    doesn't grow with the number of distinct templates """
+    return CompiledTemplate(template)
 
 
 def handleDateField(dt: datetime, val, key) -> str:
@@ -107,66 +213,193 @@ def handleDateField(dt: datetime, val, key) -> str:
         raise Exception("Invalid datetime values to fill out.  Must "
                         "be int, 2 element array of ints, or string")
 
+    helpers.precompute(format, toFormat)
     return sorted([dt.strftime(format) for dt in toFormat])
 
 
-def explodeTemplate(templateVars: dict):
+def iterExplodeTemplate(templateVars: dict, limit: int = None):
     """
     Goal of this method is simply to replace
     any array elements with simple string expansions
 
-    :return:
+    Combinations are generated lazily so memory use does not grow with
+    the number of combinations.
+
+    :param limit: the maximum number of combinations allowed.  Defaults
+    to maxCombinations
+    :return: generator of ChainMaps, one per combination, layering the
+    values of the combination over templateVars
     """
+    if limit is None:
+        limit = maxCombinations
 
     # check for key with yyyymm, yyyymmdd, or yyyymmddhh
     # and handle it specially
+    now = runTime()
     for (k, v) in templateVars.items():
-        date_vals = handleDateField(datetime.now(), v, k)
+        date_vals = handleDateField(now, v, k)
         if date_vals is not None:
             templateVars[k] = date_vals
 
-    topremute = []
-    for (k, v) in templateVars.items():
-        items = []
-        if isinstance(v, list):
-            for vv in v:
-                items.append((k, vv))
-        else:
-            items.append((k, v))
-        topremute.append(items)
-
-    collect = []
-    out = []
-    makeCombinations(topremute, out, collect)
-    # now make maps
-    maps = []
-    for s in collect:
-        maps.append(dict(s))
-    return maps
-
-
-def makeCombinations(lists: list, out: list, collect: list):
+    # only the keys with several values vary between combinations.  The
+    # rest are shared by every combination rather than copied into each
+    keys = [k for (k, v) in templateVars.items() if isinstance(v, list)]
+    values = [templateVars[k] for k in keys]
+    size = 1
+    for v in values:
+        size *= len(v)
+    if size > limit:
+        fanout = ", ".join(["{}={}".format(k, len(v))
+                            for (k, v) in zip(keys, values) if len(v) > 1])
+        raise Exception("template vars explode into {} combinations which "
+                        "exceeds the limit of {}: {}".format(size, limit,
+                                                             fanout))
+
+    layers = isinstance(templateVars, ChainMap) and templateVars.maps \
+        or [templateVars]
+    for combination in itertools.product(*values):
+        yield ChainMap(dict(zip(keys, combination)), *layers)
+
+
+def explodeTemplate(templateVars: dict, limit: int = None):
+    """ :return: list of all combinations - see iterExplodeTemplate """
+    return [dict(c) for c in iterExplodeTemplate(templateVars, limit)]
+
+
+class TemplateScope:
     """
-        given a list of lists, generate a list of lists which
-        has all combinations of each element as a a member
-
-        Example:
-            [[a,b], [c,d]] becomes
-
-            [
-             [a,c],
-             [a,d],
-             [b,c],
-             [b,d]
-            ]
+    Layers of vars shared by the entries of .vars files, i.e. global
+    vars, resolved once.  Each combination of an entry then only
+    evaluates the keys which may differ from the shared ones: the keys of
+    the entry, the shared keys with several values and the shared keys
+    derived from or referring to any of those.  Evaluating an entry
+    gives the same vars as exploding and evaluating it layered over
+    the shared layers with iterExplodeTemplate and evalTmplRecurse
     """
-    if not len(lists):
-        collect.append(out)
-        return
-
-    listsCopy = lists.copy()
-    first = listsCopy.pop(0)
-    for m in first:
-        outCopy = out.copy()
-        outCopy.append(m)
-        makeCombinations(listsCopy, outCopy, collect)
+
+    def __init__(self, layers: list):
+        """ :param layers: maps, the first which defines a var wins.
+        Never written to """
+        now = runTime()
+        self.raw = {}
+        for m in reversed(layers):
+            self.raw.update(m)
+        for (k, v) in self.raw.items():
+            dates = handleDateField(now, v, k)
+            if dates is not None:
+                self.raw[k] = dates
+        # keys which are lists of a single value don't vary
+        varying = set([])
+        for (k, v) in self.raw.items():
+            if isinstance(v, list):
+                if len(v) == 1:
+                    self.raw[k] = v[0]
+                else:
+                    varying.add(k)
+
+        # templated keys referring to each key
+        self.referrers = defaultdict(set)
+        for (k, v) in self.raw.items():
+            for needed in keysOfTemplate(v):
+                self.referrers[needed].add(k)
+
+        self.base = dict(self.raw)
+        self.dirty = self.affected(varying)
+        static = [k for k in self.raw if k not in self.dirty]
+        unresolved = set([])
+        for k in static:
+            try:
+                helpers.format_date_keys(k, self.base[k], self.base)
+            except ValueError:
+                # evaluated, and reported, with the entries which don't
+                # override it
+                unresolved.add(k)
+        references = tuple([(k, keysOfTemplate(self.raw[k]))
+                            for k in static
+                            if len(keysOfTemplate(self.raw[k]))])
+        unresolved.update([k for (k, needed) in references
+                           if not all([n in self.base for n in needed])])
+        self.dirty.update(self.affected(unresolved))
+        references = tuple([(k, needed) for (k, needed) in references
+                            if k not in self.dirty])
+        for k in resolutionOrder(references):
+            self.base[k] = compileTemplate(self.base[k]).render(self.base)
+        for k in self.base:
+            if k.endswith("_dash2uscore") and k not in self.dirty:
+                self.base[k] = self.base[k].replace("-", "_")
+
+    def affected(self, keys) -> set:
+        """ :return: keys with the keys derived from them and the keys
+        referring to any of those, directly or not """
+        ret = set([])
+        toVisit = list(keys)
+        while len(toVisit):
+            k = toVisit.pop()
+            if k in ret:
+                continue
+            ret.add(k)
+            toVisit.extend(helpers.show_new_keys([k]))
+            toVisit.extend(self.referrers.get(k, []))
+        return ret
+
+    def iterEntry(self, entry: dict, limit: int = None):
+        """
+        :param entry: vars layered over the shared ones.  Never written to
+        :param limit: see iterExplodeTemplate
+        :return: generator of a ChainMap per combination of entry, its
+        evaluated keys over the resolved shared keys
+        """
+        if limit is None:
+            limit = maxCombinations
+        now = runTime()
+        own = {}
+        for (k, v) in entry.items():
+            dates = handleDateField(now, v, k)
+            own[k] = v if dates is None else dates
+        evaluated = self.dirty.union(self.affected(own.keys()))
+        # in the order iterExplodeTemplate combines them
+        keys = [k for k in ChainMap(own, self.raw) if k in evaluated]
+        values = dict([(k, own[k] if k in own else self.raw[k])
+                       for k in keys])
+        varying = [k for k in keys if isinstance(values[k], list)]
+        choices = [values[k] for k in varying]
+        size = 1
+        for v in choices:
+            size *= len(v)
+        if size > limit:
+            fanout = ", ".join(["{}={}".format(k, len(v))
+                                for (k, v) in zip(varying, choices)
+                                if len(v) > 1])
+            raise Exception("template vars explode into {} combinations "
+                            "which exceeds the limit of {}: {}"
+                            .format(size, limit, fanout))
+
+        for combination in itertools.product(*choices):
+            top = dict(values)
+            top.update(zip(varying, combination))
+            yield self.evaluate(top)
+
+    def evaluate(self, top: dict) -> ChainMap:
+        """ evaluates the keys of top, in place, over the shared keys """
+        # explicit keys win over derived ones as with format_date_key
+        explicit = ChainMap(top, self.raw)
+        for (k, v) in list(top.items()):
+            try:
+                helpers.format_date_keys(k, v, explicit)
+            except ValueError as e:
+                raise ValueError(f"Unable to format key/value {k}/{v}: {e}")
+        ret = ChainMap(top, self.base)
+        references = tuple([(k, keysOfTemplate(v)) for (k, v) in top.items()
+                            if len(keysOfTemplate(v))])
+        for (k, needed) in references:
+            missing = sorted([n for n in needed if n not in ret])
+            if len(missing):
+                raise Exception("template vars: " + k + " refers to " +
+                                ", ".join(missing) + " which are not "
+                                "defined")
+        for k in resolutionOrder(references):
+            top[k] = compileTemplate(top[k]).render(ret)
+        for k in top:
+            if k.endswith("_dash2uscore"):
+                top[k] = top[k].replace("-", "_")
+        return ret
@@ -1,10 +1,28 @@
+import json
+import os
+import tempfile
 import unittest
 from collections import defaultdict
 
-from bqm2 import DependencyExecutor
+from google.cloud.bigquery.dataset import Dataset, DatasetReference
+from mock import MagicMock
+
+import tmplhelper
+from bqm2 import DependencyExecutor, Backfill, DependencyBuilder, \
+    SelectionError, selectSubgraph, restrictTo
+from loader import BqQueryTemplatingFileLoader, \
+    DelegatingFileSuffixLoader, TableType
+from resource import BqExtractTableResource, BqGcsTableLoadResource, \
+    ResourceFailed
 
 
 class Test(unittest.TestCase):
+    def setUp(self):
+        tmplhelper.asOf = None
+
+    def tearDown(self):
+        tmplhelper.asOf = None
+
     def testHandleRetries(self):
         de = DependencyExecutor(set([]), {}, maxRetry=1)
         retries = defaultdict(lambda: 1)
@@ -17,6 +35,311 @@ class Test(unittest.TestCase):
         except:
             pass
 
+    def testStampedOnlyAfterJobCompletes(self):
+        rsrc = MagicMock()
+        rsrc.exists.side_effect = [False, True]
+        rsrc.isRunning.side_effect = [False, True, True, False]
+        rsrc.shouldUpdate.return_value = False
+        rsrc.updateTime.return_value = 1
+        rsrc.recordedInputs.return_value = None
+
+        de = DependencyExecutor({"a": rsrc}, {"a": set([])})
+        de.execute(checkFrequency=0)
+
+        rsrc.create.assert_called_once()
+        rsrc.stampMetadata.assert_called_once()
+        # creation is never followed by a write to the metadata while
+        # the job is running
+        calls = [c[0] for c in rsrc.method_calls]
+        self.assertTrue(calls.index("stampMetadata") >
+                        calls.index("create"))
+        self.assertEqual(calls.count("isRunning"), 4)
+
+    def testRerunOnlyWhenInputFingerprintsChange(self):
+        upstream = MagicMock()
+        upstream.isRunning.return_value = False
+        upstream.exists.return_value = True
+        upstream.shouldUpdate.return_value = False
+        # a metadata only update makes the upstream look newer
+        upstream.updateTime.return_value = 100
+        upstream.fingerprint.return_value = "fp"
+
+        de = DependencyExecutor({}, {})
+        upstream.recordedInputs.return_value = de.inputsFingerprint({})
+        recorded = de.inputsFingerprint({"up": "fp"})
+
+        for (inputs, expectCreate) in [(recorded, False),
+                                       ("other", True)]:
+            downstream = MagicMock()
+            downstream.isRunning.return_value = False
+            downstream.exists.return_value = True
+            downstream.shouldUpdate.return_value = False
+            downstream.updateTime.return_value = 1
+            downstream.recordedInputs.side_effect = [inputs, recorded]
+
+            de = DependencyExecutor({"up": upstream, "down": downstream},
+                                    {"up": set([]), "down": set(["up"])})
+            de.execute(checkFrequency=0)
+            self.assertEqual(downstream.create.called, expectCreate)
+            if expectCreate:
+                downstream.stampMetadata.assert_called_once_with(recorded)
+
+    def testResourceFailureSkipsOnlyItsDependants(self):
+        def resource(exists=True):
+            rsrc = MagicMock()
+            rsrc.isRunning.return_value = False
+            rsrc.exists.return_value = exists
+            rsrc.shouldUpdate.return_value = False
+            rsrc.updateTime.return_value = 1
+            rsrc.recordedInputs.return_value = None
+            return rsrc
+
+        bad = resource(exists=False)
+        bad.create.side_effect = ResourceFailed("t.localdata: ragged")
+        child = resource()
+        other = resource()
+        other.exists.side_effect = [False, True]
+        de = DependencyExecutor(
+            {"bad": bad, "child": child, "other": other},
+            {"bad": set([]), "child": set(["bad"]), "other": set([])})
+        failed = de.execute(checkFrequency=0)
+
+        self.assertEqual(failed, {
+            "bad": "t.localdata: ragged",
+            "child": "depends on bad which failed"})
+        other.create.assert_called_once()
+        child.create.assert_not_called()
+
+    def testResourceFailingWhileRunningIsNotRetried(self):
+        bad = MagicMock()
+        bad.exists.return_value = False
+        bad.isRunning.side_effect = [False,
+                                     ResourceFailed("not loading output")]
+        child = MagicMock()
+        de = DependencyExecutor({"bad": bad, "child": child},
+                                {"bad": set([]), "child": set(["bad"])})
+        failed = de.execute(checkFrequency=0)
+
+        self.assertEqual(failed, {
+            "bad": "not loading output",
+            "child": "depends on bad which failed"})
+        bad.create.assert_called_once()
+        child.create.assert_not_called()
+
+    def makeBackfillResource(self, ok=True):
+        rsrc = MagicMock()
+        rsrc.isRunning.return_value = False
+        rsrc.exists.return_value = ok
+        rsrc.shouldUpdate.return_value = False
+        rsrc.updateTime.return_value = 1
+        rsrc.recordedInputs.return_value = None
+        return rsrc
+
+    def loadBackfillGraphs(self, templates: dict, dates: list) -> dict:
+        """ :param templates: (query, vars) keyed by querytemplate
+        file name.  :return: the graph of each date as the loader
+        builds it """
+        client = MagicMock()
+        client.dataset.side_effect = \
+            lambda d, project=None: DatasetReference(project or "p", d)
+        client.get_dataset.side_effect = lambda d: \
+            d if isinstance(d, Dataset) else Dataset(DatasetReference("p", d))
+        builder = DependencyBuilder(DelegatingFileSuffixLoader(
+            querytemplate=BqQueryTemplatingFileLoader(
+                client, MagicMock(), MagicMock(), TableType.TABLE,
+                {"dataset": "ds", "project": "p"})))
+        with tempfile.TemporaryDirectory() as folder:
+            for (name, (query, tmplVars)) in templates.items():
+                path = os.path.join(folder, name + ".querytemplate")
+                with open(path, "w") as f:
+                    f.write(query)
+                with open(path + ".vars", "w") as f:
+                    json.dump([tmplVars], f)
+            return Backfill(builder, [folder], None).loadGraphs(dates)
+
+    def testBackfillPartitionsSharedResources(self):
+        graphs = self.loadBackfillGraphs({
+            "lookup": ("select 1 as x", {"table": "lookup"}),
+            "t": ("select * from ds.lookup where d = '{yyyymmdd}'",
+                  {"table": "t_{yyyymmdd}", "yyyymmdd": 0})},
+            ["20250101", "20250102"])
+        (common, perDate) = Backfill(None, [], None).partition(graphs)
+        # the dataset and the lookup are built once
+        self.assertEqual(common[1], {"ds": set([]),
+                                     "ds.lookup": set(["ds"])})
+        # and are frozen inputs of each date
+        self.assertEqual(perDate["20250101"][1],
+                         {"ds.t_20250101": set(["ds", "ds.lookup"])})
+
+    def testBackfillRejectsSharedNameWithDatedDefinition(self):
+        # the query varies by date but the table name does not
+        graphs = self.loadBackfillGraphs({
+            "lookup": ("select '{yyyymmdd}' as d",
+                       {"table": "lookup", "yyyymmdd": 0})},
+            ["20250101", "20250102"])
+        with self.assertRaisesRegex(ValueError, "ds.lookup is defined "
+                                                "differently for 20250101 "
+                                                "and 20250102"):
+            Backfill(None, [], None).partition(graphs)
+
+    def testBackfillResumesFailedDates(self):
+        built = []
+        failing = set(["20250102"])
+
+        def buildDepend(folders, asOf=None):
+            date = asOf.strftime("%Y%m%d")
+            built.append(date)
+            key = "t_" + date
+            return ({key: self.makeBackfillResource(date not in failing)},
+                    {key: set([])})
+
+        builder = MagicMock()
+        builder.buildDepend.side_effect = buildDepend
+        with tempfile.TemporaryDirectory() as folder:
+            ledger = os.path.join(folder, "ledger.json")
+            backfill = Backfill(builder, ["f"], ledger, maxRetry=0)
+            failed = backfill.execute("20250101", "20250103",
+                                      checkFrequency=0)
+            self.assertEqual(failed, ["20250102"])
+            self.assertEqual(sorted(built),
+                             ["20250101", "20250102", "20250103"])
+            with open(ledger) as f:
+                self.assertEqual(json.load(f)["20250103"], "done")
+
+            failing.clear()
+            built.clear()
+            self.assertEqual(backfill.execute("20250101", "20250103",
+                                              checkFrequency=0), [])
+            self.assertEqual(built, ["20250102"])
+        self.assertIsNone(tmplhelper.asOf)
+
+    def testRecursiveDiscoveryHonoursFilters(self):
+        with tempfile.TemporaryDirectory() as root:
+            for relPath in ["a.querytemplate", "a.querytemplate.vars",
+                            "sub/b.querytemplate", "sub/c.view",
+                            "sub/skip/d.querytemplate",
+                            "scratch/e.querytemplate",
+                            ".git/f.querytemplate"]:
+                path = os.path.join(root, relPath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "w").close()
+            with open(os.path.join(root, "sub", ".bqm2ignore"), "w") as f:
+                f.write("# comment\nskip/\n")
+
+            loader = MagicMock()
+            loader.handles.side_effect = \
+                lambda f: f.split(".")[-1] in ["querytemplate", "view"]
+
+            def found(**kwargs):
+                builder = DependencyBuilder(loader, **kwargs)
+                return [os.path.relpath(f, root)
+                        for f in builder.discover(root)]
+
+            self.assertEqual(found(), ["a.querytemplate"])
+            self.assertEqual(found(recursive=True, exclude=["scratch"]),
+                             ["a.querytemplate", "sub/b.querytemplate",
+                              "sub/c.view"])
+            self.assertEqual(found(recursive=True, include=["sub/*"]),
+                             ["sub/b.querytemplate", "sub/c.view"])
+
+    def testLoadsDependOnExtractsWritingOverlappingUris(self):
+        def table(dataset, name):
+            t = MagicMock()
+            t.dataset_id = dataset
+            t.table_id = name
+            return t
+
+        extract = BqExtractTableResource(
+            table("ds", "t1"), MagicMock(), MagicMock(), None,
+            "gs://b/p/part-*.json", {})
+        load = BqGcsTableLoadResource(
+            table("other", "t1copy"), MagicMock(), MagicMock(), None,
+            "gs://b/p/*.json", (), {})
+        unrelated = BqGcsTableLoadResource(
+            table("other", "csvs"), MagicMock(), MagicMock(), None,
+            "gs://b/p/*.csv", (), {})
+
+        with tempfile.TemporaryDirectory() as root:
+            open(os.path.join(root, "a.gcsdata"), "w").close()
+            loader = MagicMock()
+            loader.handles.return_value = True
+            loader.load.return_value = [extract, load, unrelated]
+            (_, dependencies) = DependencyBuilder(loader).buildDepend([root])
+
+        self.assertEqual(dependencies[load.key()], set([extract.key()]))
+        self.assertEqual(dependencies[unrelated.key()], set([]))
+
+    def testSelectSubgraph(self):
+        dependencies = {"ds": set([]), "ds.a": set(["ds"]),
+                        "ds.b": set(["ds.a"]), "ds.c": set(["ds.b"]),
+                        "ds.other": set(["ds"])}
+        self.assertEqual(selectSubgraph(dependencies, ["ds.b"]),
+                         set(["ds.b"]))
+        self.assertEqual(selectSubgraph(dependencies, ["+ds.b"]),
+                         set(["ds", "ds.a", "ds.b"]))
+        self.assertEqual(selectSubgraph(dependencies, ["ds.b+"]),
+                         set(["ds.b", "ds.c"]))
+        self.assertEqual(selectSubgraph(dependencies, ["ds.[ab]", "ds.c"]),
+                         set(["ds.a", "ds.b", "ds.c"]))
+        self.assertRaises(ValueError, selectSubgraph, dependencies,
+                          ["nope+"])
+
+    def testFrozenInputsAreOnlyFingerprinted(self):
+        upstream = MagicMock()
+        upstream.updateTime.return_value = 1
+        upstream.fingerprint.return_value = "fp"
+        downstream = MagicMock()
+        downstream.isRunning.return_value = False
+        downstream.exists.return_value = True
+        downstream.shouldUpdate.return_value = False
+        de = DependencyExecutor({"a": upstream, "b": downstream},
+                                {"a": set([]), "b": set(["a"])})
+        downstream.recordedInputs.return_value = \
+            de.inputsFingerprint({"a": "fp"})
+        de.dependencies = restrictTo(de.dependencies, set(["b"]))
+        de.execute(checkFrequency=0)
+
+        downstream.create.assert_not_called()
+        upstream.isRunning.assert_not_called()
+        upstream.create.assert_not_called()
+
+    def testMissingFrozenInputIsAnError(self):
+        parent = MagicMock()
+        parent.exists.return_value = False
+        parent.updateTime.side_effect = Exception("404 d.parent")
+        child = MagicMock()
+        de = DependencyExecutor({"d.parent": parent, "d.child": child},
+                                {"d.parent": set([]),
+                                 "d.child": set(["d.parent"])})
+        de.dependencies = restrictTo(de.dependencies, set(["d.child"]))
+        with self.assertRaisesRegex(SelectionError,
+                                    "depend on missing d.parent, include "
+                                    "them in --select"):
+            de.execute(checkFrequency=0)
+        child.create.assert_not_called()
+
+    def testErrorsDuringARunAreNotSelectionErrors(self):
+        rsrc = MagicMock()
+        rsrc.isRunning.return_value = False
+        rsrc.exists.return_value = False
+        rsrc.create.side_effect = ValueError("bad template")
+        de = DependencyExecutor({"d.t": rsrc}, {"d.t": set([])})
+        de.checkFrozenInputs()
+        with self.assertRaises(ValueError) as raised:
+            de.execute(checkFrequency=0)
+        self.assertNotIsInstance(raised.exception, SelectionError)
+
+    def testPlanReportsResourcesWhichCantBeBuilt(self):
+        ok = MagicMock()
+        ok.plan.return_value = "load a as CSV"
+        bad = MagicMock()
+        bad.plan.side_effect = ValueError("ragged")
+        de = DependencyExecutor({"ds.a": ok, "ds.b": bad},
+                                {"ds.a": set([]), "ds.b": set(["ds.a"])})
+        self.assertEqual(de.levels(), [["ds.a"], ["ds.b"]])
+        self.assertEqual(de.plan(), 1)
+        bad.create.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
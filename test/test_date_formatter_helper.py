@@ -14,6 +14,12 @@ class Test(unittest.TestCase):
         except ValueError:
             pass
 
+    def test_formatters_unpadded_date(self):
+        m = {"yyyymmdd": "2024011"}
+        date_formatter_helper.helpers.format_all_date_keys(m)
+        self.assertEqual((m["yyyymmdd_yyyy"], m["yyyymmdd_mm"],
+                          m["yyyymmdd_dd"]), ("2024", "01", "01"))
+
     def test_formatters_show_new_keys(self):
         self.assertEqual(set(["yyyymm_yyyy", "yyyymm_mm"]), date_formatter_helper.helpers.show_new_keys(["yyyymm"]))
         self.assertEqual(set(["foo_yyyymm_yyyy", "foo_yyyymm_mm"]),
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from mock import patch
+
+import filehash
+from filehash import FileHashCache, hashFile, SIDECAR
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.folder.name, "a.localdata")
+        with open(self.file, "w") as f:
+            f.write("a\tb\n")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def testHashFile(self):
+        self.assertEqual(hashFile(self.file, "md5"),
+                         hashlib.md5(b"a\tb\n").hexdigest())
+        empty = os.path.join(self.folder.name, "empty")
+        open(empty, "w").close()
+        self.assertEqual(hashFile(empty),
+                         hashlib.blake2b(digest_size=20).hexdigest())
+
+    def testUnchangedFileIsNotRehashed(self):
+        cache = FileHashCache()
+        expected = cache.digest(self.file)
+        cache.flush()
+
+        # a new cache i.e. the next run reads the sidecar
+        cache = FileHashCache()
+        with patch.object(filehash, "hashFile") as hashed:
+            self.assertEqual(cache.digest(self.file), expected)
+            hashed.assert_not_called()
+        self.assertTrue(os.path.exists(os.path.join(self.folder.name,
+                                                    SIDECAR)))
+
+    def testChangedFileIsRehashed(self):
+        cache = FileHashCache(persist=False)
+        before = cache.digest(self.file)
+        with open(self.file, "a") as f:
+            f.write("c\td\n")
+        self.assertNotEqual(cache.digest(self.file), before)
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name,
+                                                     SIDECAR)))
+
+    def testSidecarIsSavedOncePerFlush(self):
+        other = os.path.join(self.folder.name, "b.localdata")
+        with open(other, "w") as f:
+            f.write("c\td\n")
+        cache = FileHashCache()
+        with patch.object(cache, "save") as save:
+            cache.digest(self.file)
+            cache.digest(other)
+            cache.digest(self.file, "md5")
+            save.assert_not_called()
+            cache.flush()
+            save.assert_called_once_with(os.path.abspath(self.folder.name))
+            cache.flush()
+            self.assertEqual(save.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
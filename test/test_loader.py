@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 import unittest
 
 from google.cloud.bigquery.client import Client
@@ -12,7 +14,8 @@ import logging
 
 from loader import DelegatingFileSuffixLoader, FileLoader, \
     parseDatasetTable, \
-    parseDataset, BqQueryTemplatingFileLoader, TableType, loadSchemaFromString
+    parseDataset, BqQueryTemplatingFileLoader, TableType, loadSchemaFromString, \
+    SchemaCache
 from resource import BqJobs, BqViewBackedTableResource, \
     BqQueryBackedTableResource
 
@@ -143,7 +146,7 @@ class Test(unittest.TestCase):
 
     def test_DelegatingFileLoaderParseSuffix(self):
         aLoader = FileLoader()
-        def f(file):
+        def f(file, root=None):
             return True
         aLoader.load = f
         self.assertTrue(DelegatingFileSuffixLoader(query=aLoader).load("nosuffixfile.query"))
@@ -374,6 +377,94 @@ class Test(unittest.TestCase):
         log.info("expect string: " + expectedStr)
         self.assertEquals(expectedStr.lower(), actualStr)
 
+    def testFolderGlobalVarsAreLayered(self):
+        defaultVars = {"dataset": "adataset", "project": "aproject",
+                       "color": "red", "size": "big"}
+        ldr = BqQueryTemplatingFileLoader(MagicMock(), MagicMock(),
+                                          MagicMock(), TableType.VIEW,
+                                          defaultVars)
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "global.vars"), "w") as f:
+                json.dump({"color": "blue", "shape": "{size}_box"}, f)
+            scope = ldr.folderScope(folder)
+            self.assertIs(scope, ldr.folderScope(folder))
+
+            result = list(BqQueryTemplatingFileLoader.iterTemplateVarsArray(
+                [{"size": ["small", "tiny"]}, {}], "afolder", "afile",
+                scope))
+        self.assertEqual([(r["color"], r["shape"]) for r in result],
+                         [("blue", "small_box"), ("blue", "tiny_box"),
+                          ("blue", "big_box")])
+        # the resolved layers are shared, not copied, and the defaults
+        # are never written to
+        for r in result:
+            self.assertIs(r.maps[-1], result[0].maps[-1])
+        self.assertEqual(defaultVars, {"dataset": "adataset",
+                                       "project": "aproject",
+                                       "color": "red", "size": "big"})
+
+    def testNestedFolderGlobalVarsAreInherited(self):
+        ldr = BqQueryTemplatingFileLoader(MagicMock(), MagicMock(),
+                                          MagicMock(), TableType.VIEW,
+                                          {"dataset": "adataset",
+                                           "color": "red"})
+        with tempfile.TemporaryDirectory() as root:
+            nested = os.path.join(root, "a", "b")
+            os.makedirs(nested)
+            with open(os.path.join(root, "global.vars"), "w") as f:
+                json.dump({"color": "blue", "size": "big"}, f)
+            with open(os.path.join(nested, "global.vars"), "w") as f:
+                json.dump({"size": "small"}, f)
+            scope = ldr.folderScope(nested, root + "/")
+            self.assertEqual((scope["color"], scope["size"],
+                              scope["dataset"]),
+                             ("blue", "small", "adataset"))
+            self.assertEqual(ldr.folderScope(os.path.join(root, "a"),
+                                             root)["size"], "big")
+            # without a root only the folder's own global.vars is used
+            self.assertEqual(ldr.folderScope(nested)["color"], "red")
+
+    def testJsonLinesVarsAreStreamed(self):
+        ldr = BqQueryTemplatingFileLoader(MagicMock(), MagicMock(),
+                                          MagicMock(), TableType.VIEW, {})
+        with tempfile.TemporaryDirectory() as folder:
+            varsFile = os.path.join(folder, "a.querytemplate.vars")
+            with open(varsFile, "w") as f:
+                f.write('\n{"customer": "a"}\n\n{"customer": "b"}\n'
+                        'not json\n')
+            entries = ldr.iterTemplateVars(varsFile)
+            # entries are available before the rest of the file is read
+            self.assertEqual(next(entries), {"customer": "a"})
+            self.assertEqual(next(entries), {"customer": "b"})
+            with self.assertRaises(Exception) as e:
+                next(entries)
+            self.assertIn("line 5", str(e.exception))
+
+            with open(varsFile, "w") as f:
+                f.write(' [{"customer": "a"}]')
+            self.assertEqual(ldr.loadTemplateVars(varsFile),
+                             [{"customer": "a"}])
+
+    def testSchemaCacheParsesEachSchemaOnce(self):
+        cache = SchemaCache()
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, name + ".schema")
+                     for name in ["a", "b"]]
+            for path in paths:
+                with open(path, "w") as f:
+                    f.write("a:int,b:string\n")
+            schema = cache.load(paths[0])
+            self.assertIsInstance(schema, tuple)
+            self.assertEqual([f.name for f in schema], ["a", "b"])
+            self.assertIs(cache.load(paths[0]), schema)
+            # same content in another file
+            self.assertIs(cache.load(paths[1]), schema)
+
+            with open(paths[1], "w") as f:
+                f.write("c:float")
+            self.assertEqual([f.name for f in cache.load(paths[1])], ["c"])
+
+
 if __name__ == '__main__':
     import sys
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
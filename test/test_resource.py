@@ -1,20 +1,29 @@
+import io
+import json
+import os
+import tempfile
 import unittest
+import zlib
+from datetime import datetime, timedelta
 from unittest import TestCase
 from unittest.mock import Mock
 
 import mock
 from google.api_core.page_iterator import Iterator
+from google.cloud.bigquery import ExternalConfig
 from google.cloud.bigquery.client import Client
 from google.cloud.bigquery.dataset import Dataset
 from google.cloud.bigquery.job import QueryJob, SourceFormat, \
     WriteDisposition
 from google.cloud.bigquery.table import Table
+from google.cloud.exceptions import NotFound
 
+import loader
 import resource
 from resource import strictSubstring, Resource, \
     BqDatasetBackedResource, BqViewBackedTableResource, \
     BqQueryBasedResource, BqJobs, BqDataLoadTableResource, \
-    processLoadTableOptions
+    processLoadTableOptions, BqProcessTableResource
 
 
 class Test(unittest.TestCase):
@@ -210,6 +219,773 @@ group each by id, description, url
         self.assertEquals(jobs.tableToJobMap['p:d:t'], job)
 
 
+    def testShouldUpdateDoesNotWriteDescription(self):
+        client = Mock()
+        client.get_table.return_value.description = None
+        rsrc = BqDataLoadTableResource("afile", Mock(), (), client, None)
+        rsrc.makeHashTag = Mock(return_value="filehash:a:b")
+
+        self.assertTrue(rsrc.shouldUpdate())
+        client.update_table.assert_not_called()
+
+        rsrc.stampMetadata()
+        client.update_table.assert_called_once()
+        self.assertEqual(client.get_table.return_value.description,
+                         "Do not edit\nfilehash:a:b")
+
+    def makeTable(self, tableId: str, **attrs) -> tuple:
+        """ :return: (table, client) where table is a Mock of
+        adataset.tableId with attrs set, as client.get_table returns it
+        and client.update_table writes it """
+        table = Mock()
+        table.project = "aproject"
+        table.dataset_id = "adataset"
+        table.table_id = tableId
+        table.description = None
+        for (k, v) in attrs.items():
+            setattr(table, k, v)
+        client = Mock()
+        client.get_table.return_value = table
+        client.update_table.side_effect = lambda t, fields: t
+        return (table, client)
+
+    def recordLoads(self, client) -> list:
+        """ fakes client.load_table_from_file, each load reading its
+        stream into the list returned """
+        loaded = []
+
+        def load(stream, table, job_config=None):
+            loaded.append(stream.read())
+            return Mock(job_id="j1", error_result=None)
+
+        client.load_table_from_file.side_effect = load
+        return loaded
+
+    def testBashTemplateRunsInTheBackground(self):
+        (table, client) = self.makeTable("bash_background")
+        client.load_table_from_file.return_value.running.return_value = \
+            False
+        rsrc = BqProcessTableResource(
+            "#!/bin/bash\nsleep 0.5\necho '{\"a\": 1}'\n", table, (),
+            client, None)
+
+        rsrc.create()
+        # the script is still running so nothing has been loaded yet
+        self.assertTrue(rsrc.isRunning())
+        client.load_table_from_file.assert_not_called()
+
+        rsrc.pending.result(timeout=10)
+        self.assertFalse(rsrc.isRunning())
+        client.load_table_from_file.assert_called_once()
+        self.assertEqual(
+            client.load_table_from_file.call_args[1]["job_config"]
+            .source_format, SourceFormat.NEWLINE_DELIMITED_JSON)
+
+    def testBashTemplateStreamsOutput(self):
+        (table, client) = self.makeTable("bash_streaming")
+        uploaded = []
+
+        def upload(stream, table, job_config=None):
+            # read as a resumable upload does
+            while True:
+                chunk = stream.read(4096)
+                uploaded.append(chunk)
+                if len(chunk) < 4096:
+                    break
+            return Mock()
+
+        client.load_table_from_file.side_effect = upload
+        script = "#!/bin/bash\nfor i in $(seq 1 2000); do " \
+                 "echo \"$i\tsome text\"; done\n"
+        rsrc = BqProcessTableResource(script, table, (), client, None,
+                                      streaming=True, gzip=True)
+        rsrc.create()
+        rsrc.pending.result(timeout=10)
+
+        self.assertFalse(rsrc.scriptFailed)
+        self.assertEqual(
+            client.load_table_from_file.call_args[1]["job_config"]
+            .source_format, SourceFormat.CSV)
+        lines = zlib.decompress(b"".join(uploaded), wbits=31).split(b"\n")
+        self.assertEqual(lines[0], b"1\tsome text")
+        self.assertEqual(lines[1999], b"2000\tsome text")
+
+        # a failing script never completes its upload
+        uploaded.clear()
+        rsrc = BqProcessTableResource("#!/bin/bash\necho a\nexit 1\n",
+                                      table, (), client, None,
+                                      streaming=True)
+        rsrc.create()
+        self.assertIsNone(rsrc.pending.result(timeout=10))
+        self.assertTrue(rsrc.scriptFailed)
+
+    def testScriptOutputReadsNeverExceedTheSizeAsked(self):
+        process = Mock()
+        process.stdout = io.BytesIO(b"efgh")
+        process.wait.return_value = 0
+        # a head larger than the first read asks for
+        stream = resource.ScriptOutputStream(process, b"abcd")
+        self.assertEqual(stream.read(3), b"abc")
+        self.assertEqual(stream.read(3), b"def")
+        self.assertEqual(stream.read(3), b"gh")
+        self.assertEqual(stream.tell(), 8)
+        whole = resource.ALGORITHMS["blake2b"]()
+        whole.update(b"abcdefgh")
+        self.assertEqual(stream.digest(), whole.hexdigest())
+
+    def testChunkedLocalDataIsCommittedAtomically(self):
+        (table, client) = self.makeTable("atable")
+        client.copy_table.return_value.running.return_value = False
+        client.copy_table.return_value.error_result = None
+        uploaded = {}
+
+        def upload(stream, table, size=None, job_config=None):
+            uploaded[stream.f.tell() - size] = stream.read()
+            job = Mock()
+            job.running.return_value = False
+            job.error_result = None
+            return job
+
+        client.load_table_from_file.side_effect = upload
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "adataset.atable.localdata")
+            with open(path, "w") as f:
+                for i in range(100):
+                    f.write(json.dumps({"i": i}) + "\n")
+            rsrc = BqDataLoadTableResource(path, table, (), client, None,
+                                           chunkBytes=300)
+            rsrc.create()
+            for f in rsrc.uploads:
+                f.result(timeout=10)
+
+            # every chunk is whole lines and together they are the file
+            with open(path, "rb") as f:
+                content = f.read()
+            self.assertGreater(len(uploaded), 1)
+            self.assertEqual(b"".join([uploaded[k]
+                                       for k in sorted(uploaded)]), content)
+            for chunk in uploaded.values():
+                self.assertTrue(chunk.endswith(b"\n"))
+
+        staging = client.load_table_from_file.call_args[0][1]
+        self.assertIn("atable_bqm2staging_", staging.table_id)
+        client.create_table.assert_called_once_with(staging)
+        self.assertLessEqual(staging.expires.replace(tzinfo=None),
+                             datetime.now() + timedelta(days=1))
+        self.assertFalse(rsrc.isRunning())
+        copy = client.copy_table.call_args
+        self.assertEqual(copy[0], (staging, table))
+        self.assertEqual(copy[1]["job_config"].write_disposition,
+                         WriteDisposition.WRITE_TRUNCATE)
+        client.delete_table.assert_called_once_with(staging,
+                                                    not_found_ok=True)
+        self.assertIs(rsrc.job, client.copy_table.return_value)
+
+    def testIdenticalBashOutputIsNotReloaded(self):
+        for streaming in [False, True]:
+            (table, client) = self.makeTable("bash_identical")
+            loaded = self.recordLoads(client)
+            rsrc = BqProcessTableResource("#!/bin/bash\necho 'a\tb'\n",
+                                          table, (), client, None,
+                                          streaming=streaming)
+            rsrc.create()
+            rsrc.pending.result(timeout=10)
+            rsrc.stampMetadata()
+            self.assertEqual(len(loaded), 1)
+            fingerprint = rsrc.fingerprint()
+            self.assertTrue(fingerprint.startswith("outputhash:"))
+
+            # run again with the same output
+            rsrc.create()
+            rsrc.pending.result(timeout=10)
+            rsrc.stampMetadata()
+            self.assertEqual(len(loaded), 1)
+            self.assertIsNone(rsrc.job)
+            self.assertIn("outputhash:", table.description)
+            self.assertEqual(rsrc.fingerprint(), fingerprint)
+
+    def testStreamedOutputBeyondAChunkIsAlwaysUploaded(self):
+        (table, client) = self.makeTable("bash_large")
+        loaded = self.recordLoads(client)
+        # about 110kb, more than a single chunk
+        script = "#!/bin/bash\nfor i in $(seq 1 20000); do " \
+                 "echo \"$i\ta\"; done\n"
+        rsrc = BqProcessTableResource(script, table, (), client, None,
+                                      streaming=True)
+        chunkBytes = resource.streamChunkBytes
+        resource.streamChunkBytes = 1
+        try:
+            for i in range(2):
+                rsrc.create()
+                rsrc.pending.result(timeout=10)
+                rsrc.stampMetadata()
+        finally:
+            resource.streamChunkBytes = chunkBytes
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded[0], loaded[1])
+        # its hash is still recorded so dependants aren't re-run
+        h = resource.ALGORITHMS["blake2b"]()
+        h.update(loaded[0])
+        self.assertEqual(
+            resource.parseDescriptionTag(table.description, "outputhash"),
+            h.hexdigest())
+
+    def testGcsListingsAreSharedUntilInvalidated(self):
+        cache = resource.GcsListingCache()
+        gcs = Mock()
+        blob = Mock()
+        blob.name = "exports/t1/part-000.json"
+        nested = Mock()
+        nested.name = "exports/t1/sub/part-001.json"
+        gcs.bucket.return_value.list_blobs.return_value = [blob, nested]
+
+        self.assertEqual(cache.list(gcs, "b", "exports/t1/"),
+                         [blob, nested])
+        self.assertEqual(cache.list(gcs, "b", "exports/t1/"),
+                         [blob, nested])
+        # a prefix under one listed is answered from its listing
+        self.assertEqual(cache.list(gcs, "b", "exports/t1/sub/"), [nested])
+        self.assertEqual(gcs.bucket.return_value.list_blobs.call_count, 1)
+        # listed without a delimiter so nested objects are included
+        gcs.bucket.return_value.list_blobs.assert_called_once_with(
+            prefix="exports/t1/")
+
+        # answered from the listing
+        self.assertTrue(cache.blobExists(gcs, "b",
+                                         "exports/t1/part-000.json"))
+        self.assertTrue(cache.blobExists(gcs, "b",
+                                         "exports/t1/sub/part-001.json"))
+        self.assertFalse(cache.blobExists(gcs, "b",
+                                          "exports/t1/part-002.json"))
+        gcs.bucket.return_value.blob.assert_not_called()
+        # not covered by a listing
+        cache.blobExists(gcs, "b", "exports/t2/x.json")
+        cache.blobExists(gcs, "b", "exports/t2/x.json")
+        self.assertEqual(gcs.bucket.return_value.blob.call_count, 1)
+
+        cache.invalidate("b", "exports/")
+        cache.list(gcs, "b", "exports/t1/")
+        self.assertEqual(gcs.bucket.return_value.list_blobs.call_count, 2)
+        cache.blobExists(gcs, "b", "exports/t2/x.json")
+        self.assertEqual(gcs.bucket.return_value.blob.call_count, 2)
+
+    def fakeGcsObjects(self, gcs) -> dict:
+        """ backs gcs.bucket().blob() with a dict of object contents
+        keyed by path """
+        stored = {}
+
+        class Blob:
+            def __init__(self, path):
+                self.path = path
+
+            def download_as_bytes(self):
+                if self.path not in stored:
+                    raise NotFound(self.path)
+                return stored[self.path]
+
+            def upload_from_string(self, data, content_type=None):
+                stored[self.path] = data.encode("utf-8")
+
+            def delete(self):
+                if self.path not in stored:
+                    raise NotFound(self.path)
+                del stored[self.path]
+
+        gcs.bucket.return_value.blob.side_effect = Blob
+        return stored
+
+    def testIncrementalGcsLoadAppendsOnlyNewObjects(self):
+        def blob(name, generation):
+            b = Mock()
+            b.name = name
+            b.generation = generation
+            b.md5_hash = "md5-" + str(generation)
+            b.size = 100
+            return b
+
+        (table, bq) = self.makeTable("drops", num_rows=10)
+        gcs = Mock()
+        stored = self.fakeGcsObjects(gcs)
+        bq.load_table_from_uri.return_value.error_result = None
+        bq.load_table_from_uri.return_value.job_id = "load-1"
+        # the wildcard spans folders
+        blobs = [blob("drops/h00.json", 1), blob("drops/d2/h01.json", 2)]
+        gcs.bucket.return_value.list_blobs.side_effect = \
+            lambda prefix: [b for b in blobs if b.name.startswith(prefix)]
+
+        def run(rsrc):
+            resource.gcsListings.invalidate("b", "drops/")
+            rsrc.invalidate()
+            rsrc.create()
+            # the load adds rows
+            table.num_rows += 5
+            rsrc.invalidate()
+            rsrc.stampMetadata("inputs-1")
+            rsrc.invalidate()
+            (args, kwargs) = bq.load_table_from_uri.call_args
+            return (args[0], kwargs["job_config"].write_disposition)
+
+        def load():
+            return resource.BqGcsTableLoadResource(
+                table, bq, gcs, None, "gs://b/drops/*.json", (), {},
+                incremental=True, fullRefreshEvery=2)
+
+        resource.gcsLedger.entries.clear()
+        rsrc = load()
+        # nothing recorded so everything is loaded
+        self.assertEqual(run(rsrc), (
+            ["gs://b/drops/d2/h01.json", "gs://b/drops/h00.json"],
+            WriteDisposition.WRITE_TRUNCATE))
+        ledger = json.loads(stored["_bqm2ledgers/adataset.drops.json"])
+        self.assertEqual(sorted(ledger["objects"]),
+                         ["gs://b/drops/d2/h01.json",
+                          "gs://b/drops/h00.json"])
+        # the ledger lives in gcs so a fresh run sees it
+        resource.gcsLedger.entries.clear()
+        resource.gcsListings.invalidate("b", "drops/")
+        self.assertFalse(load().shouldUpdate())
+        self.assertEqual(rsrc.recordedInputs(), "inputs-1")
+        self.assertEqual(table.description, "jobid:load-1\ninputs:inputs-1")
+
+        # a new hourly drop is appended on its own
+        blobs.append(blob("drops/d3/h02.json", 3))
+        resource.gcsListings.invalidate("b", "drops/")
+        self.assertTrue(rsrc.shouldUpdate())
+        self.assertEqual(run(rsrc), (
+            ["gs://b/drops/d3/h02.json"],
+            WriteDisposition.WRITE_APPEND))
+
+        # an object rewritten since it was loaded means a reload
+        blobs[0] = blob("drops/h00.json", 4)
+        self.assertEqual(run(rsrc)[1], WriteDisposition.WRITE_TRUNCATE)
+
+        # as does reaching the number of appends to compact after
+        for i in [5, 6]:
+            blobs.append(blob("drops/h0{}.json".format(i), i))
+            self.assertEqual(run(rsrc)[1], WriteDisposition.WRITE_APPEND)
+        blobs.append(blob("drops/h07.json", 7))
+        self.assertEqual(run(rsrc), (
+            sorted(["gs://b/" + b.name for b in blobs]),
+            WriteDisposition.WRITE_TRUNCATE))
+
+        # rows changed by something other than our loads
+        table.num_rows = 3
+        resource.gcsListings.invalidate("b", "drops/")
+        self.assertIn("outside", rsrc.plan())
+
+    def testBucketRootWildcardSkipsLedgersAndMarkers(self):
+        (table, bq) = self.makeTable("drops")
+        gcs = Mock()
+        blobs = []
+        for name in ["h00.json", "d/h01.json",
+                     "_bqm2ledgers/adataset.drops.json",
+                     "_bqm2markers/exports/part-_.json/_SUCCESS"]:
+            blob = Mock()
+            blob.name = name
+            blob.size = 10
+            blobs.append(blob)
+        gcs.bucket.return_value.list_blobs.side_effect = \
+            lambda prefix: [b for b in blobs if b.name.startswith(prefix)]
+        resource.gcsListings.invalidate("b", "")
+
+        rsrc = resource.BqGcsTableLoadResource(
+            table, bq, gcs, None, "gs://b/*", (), {}, incremental=True)
+        self.assertEqual(sorted(rsrc.listObjects()),
+                         ["gs://b/d/h01.json", "gs://b/h00.json"])
+        # not handed to bigquery as a wildcard which would match them
+        self.assertEqual(rsrc.sources(["gs://b/*"]),
+                         [("gs://b/h00.json", 10), ("gs://b/d/h01.json", 10)])
+        self.assertEqual(rsrc.sources(["gs://b/d/*"]), [("gs://b/d/*", 10)])
+
+    def testGcsLoadExpirationIsSetWhenStamped(self):
+        (table, bq) = self.makeTable("drops", expires=None)
+        rsrc = resource.BqGcsTableLoadResource(
+            table, bq, Mock(), None, "gs://b/drops/*.json", (),
+            {"expiration": "2"})
+
+        # probing never writes
+        self.assertTrue(rsrc.exists())
+        bq.update_table.assert_not_called()
+
+        rsrc.job = Mock()
+        rsrc.job.error_result = None
+        rsrc.job.job_id = "load-1"
+        rsrc.stampMetadata()
+        (args, _) = bq.update_table.call_args
+        self.assertEqual(args[1], ["description", "expires"])
+        self.assertIsNotNone(table.expires)
+
+    def testQueryTableExpirationIsSetWhenStamped(self):
+        (table, bq) = self.makeTable("daily", expires=None)
+        bq.query.return_value = Mock(job_id="q1", error_result=None)
+        rsrc = resource.BqQueryBackedTableResource(
+            ["select 1"], table, bq, None, expiration=2)
+        rsrc.create()
+        bq.query.return_value.add_done_callback.assert_not_called()
+        bq.update_table.assert_not_called()
+
+        rsrc.invalidate()
+        rsrc.stampMetadata()
+        bq.update_table.assert_called_once()
+        self.assertEqual(bq.update_table.call_args[0][1],
+                         ["description", "expires"])
+        self.assertIsNotNone(table.expires)
+
+    def testBatchSourcesWithinLimits(self):
+        sources = [("gs://b/a", 5), ("gs://b/b", 5), ("gs://b/c", 5),
+                   ("gs://b/d", 30), ("gs://b/e", 1)]
+        self.assertEqual(resource.batchSources(sources, 2, 100),
+                         [["gs://b/a", "gs://b/b"], ["gs://b/c", "gs://b/d"],
+                          ["gs://b/e"]])
+        self.assertEqual(resource.batchSources(sources, 10, 12),
+                         [["gs://b/a", "gs://b/b"], ["gs://b/c"],
+                          ["gs://b/d"], ["gs://b/e"]])
+
+    def testGcsLoadBeyondLimitsIsBatchedThroughStaging(self):
+        (table, bq) = self.makeTable("many")
+        gcs = Mock()
+        blobs = []
+        for i in range(5):
+            blob = Mock()
+            blob.name = "many/part-{}.json".format(i)
+            blob.size = 10
+            blobs.append(blob)
+        gcs.bucket.return_value.list_blobs.return_value = blobs
+        query = "\n".join(["gs://b/" + b.name for b in blobs])
+        loads = [Mock(), Mock(), Mock()]
+        for load in loads:
+            load.error_result = None
+            load.running.return_value = False
+        bq.load_table_from_uri.side_effect = loads
+        bq.create_table.side_effect = lambda t: t
+        bq.copy_table.return_value.error_result = None
+        bq.copy_table.return_value.running.return_value = False
+
+        resource.gcsListings.invalidate("b", "many/")
+        with mock.patch.object(resource, "MAX_LOAD_URIS", 2):
+            rsrc = resource.BqGcsTableLoadResource(
+                table, bq, gcs, None, query, (), {})
+            self.assertIn("3 batches", rsrc.plan())
+            rsrc.create()
+
+        staging = bq.create_table.call_args[0][0]
+        self.assertIn("many_bqm2staging_", staging.table_id)
+        self.assertIsNotNone(staging.expires)
+        self.assertEqual([c[0][0] for c in
+                          bq.load_table_from_uri.call_args_list],
+                         [["gs://b/many/part-0.json",
+                           "gs://b/many/part-1.json"],
+                          ["gs://b/many/part-2.json",
+                           "gs://b/many/part-3.json"],
+                          ["gs://b/many/part-4.json"]])
+        for c in bq.load_table_from_uri.call_args_list:
+            self.assertEqual(c[0][1], staging)
+            self.assertEqual(c[1]["job_config"].write_disposition,
+                             WriteDisposition.WRITE_APPEND)
+
+        # nothing is committed until every batch has loaded
+        loads[1].running.return_value = True
+        self.assertTrue(rsrc.isRunning())
+        bq.copy_table.assert_not_called()
+        loads[1].running.return_value = False
+        self.assertFalse(rsrc.isRunning())
+        (args, kwargs) = bq.copy_table.call_args
+        self.assertEqual(args, (staging, table))
+        self.assertEqual(kwargs["job_config"].write_disposition,
+                         WriteDisposition.WRITE_TRUNCATE)
+        bq.delete_table.assert_called_once_with(staging, not_found_ok=True)
+
+    def testSingleObjectLoadIsNotListed(self):
+        (table, bq) = self.makeTable("one")
+        gcs = Mock()
+        resource.gcsListings.invalidate("b", "")
+        rsrc = resource.BqGcsTableLoadResource(
+            table, bq, gcs, None, "gs://b/d/one.json", (), {})
+        self.assertEqual(rsrc.plan(), "load 1 uris")
+        rsrc.create()
+        self.assertEqual(bq.load_table_from_uri.call_args[0][0],
+                         ["gs://b/d/one.json"])
+        gcs.bucket.return_value.list_blobs.assert_not_called()
+
+    def testFailedGcsLoadBatchIsNotCommitted(self):
+        (table, bq) = self.makeTable("many")
+        gcs = Mock()
+        blob = Mock()
+        blob.name = "many/part-0.json"
+        blob.size = 10
+        gcs.bucket.return_value.list_blobs.return_value = [blob]
+        failed = Mock()
+        failed.running.return_value = False
+        failed.error_result = {"reason": "invalid"}
+        ok = Mock()
+        ok.running.return_value = False
+        ok.error_result = None
+        bq.load_table_from_uri.side_effect = [ok, failed]
+
+        resource.gcsListings.invalidate("b", "many/")
+        # explicit uris are sized from a listing the run already has
+        resource.gcsListings.list(gcs, "b", "many/")
+        with mock.patch.object(resource, "MAX_LOAD_BYTES", 15):
+            rsrc = resource.BqGcsTableLoadResource(
+                table, bq, gcs, None,
+                "gs://b/many/part-0.json\ngs://b/many/part-0.json", (), {})
+            rsrc.create()
+        self.assertFalse(rsrc.isRunning())
+        bq.copy_table.assert_not_called()
+        self.assertIs(rsrc.job, failed)
+        bq.delete_table.assert_called_once()
+
+    def testUrisOverlap(self):
+        overlap = resource.urisOverlap
+        self.assertTrue(overlap("gs://b/p/*.json", "gs://b/p/part-*.json"))
+        self.assertTrue(overlap("gs://b/p/part-*.json", "gs://b/p/*"))
+        self.assertTrue(overlap("gs://b/p/part-1.json", "gs://b/p/*.json"))
+        self.assertTrue(overlap("gs://b/p/x.json", "gs://b/p/x.json"))
+        self.assertFalse(overlap("gs://b/p/*.json", "gs://b/p/*.csv"))
+        self.assertFalse(overlap("gs://b/p/*.json", "gs://b/q/*.json"))
+        self.assertFalse(overlap("gs://b/p/*.json", "gs://c/p/*.json"))
+        self.assertFalse(overlap("gs://b/p/a.json", "gs://b/p/a*a.json"))
+
+    def testUriIndexLookup(self):
+        index = resource.UriIndex()
+        index.add("gs://b/exports/t1/part-*.json", "extract.t1")
+        index.add("gs://b/exports/t2/*.json", "extract.t2")
+        index.add("gs://b/exports/t1/manifest.txt", "extract.m")
+        index.add("gs://other/exports/t1/*.json", "extract.o")
+
+        self.assertEqual(index.lookup("gs://b/exports/t1/*.json"),
+                         ["extract.t1"])
+        self.assertEqual(index.lookup("gs://b/exports/*"),
+                         ["extract.m", "extract.t1", "extract.t2"])
+        self.assertEqual(index.lookup("gs://b/exports/t2/x.json"),
+                         ["extract.t2"])
+        self.assertEqual(index.lookup("gs://b/exports/t3/*.json"), [])
+
+    def testExtractFreshnessIsReadFromItsMarker(self):
+        part = Mock()
+        part.name = "exports/t1/part-000.json"
+        part.generation = 7
+        part.size = 10
+        part.updated = datetime(2026, 1, 2)
+        gcs = Mock()
+        stored = self.fakeGcsObjects(gcs)
+        gcs.bucket.return_value.list_blobs.return_value = [part]
+        (table, bq) = self.makeTable("t1", modified=datetime(2026, 1, 1))
+        bq.extract_table.return_value.error_result = None
+        bq.extract_table.return_value.job_id = "extract-1"
+
+        rsrc = resource.BqExtractTableResource(
+            table, bq, gcs, None, "gs://b/exports/t1/part-*.json", {})
+        # the files alone are not a complete extract
+        self.assertFalse(rsrc.exists())
+        self.assertEqual(rsrc.updateTime(), 0)
+
+        rsrc.create()
+        rsrc.invalidate()
+        self.assertFalse(rsrc.exists())
+        rsrc.stampMetadata("inputs-1")
+        rsrc.invalidate()
+
+        marker = json.loads(
+            stored["_bqm2markers/exports/t1/part-_.json/_SUCCESS"])
+        self.assertEqual(marker["jobid"], "extract-1")
+        self.assertEqual(marker["files"],
+                         [["exports/t1/part-000.json", 7, 10]])
+        gcs.bucket.return_value.list_blobs.reset_mock()
+        self.assertTrue(rsrc.exists())
+        self.assertFalse(rsrc.shouldUpdate())
+        self.assertEqual(rsrc.recordedInputs(), "inputs-1")
+        self.assertEqual(rsrc.updateTime(),
+                         int(part.updated.timestamp() * 1000))
+        self.assertTrue(len(rsrc.fingerprint()))
+        # answered by the marker alone
+        gcs.bucket.return_value.list_blobs.assert_not_called()
+
+        table.modified = datetime(2026, 1, 3)
+        self.assertTrue(rsrc.shouldUpdate())
+        # a new extract removes the marker until it completes
+        rsrc.create()
+        rsrc.invalidate()
+        self.assertFalse(rsrc.exists())
+
+    def testFingerprintIgnoresMetadataOnlyUpdates(self):
+        (table, bq) = self.makeTable("t1", num_rows=10, num_bytes=100,
+                                     modified=datetime(2026, 1, 1))
+        rsrc = resource.BqTableBasedResource(table, bq)
+
+        fingerprint = rsrc.fingerprint()
+        # e.g. setting an expiration
+        table.modified = datetime(2026, 1, 2)
+        rsrc.invalidate()
+        self.assertEqual(rsrc.fingerprint(), fingerprint)
+        table.num_rows = 11
+        rsrc.invalidate()
+        self.assertNotEqual(rsrc.fingerprint(), fingerprint)
+
+        bq.get_table.side_effect = NotFound("t1")
+        rsrc.invalidate()
+        self.assertRaises(NotFound, rsrc.fingerprint)
+
+    def testExternalTableStampsInputs(self):
+        (table, bq) = self.makeTable("ext", schema=None)
+        bq.create_table.side_effect = lambda t: t
+        config = ExternalConfig("NEWLINE_DELIMITED_JSON")
+        config.autodetect = True
+        config.source_uris = ["gs://b/ext/*.json"]
+
+        rsrc = resource.BqExternalTableBasedResource(bq, table, config)
+        rsrc.create()
+        rsrc.invalidate()
+        # not stamped until its post run hook
+        self.assertTrue(rsrc.shouldUpdate())
+        rsrc.stampMetadata("inputs-1")
+        rsrc.invalidate()
+        self.assertFalse(rsrc.shouldUpdate())
+        self.assertEqual(rsrc.recordedInputs(), "inputs-1")
+
+    def testFailedBashTemplateIsNotStamped(self):
+        (table, client) = self.makeTable("bash_failing")
+        rsrc = BqProcessTableResource("#!/bin/bash\nexit 3\n", table, (),
+                                      client, None)
+        rsrc.create()
+        rsrc.pending.result(timeout=10)
+        self.assertFalse(rsrc.isRunning())
+        client.load_table_from_file.assert_not_called()
+        # only the wipe of the description before the script ran
+        rsrc.stampMetadata()
+        client.update_table.assert_called_once_with(table, ["description"])
+
+    def testUnloadableBashOutputFailsTheResource(self):
+        (table, client) = self.makeTable("bash_ragged")
+        script = "#!/bin/bash\nprintf 'a,b\\nc\\nd;e;f\\n'\n"
+        for streaming in [False, True]:
+            rsrc = BqProcessTableResource(script, table, (), client, None,
+                                          streaming=streaming,
+                                          sniffFormat=True)
+            rsrc.create()
+            with self.assertRaises(resource.ResourceFailed):
+                rsrc.pending.result(timeout=10)
+            with self.assertRaises(resource.ResourceFailed):
+                rsrc.isRunning()
+            self.assertFalse(rsrc.isRunning())
+        client.load_table_from_file.assert_not_called()
+
+    def testParseDescriptionTagIgnoresQueryText(self):
+        description = "\n".join(["/**", "select 'inputs:no' as x", "*/",
+                                  "queryhash:abc", "jobid:j1",
+                                  "inputs:def"])
+        self.assertEqual(resource.parseDescriptionTag(description,
+                                                      "inputs"), "def")
+        self.assertEqual(resource.parseDescriptionTag(description,
+                                                      "jobid"), "j1")
+        self.assertIsNone(resource.parseDescriptionTag("queryhash:abc",
+                                                       "inputs"))
+
+    def testNormalizeQueryIgnoresCommentsWhitespaceAndKeywordCase(self):
+        original = "#standardSQL\n-- daily\nselect a,  b\nfrom " \
+                   "`p.d.t` /* note */ where x = 'a  -- b'"
+        edited = "#standardSQL\nSELECT a, b FROM `p.d.t`\n" \
+                 "  WHERE x='a  -- b' # trailing"
+        self.assertEqual(resource.normalizeQuery(original),
+                         resource.normalizeQuery(edited))
+        self.assertEqual(resource.normalizeQuery(original),
+                         "#standardsql\nSELECT a,b FROM `p.d.t` "
+                         "WHERE x='a  -- b'")
+        # literals, identifiers and directives are significant
+        self.assertNotEqual(resource.normalizeQuery("select 'a b'"),
+                            resource.normalizeQuery("select 'a  b'"))
+        self.assertNotEqual(resource.normalizeQuery("select A"),
+                            resource.normalizeQuery("select a"))
+        self.assertNotEqual(resource.normalizeQuery("#legacySQL\nselect 1"),
+                            resource.normalizeQuery("select 1"))
+
+    def testNormalizedHashRecognizesLegacyDescription(self):
+        client = Mock()
+        rsrc = BqQueryBasedResource(["select 1 as one"], Mock(), client,
+                                    queryHash="normalized")
+        legacy = BqQueryBasedResource(["select 1 as one"], Mock(), client)
+        client.get_table.return_value.description = \
+            legacy.makeDescription()
+        self.assertFalse(rsrc.shouldUpdate())
+
+        # the query saved in the description is compared when only the
+        # formatting has changed
+        rsrc = BqQueryBasedResource(["SELECT 1 AS one -- one"], Mock(),
+                                    client, queryHash="normalized")
+        self.assertFalse(rsrc.shouldUpdate())
+
+        rsrc = BqQueryBasedResource(["select 2 as one"], Mock(), client,
+                                    queryHash="normalized")
+        self.assertTrue(rsrc.shouldUpdate())
+
+    def testAddQueryInvalidatesMemoizedQuery(self):
+        table = Mock()
+        table.dataset_id = "d"
+        table.table_id = "t"
+        rsrc = BqQueryBasedResource(["select 1"], table, Mock())
+        other = BqQueryBasedResource(["select 1", "select 2"], table,
+                                     Mock())
+        hashTag = rsrc.makeQueryHashTag()
+        self.assertNotEqual(rsrc, other)
+
+        rsrc.addQuery("select 2")
+        rsrc.addQuery("select 2")
+        self.assertEqual(rsrc.makeFinalQuery(),
+                         "select 1\nunion all\nselect 2")
+        self.assertNotEqual(rsrc.makeQueryHashTag(), hashTag)
+        self.assertEqual(rsrc, other)
+
+    def testLocalDataSkipsAHeaderUnlessSniffing(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "t.localdata")
+            with open(path, "w") as f:
+                f.write("a\tb\tc\n1\t2\t3\n")
+            schema = loader.loadSchemaFromString(
+                "col1:string,col2:string,col3:string")
+            rsrc = BqDataLoadTableResource(path, Mock(), schema, Mock(),
+                                           None)
+            self.assertEqual(rsrc.format()["skip_leading_rows"], 1)
+            self.assertIsNone(rsrc.format()["field_delimiter"])
+
+            rsrc = BqDataLoadTableResource(path, Mock(), schema, Mock(),
+                                           None, sniffFormat=True)
+            self.assertEqual(rsrc.format()["field_delimiter"], "\t")
+
+    def testMalformedLocalDataFailsOnlyItsResource(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "t.localdata")
+            with open(path, "w") as f:
+                f.write("a,b\nc\nd;e;f\n")
+            client = Mock()
+            rsrc = BqDataLoadTableResource(path, Mock(), (), client, None,
+                                           sniffFormat=True)
+            with self.assertRaises(resource.ResourceFailed):
+                rsrc.create()
+            # the table is left as it was
+            client.update_table.assert_not_called()
+            client.load_table_from_file.assert_not_called()
+
+    def testLegacyFileHashIsRecognized(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            path = folder + "/t.localdata"
+            for (f, content) in [(path, "a\tb\n"),
+                                 (path + ".schema", "a:string")]:
+                with open(f, "w") as out:
+                    out.write(content)
+
+            client = Mock()
+            rsrc = BqDataLoadTableResource(path, Mock(), (), client, None)
+            client.get_table.return_value.description = \
+                "Do not edit\n" + rsrc.makeLegacyHashTag()
+            self.assertFalse(rsrc.shouldUpdate())
+            self.assertTrue(rsrc.makeHashTag().startswith("filehash-b2:"))
+
+            rsrc.invalidate()
+            client.get_table.return_value.description = \
+                "Do not edit\nfilehash:0:0"
+            self.assertTrue(rsrc.shouldUpdate())
+
     def testDetectSourceFormatForJson(self):
         self.assertEquals(
             SourceFormat.NEWLINE_DELIMITED_JSON,
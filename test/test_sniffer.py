@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from mock import patch
+
+import sniffer
+from sniffer import FormatError, firstLineFormat, sniff, sniffFile
+
+
+class Test(unittest.TestCase):
+    def testJsonWithBlankFirstLine(self):
+        self.assertEqual(sniff(b'\n{"a": 1}\n{"a": 2}\n', True),
+                         {"source_format": "NEWLINE_DELIMITED_JSON",
+                          "field_delimiter": None, "skip_leading_rows": 0})
+
+    def testJsonHeaderLineIsAnError(self):
+        with self.assertRaises(FormatError):
+            sniff(b'["a"]\n{"a": 1}\n{"a": 2}\n', True)
+        with self.assertRaises(FormatError):
+            sniff(b'{"a": 1}\n1\tb\n', True)
+
+    def testSingleColumnValuesMayHoldDelimiters(self):
+        self.assertEqual(sniff(b"a, b\nc\nd, e\n", True, ["only"]),
+                         {"source_format": "CSV", "field_delimiter": "\t",
+                          "skip_leading_rows": 0})
+        with self.assertRaises(FormatError):
+            sniff(b"a, b\nc\nd, e\n", True)
+
+    def testFirstLineFormat(self):
+        self.assertEqual(firstLineFormat(b'{"a": 1}\nx'),
+                         {"source_format": "NEWLINE_DELIMITED_JSON",
+                          "field_delimiter": None, "skip_leading_rows": 0})
+        self.assertEqual(firstLineFormat(b"a\tb\tc\n1\t2\t3\n", None, 1),
+                         {"source_format": "CSV", "field_delimiter": None,
+                          "skip_leading_rows": 1})
+
+    def testDelimiterAndHeader(self):
+        self.assertEqual(sniff(b"name\tcount\nx\t1\ny\t2\n", True),
+                         {"source_format": "CSV", "field_delimiter": "\t",
+                          "skip_leading_rows": 1})
+        self.assertEqual(sniff(b"x,y\nz,w\n", True)["field_delimiter"],
+                         ",")
+        self.assertEqual(sniff(b"x,y\nz,w\n", True)["skip_leading_rows"],
+                         0)
+        # a header naming the columns of the schema
+        self.assertEqual(sniff(b"A,B\nz,w\n", True,
+                               ["a", "b"])["skip_leading_rows"], 1)
+
+    def testRaggedLinesAreAnError(self):
+        with self.assertRaises(FormatError):
+            sniff(b"a\tb\nc\n", True)
+
+    def testPartialLastLineOfSampleIsIgnored(self):
+        self.assertEqual(sniff(b'{"a": 1}\n{"a": 2}\n{"a', False)
+                         ["source_format"], "NEWLINE_DELIMITED_JSON")
+
+    def testDecisionIsCachedWithFile(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "a.localdata")
+            with open(path, "w") as f:
+                f.write("a\tb\n")
+            with patch("sniffer.sniff", wraps=sniffer.sniff) as sniffed:
+                first = sniffFile(path)
+                self.assertEqual(sniffFile(path), first)
+                self.assertEqual(sniffed.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
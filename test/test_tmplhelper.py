@@ -4,7 +4,11 @@ from datetime import datetime, timedelta
 
 from frozendict import frozendict
 
-from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse
+import tmplhelper
+from date_formatter_helper import helpers
+from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse, \
+    iterExplodeTemplate, compileTemplate, keysOfTemplate, parseAsOf, \
+    TemplateScope
 
 
 class Test(unittest.TestCase):
@@ -198,6 +202,122 @@ class Test(unittest.TestCase):
         result = set(frozendict(x) for x in result)
         self.assertEqual(expected, result)
 
+    def testIterExplodeTemplateIsLazy(self):
+        templateVars = {"a": list(range(1000)), "b": list(range(1000)),
+                        "c": "x"}
+        result = iterExplodeTemplate(templateVars)
+        self.assertEqual(next(result), {"a": 0, "b": 0, "c": "x"})
+        self.assertEqual(next(result), {"a": 0, "b": 1, "c": "x"})
+
+    def testExplodeTemplateLimit(self):
+        templateVars = {"a": ["1", "2", "3"], "b": ["1", "2"], "c": "x"}
+        self.assertEqual(len(explodeTemplate(templateVars, limit=6)), 6)
+        try:
+            explodeTemplate(templateVars, limit=5)
+            self.fail("should have exceeded the limit")
+        except Exception as e:
+            self.assertIn("6 combinations", str(e))
+            self.assertIn("a=3, b=2", str(e))
+
+    def testCompiledTemplateRendersLikeFormat(self):
+        templateVars = {"a": "x", "b": 2, "c": 1.5}
+        for template in ["{a}_{b}", "{{a}} {a}", "plain", "{c:.2f}-{a!r}",
+                         "{a}{b}{a}"]:
+            self.assertEqual(compileTemplate(template).render(templateVars),
+                             template.format(**templateVars))
+        self.assertEqual(keysOfTemplate("{a}_{b}_{a} {{c}}"),
+                         set(["a", "b"]))
+        self.assertIs(compileTemplate("{a}_{b}"), compileTemplate("{a}_{b}"))
+        try:
+            compileTemplate("{missing}").render(templateVars)
+            self.fail("should have raised KeyError")
+        except KeyError:
+            pass
+
+    def testEvalTmplRecurseNamesCycleKeys(self):
+        input = {"a": "{b}", "b": "{c}", "c": "{b}_{d}", "d": "e",
+                 "f": "{a}"}
+        try:
+            evalTmplRecurse(input)
+            self.fail("We should have blown up")
+        except Exception as e:
+            self.assertIn("b -> c -> b", str(e))
+
+    def testEvalTmplRecurseNamesUndefinedKeys(self):
+        try:
+            evalTmplRecurse({"a": "{b}_{c}", "c": "d"})
+            self.fail("We should have blown up")
+        except Exception as e:
+            self.assertIn("a refers to b which are not defined", str(e))
+
+    def testEvalTmplRecurseDeepChain(self):
+        input = {"k0": "end"}
+        for i in range(1, 200):
+            input["k" + str(i)] = "{k" + str(i - 1) + "}"
+        self.assertEqual(evalTmplRecurse(input)["k199"], "end")
+
+    def testDateVarsUseAsOf(self):
+        try:
+            tmplhelper.asOf = parseAsOf("2005123123")
+            result = explodeTemplate({"yyyymmddhh": [0, -1],
+                                      "yyyymmdd": -1})
+            self.assertEqual(
+                [(r["yyyymmddhh"], r["yyyymmdd"]) for r in result],
+                [("2005123122", "20051230"), ("2005123123", "20051230")])
+        finally:
+            tmplhelper.asOf = None
+        self.assertRaises(ValueError, parseAsOf, "2005-12-31")
+
+    def testHandleDateFieldPrecomputesComponents(self):
+        d = datetime.strptime('20051231', '%Y%m%d')
+        handleDateField(d, [-1, -2], "yyyymmddhh")
+        m = {"foo_yyyymmddhh": "2005123023"}
+        helpers.format_all_date_keys(m)
+        self.assertEqual(m["foo_yyyymmddhh_hh"], "23")
+        self.assertEqual(m["foo_yyyymmddhh_dd"], "30")
+        hourly = [f for f in helpers.formatters
+                  if f.formats[0] == "%Y%m%d%H"][0]
+        self.assertEqual(hourly.expansions["2005123022"],
+                         ("2005", "12", "30", "22"))
+
+    def testTemplateScopeEvaluatesLikeEvalTmplRecurse(self):
+        shared = {"dataset": "d_{env}", "env": ["dev", "prod"],
+                  "region": "eu", "path": "{region}/{table}",
+                  "yyyymmdd": "20240102", "day": "{yyyymmdd_dd}",
+                  "static": "{region}-{yyyymmdd_mm}",
+                  "static_dash2uscore": "{region}-x"}
+        entries = [{"table": "t"}, {"table": "u", "region": "us"},
+                   {"table": "v", "yyyymmdd": [-1, 0]},
+                   {"table": "w", "env": "test", "yyyymmdd_mm": "13"}]
+        try:
+            tmplhelper.asOf = parseAsOf("20240301")
+            scope = TemplateScope([shared])
+            for entry in entries:
+                expected = [dict(evalTmplRecurse(c)) for c in
+                            iterExplodeTemplate(dict(shared, **entry))]
+                self.assertEqual([dict(c) for c in scope.iterEntry(entry)],
+                                 expected)
+        finally:
+            tmplhelper.asOf = None
+        # the shared keys are resolved once rather than per combination
+        self.assertEqual(scope.base["static"], "eu-01")
+        self.assertEqual(scope.base["static_dash2uscore"], "eu_x")
+        self.assertEqual(scope.dirty, set(["env", "dataset", "path"]))
+
+    def testTemplateScopeReportsUndefinedKeysPerEntry(self):
+        scope = TemplateScope([{"a": "{b}"}])
+        self.assertEqual(next(scope.iterEntry({"b": "c"}))["a"], "c")
+        try:
+            next(scope.iterEntry({}))
+            self.fail("We should have blown up")
+        except Exception as e:
+            self.assertIn("a refers to b which are not defined", str(e))
+        try:
+            next(scope.iterEntry({"x": ["1", "2", "3"]}, limit=2))
+            self.fail("should have exceeded the limit")
+        except Exception as e:
+            self.assertIn("3 combinations", str(e))
+
 
 if __name__ == '__main__':
     unittest.main()